@@ -1,37 +1,117 @@
 import os
+import json
 import pandas as pd
 import glob
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "pop_stus"))
+from profiling import span
 
 # ======== 配置 ========
 results_folder = r"E:\WordPop\results"
 output_path = os.path.join(results_folder, "total_population_by_city.csv")
 
-# ======== 读取所有年龄段 CSV ========
-csv_files = glob.glob(os.path.join(results_folder, "population_age_*.csv"))
-print(f"Found {len(csv_files)} age-group CSV files.")
-
-# ======== 合并所有年龄段 ========
-dfs = []
-for file in csv_files:
-    age_group = os.path.basename(file).split("_")[2].replace(".csv", "")
-    df = pd.read_csv(file)
-    df = df[["GID_2", "population_sum"]].rename(columns={"population_sum": f"age_{age_group}"})
-    dfs.append(df)
-
-# ======== 合并所有年龄段列 ========
-merged = dfs[0]
-for df in dfs[1:]:
-    merged = merged.merge(df, on="GID_2", how="outer")
-
-# ======== 计算总人口 ========
-age_columns = [col for col in merged.columns if col.startswith("age_")]
-merged["total_population"] = merged[age_columns].sum(axis=1, skipna=True)
-
-# ======== 添加城市名称信息 ========
-sample_df = pd.read_csv(csv_files[0])
-name_info = sample_df[["GID_2", "NAME_2", "NAME_1"]].drop_duplicates()
-final = merged.merge(name_info, on="GID_2")
-
-# ======== 保存结果 ========
-final[["GID_2", "NAME_2", "NAME_1", "total_population"]].to_csv(output_path, index=False)
-print(f"✅ Total population by city saved to: {output_path}")
\ No newline at end of file
+# 增量状态：已合并输入的清单 + 各输入列组成的宽表
+# 新增或修改的 CSV 只读取它自己并补到宽表中，未变化的输入不再重复读取
+state_folder = os.path.join(results_folder, ".merge_state")
+manifest_path = os.path.join(state_folder, "manifest.json")
+table_path = os.path.join(state_folder, "age_table.parquet")
+
+NAME_COLUMNS = ["NAME_2", "NAME_1"]
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def column_name(path):
+    # population_age_00.csv -> age_00（文件名中更多字段，如年份，会保留在列名中）
+    return os.path.splitext(os.path.basename(path))[0].split("_", 1)[1]
+
+
+def load_state():
+    if os.path.exists(manifest_path) and os.path.exists(table_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        table = pd.read_parquet(table_path)
+        return manifest, table
+    return {}, pd.DataFrame(columns=NAME_COLUMNS, index=pd.Index([], name="GID_2"))
+
+
+def save_state(manifest, table):
+    os.makedirs(state_folder, exist_ok=True)
+    table.to_parquet(table_path + ".tmp")
+    os.replace(table_path + ".tmp", table_path)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def read_inputs(paths):
+    """新输入一次 concat 成长表，再一次 pivot 成宽表（每个文件一列）"""
+    frames = []
+    for path in paths:
+        df = pd.read_csv(path, usecols=["GID_2", "population_sum"] + NAME_COLUMNS)
+        df["column"] = column_name(path)
+        frames.append(df)
+    long_df = pd.concat(frames, ignore_index=True)
+
+    # 同一输入中重复的 GID_2（例如重跑追加写入）保留最后一行，并报告数量
+    duplicated = long_df.duplicated(["GID_2", "column"], keep="last")
+    if duplicated.any():
+        counts = long_df.loc[duplicated, "column"].value_counts()
+        for column, n in counts.items():
+            print(f"⚠ {column}: {n} duplicate GID_2 rows, keeping the last one")
+        long_df = long_df[~duplicated]
+
+    wide = long_df.pivot(index="GID_2", columns="column", values="population_sum")
+    wide.columns.name = None
+    names = long_df.drop_duplicates("GID_2").set_index("GID_2")[NAME_COLUMNS]
+    return wide, names
+
+
+def main():
+    # ======== 扫描所有年龄段 CSV ========
+    csv_files = sorted(glob.glob(os.path.join(results_folder, "population_age_*.csv")))
+    print(f"Found {len(csv_files)} age-group CSV files.")
+
+    manifest, table = load_state()
+    current = {os.path.basename(p): file_signature(p) for p in csv_files}
+
+    # ======== 移除已删除或已修改的输入列 ========
+    stale = [name for name, entry in manifest.items()
+             if current.get(name) != entry["signature"]]
+    for name in stale:
+        table = table.drop(columns=manifest.pop(name)["column"], errors="ignore")
+
+    # ======== 只读取新增 / 修改的输入 ========
+    new_files = [p for p in csv_files if os.path.basename(p) not in manifest]
+    print(f"{len(manifest)} unchanged, {len(stale)} removed or modified, {len(new_files)} to read.")
+
+    if new_files:
+        wide, names = read_inputs(new_files)
+        table = table.join(wide, how="outer")
+        table[NAME_COLUMNS] = table[NAME_COLUMNS].combine_first(names)
+        for path in new_files:
+            manifest[os.path.basename(path)] = {
+                "signature": current[os.path.basename(path)],
+                "column": column_name(path),
+            }
+
+    if stale or new_files:
+        save_state(manifest, table)
+
+    # ======== 计算总人口 ========
+    age_columns = [col for col in table.columns if col.startswith("age_")]
+    final = table[NAME_COLUMNS].copy()
+    final["total_population"] = table[age_columns].sum(axis=1, skipna=True)
+
+    # ======== 保存结果 ========
+    final.reset_index()[["GID_2", "NAME_2", "NAME_1", "total_population"]].to_csv(output_path, index=False)
+    print(f"✅ Total population by city saved to: {output_path}")
+
+
+if __name__ == "__main__":
+    with span("merge"):
+        main()
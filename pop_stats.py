@@ -1,56 +1,76 @@
 import os
-import geopandas as gpd
+import sys
+import numpy as np
 from rasterstats import zonal_stats
-import pandas as pd
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "pop_stus"))
+import rasterio
+from label_zonal import grid_key, vector_key, get_label_raster, zonal_sums, stream_zonal_sums
+from coverage_weights import get_coverage_matrix, coverage_sums
+from boundary_cache import load_boundaries
+from result_store import build_frame, write_results
+from profiling import span
 
 # ======== 配置 ========
-vector_path = r"USA\gadm41_USA_2.shp" 
+vector_path = r"USA\gadm41_USA_2.shp"
 base_raster_folder = r"F:\wordpop_USA\both"  # 根目录
 output_folder = r"./population"
+label_cache_folder = r"./cache/labels"  # 县界标签栅格缓存（按格网）
+
+# "parquet"：写入 output_folder/store 下按 Year/Gender/Age 分区的列式结果库（见 pop_stus/result_store.py）
+# "csv"：每年一个 population_usa_{year}.csv（原方式）
+output_format = "parquet"
 
-os.makedirs(output_folder, exist_ok=True)
+# "coverage"：县 × 像元覆盖权重稀疏矩阵（按像元面积覆盖比例，边界像元按比例分给相邻县），
+#             按格网只构建一次；每年同一格网的性别 × 年龄波段按进程数分批，每批一次稀疏矩阵乘
+# "label"：县界按格网只栅格化一次 + 每个文件一次 bincount（结果与 all_touched=False 的 zonal_stats 一致）
+# "rasterstats"：逐文件调用 zonal_stats（原方式，较慢）
+# "cube"：从多年份人口数据立方体读取（先运行 pop_stus/pop_datacube.py 入库），全部年份 × 波段一次分块扫描，
+#         县的像元归属与 coverage 引擎相同（覆盖权重）
+zonal_engine = "coverage"
+population_cube = r"./cube/worldpop_usa.zarr"
+coverage_cache_folder = r"./cache/coverage"   # coverage / cube 引擎：覆盖权重矩阵缓存（按县界 × 格网）
 
-# ======== 读取矢量边界 ========
-print("Loading county boundaries...")
-counties = gpd.read_file(vector_path)
-counties = counties.to_crs(epsg=4326)
+# 流式模式（仅 label 引擎）：按栅格分块读取累加，峰值内存不超过该值（MB）；None 表示整幅读入
+stream_max_memory_mb = None
+stream_workers = 4
+
+# 并行：max_workers > 1 时按 (年份, tif)（coverage 引擎按 (年份, 格网, 波段批)）分发到进程池，None 表示使用全部核心
+# 每个进程只开 1 个 GDAL 线程，GDAL 缓存总量按进程数均分，避免线程超订
+max_workers = 1
+gdal_cache_total_mb = 4096
 
 # 手动指定需要处理的年份列表
 target_years = ["2021", "2022", "2023"]
 
-# ======== 循环年份处理 ========
-for year in target_years:
-    year_path = os.path.join(base_raster_folder, str(year))
-    
-    # 检查该年份文件夹是否存在
-    if not os.path.exists(year_path):
-        print(f"⚠️ Skip: Folder for {year} not found.")
-        continue
-    
-    # 递归扫描该年份文件夹下所有 tif (包括子文件夹如 fm)
+
+def load_counties(path):
+    # 预投影边界缓存（pop_stus/boundary_cache.py），进程池各进程也直接读取缓存
+    return load_boundaries(path, "EPSG:4326").gdf
+
+
+def find_year_tifs(year):
+    """递归扫描该年份文件夹下所有 tif (包括子文件夹如 fm)"""
     tif_files = []
-    for root, dirs, files in os.walk(year_path):
+    for root, dirs, files in os.walk(os.path.join(base_raster_folder, str(year))):
         for f in files:
             if f.endswith(".tif"):
                 tif_files.append(os.path.join(root, f))
-    
-    if not tif_files:
-        continue
-        
-    print(f"\nProcessing Year: {year} ({len(tif_files)} files found)")
-    
-    all_results = []  # 用于存储该年份的所有统计行
-
-    for tif_path in tqdm(tif_files, desc=f"Year {year}"):
-        filename = os.path.basename(tif_path)
-        
-        # 解析文件名: usa_f_00_2023_CN_100m_R2025A_v1.tif
-        parts = filename.split("_")
-        gender = parts[1]      # 'f' 或 'm'
-        age_group = parts[2]   # '00', '05' 等
-        
-        # 计算空间统计
+    return tif_files
+
+
+def file_sums(counties, counties_key, tif_path, workers=stream_workers):
+    """计算单个人口文件的各县总和（与 counties 行顺序一致）"""
+    with span("pop_stats.file", file=os.path.basename(tif_path), engine=zonal_engine):
+        if zonal_engine == "label":
+            label_path = get_label_raster(counties, tif_path, label_cache_folder, vec_key=counties_key)
+            if stream_max_memory_mb:
+                return stream_zonal_sums(label_path, tif_path, len(counties), nodata=-99999,
+                                         max_memory_mb=stream_max_memory_mb, workers=workers)
+            return zonal_sums(label_path, tif_path, len(counties), nodata=-99999)
+
         stats = zonal_stats(
             vectors=counties,
             raster=tif_path,
@@ -58,22 +78,223 @@ for year in target_years:
             all_touched=False,
             nodata=-99999
         )
-        
-        # 将结果按行填入列表，并进行字段重命名
-        for idx, row in counties.iterrows():
-            all_results.append({
-                "GID_2": row["GID_2"],
-                "Province": row["NAME_1"],
-                "City": row["NAME_2"],
-                "Gender": gender,
-                "Age": age_group,
-                "Population": stats[idx]["sum"] or 0 # 对应您要求的 Affected_Pop 逻辑
-            })
-    
-    # 将该年份所有数据转为 DataFrame 并保存
-    year_df = pd.DataFrame(all_results)
-    output_csv = os.path.join(output_folder, f"population_usa_{year}.csv")
-    year_df.to_csv(output_csv, index=False)
-    print(f"Saved annual file: {output_csv}")
-
-print("\nAll done!")
\ No newline at end of file
+        return [s["sum"] for s in stats]
+
+
+def parse_name(tif_path):
+    # 解析文件名: usa_f_00_2023_CN_100m_R2025A_v1.tif
+    parts = os.path.basename(tif_path).split("_")
+    gender = parts[1]      # 'f' 或 'm'
+    age_group = parts[2]   # '00', '05' 等
+    return gender, age_group
+
+
+def save_year(counties, year, bands, sums_list):
+    """
+    将该年份所有数据转为 DataFrame 并保存（行顺序与串行模式相同）
+    bands: 与 sums_list 对应的 (性别, 年龄) 列表
+    """
+    with span("pop_stats.save_year", year=year, files=len(bands)):
+        genders, ages = zip(*bands)
+        # rasterstats 引擎中无像元的县为 None -> NaN -> 0
+        values = np.nan_to_num(np.vstack([np.asarray(s, dtype="float64") for s in sums_list]))
+        if output_format == "parquet":
+            year_df = build_frame(counties, values, "Population", Year=int(year), Gender=genders, Age=ages)
+            store_root = os.path.join(output_folder, "store")
+            write_results(year_df, store_root, "population")
+            print(f"Saved year {year} to: {store_root}")
+            return
+
+        # 每个 (性别, 年龄) 一组全县结果，顺序与逐文件拼行相同
+        year_df = build_frame(counties, values, "Population", Gender=genders, Age=ages)
+        year_df = year_df.rename(columns={"NAME_1": "Province", "NAME_2": "City"})[
+            ["GID_2", "Province", "City", "Gender", "Age", "Population"]
+        ]
+        output_csv = os.path.join(output_folder, f"population_usa_{year}.csv")
+        year_df.to_csv(output_csv, index=False)
+        print(f"Saved annual file: {output_csv}")
+
+
+def run_serial(counties, counties_key, year_tifs):
+    for year, tif_files in year_tifs.items():
+        print(f"\nProcessing Year: {year} ({len(tif_files)} files found)")
+        sums_list = [file_sums(counties, counties_key, tif_path)
+                     for tif_path in tqdm(tif_files, desc=f"Year {year}")]
+        save_year(counties, year, [parse_name(p) for p in tif_files], sums_list)
+
+
+# ======== 并行模式：进程内全局状态（由 initializer 加载一次） ========
+_worker = {}
+
+
+def _init_worker(counties_path, counties_key, gdal_cache_mb, threads):
+    # 父进程通常已初始化 GDAL，fork 出的子进程不再读取环境变量；
+    # 进程存续期间保持一个 rasterio.Env，预算对本进程之后的所有读取生效
+    _worker["env"] = rasterio.Env(GDAL_NUM_THREADS=1, GDAL_CACHEMAX=gdal_cache_mb)
+    _worker["env"].__enter__()
+    _worker["counties"] = load_counties(counties_path)
+    _worker["key"] = counties_key
+    _worker["threads"] = threads
+
+
+def _worker_file_sums(year, file_idx, tif_path):
+    sums = file_sums(_worker["counties"], _worker["key"], tif_path, workers=_worker["threads"])
+    return year, file_idx, sums
+
+
+def run_parallel(counties, counties_key, year_tifs, workers):
+    jobs = [(year, i, tif_path) for year, tif_files in year_tifs.items()
+            for i, tif_path in enumerate(tif_files)]
+
+    # 标签栅格先在主进程按格网构建好，避免多个进程同时构建同一缓存
+    if zonal_engine == "label":
+        for _, _, tif_path in tqdm(jobs, desc="Label rasters"):
+            get_label_raster(counties, tif_path, label_cache_folder, vec_key=counties_key)
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    gdal_cache_mb = max(64, gdal_cache_total_mb // workers)
+    pending = {year: len(tif_files) for year, tif_files in year_tifs.items()}
+    results = {year: [None] * len(tif_files) for year, tif_files in year_tifs.items()}
+
+    print(f"\nProcessing {len(jobs)} files on {workers} workers")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(vector_path, counties_key, gdal_cache_mb, threads),
+    ) as executor:
+        futures = [executor.submit(_worker_file_sums, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Files"):
+            year, file_idx, sums = future.result()
+            results[year][file_idx] = sums
+            pending[year] -= 1
+            # 某年份全部完成即写出，不等待其它年份
+            if pending[year] == 0:
+                save_year(counties, year, [parse_name(p) for p in year_tifs[year]], results.pop(year))
+
+
+def run_cube(counties, counties_key):
+    """所有年份 × 性别 × 年龄一次读取：按县界像元索引扫描立方体中含县像元的分块"""
+    from coverage_weights import coverage_triplets
+    from pop_datacube import open_cube, cube_years, CubeGrid, cube_zonal_sums
+
+    cube = open_cube(population_cube)
+    available = cube_years(cube)
+    years = [int(y) for y in target_years if int(y) in available]
+    for year in target_years:
+        if int(year) not in available:
+            print(f"⚠️ Skip: {year} not in cube {population_cube}")
+    if not years:
+        return
+
+    attrs = cube.attrs.asdict()
+    matrix, pixels = get_coverage_matrix(counties, CubeGrid(attrs), coverage_cache_folder, vec_key=counties_key)
+    zones, pixels, weights = coverage_triplets(matrix, pixels)
+    print(f"\nProcessing {len(years)} years from cube ({len(pixels)} county pixels)")
+    with span("pop_stats.cube", years=len(years)):
+        years, sums = cube_zonal_sums(cube, zones, pixels, len(counties), years=years, weights=weights)
+
+    bands = [(g, a) for g in attrs["genders"] for a in attrs["ages"]]
+    for y, year in enumerate(years):
+        save_year(counties, year, bands, list(sums[y].reshape(len(bands), len(counties))))
+
+
+def coverage_batch_sums(counties, counties_key, paths):
+    """同一格网的一批波段与覆盖权重矩阵做一次矩阵乘，返回 (len(paths), n_counties)"""
+    with rasterio.open(paths[0]) as src:
+        matrix, pixels = get_coverage_matrix(counties, src, coverage_cache_folder, vec_key=counties_key)
+    with span("pop_stats.coverage", files=len(paths)):
+        return coverage_sums(matrix, pixels, paths, nodata=-99999)
+
+
+def _worker_coverage_sums(year, indices, paths):
+    return year, indices, coverage_batch_sums(_worker["counties"], _worker["key"], paths)
+
+
+def run_coverage(counties, counties_key, year_tifs, workers):
+    """
+    每个年份按格网分组，同一格网的波段按进程数分批，每批与覆盖权重矩阵做一次矩阵乘。
+    workers > 1 时各批分发到进程池（与 run_parallel 相同的 GDAL 预算），某年份全部完成即写出。
+    """
+    jobs = []
+    for year, tif_files in year_tifs.items():
+        groups = {}
+        for i, tif_path in enumerate(tif_files):
+            with rasterio.open(tif_path) as src:
+                groups.setdefault(grid_key(src), []).append(i)
+        for members in groups.values():
+            # 权重矩阵先在主进程构建好，避免多个进程同时构建同一缓存
+            with rasterio.open(tif_files[members[0]]) as src:
+                get_coverage_matrix(counties, src, coverage_cache_folder, vec_key=counties_key)
+            per_job = -(-len(members) // workers)
+            for b0 in range(0, len(members), per_job):
+                batch = members[b0:b0 + per_job]
+                jobs.append((year, batch, [tif_files[i] for i in batch]))
+
+    pending = {year: len(tif_files) for year, tif_files in year_tifs.items()}
+    results = {year: [None] * len(tif_files) for year, tif_files in year_tifs.items()}
+
+    def collect(year, indices, sums):
+        for i, row in zip(indices, sums):
+            results[year][i] = row
+        pending[year] -= len(indices)
+        if pending[year] == 0:
+            tif_files = year_tifs[year]
+            save_year(counties, year, [parse_name(p) for p in tif_files], results.pop(year))
+
+    print(f"\nProcessing {len(jobs)} coverage batches on {workers} workers")
+    if workers <= 1:
+        for year, indices, paths in tqdm(jobs, desc="Batches"):
+            collect(year, indices, coverage_batch_sums(counties, counties_key, paths))
+        return
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    gdal_cache_mb = max(64, gdal_cache_total_mb // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(vector_path, counties_key, gdal_cache_mb, threads),
+    ) as executor:
+        futures = [executor.submit(_worker_coverage_sums, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Batches"):
+            collect(*future.result())
+
+
+def main():
+    os.makedirs(output_folder, exist_ok=True)
+
+    # ======== 读取矢量边界 ========
+    print("Loading county boundaries...")
+    counties = load_counties(vector_path)
+    counties_key = vector_key(counties)
+
+    if zonal_engine == "cube":
+        run_cube(counties, counties_key)
+        print("\nAll done!")
+        return
+
+    # ======== 收集各年份文件 ========
+    year_tifs = {}
+    for year in target_years:
+        # 检查该年份文件夹是否存在
+        if not os.path.exists(os.path.join(base_raster_folder, str(year))):
+            print(f"⚠️ Skip: Folder for {year} not found.")
+            continue
+
+        tif_files = find_year_tifs(year)
+        if tif_files:
+            year_tifs[year] = tif_files
+
+    workers = max_workers or os.cpu_count() or 1
+    if zonal_engine == "coverage":
+        run_coverage(counties, counties_key, year_tifs, workers)
+    elif workers > 1:
+        run_parallel(counties, counties_key, year_tifs, workers)
+    else:
+        run_serial(counties, counties_key, year_tifs)
+
+    print("\nAll done!")
+
+
+if __name__ == "__main__":
+    with span("pop_stats", engine=zonal_engine):
+        main()
@@ -1,73 +1,237 @@
 import rasterio
 from rasterio.features import shapes
-import geopandas as gpd
-import pandas as pd
+from rasterio.windows import Window
 import numpy as np
+import shapely
 import os
+import pyogrio
+from pyproj import CRS, Transformer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+from vector_sink import FeatureSink, vector_path
+from profiling import span
+
+'''
+噪声栅格 -> 各阈值（>= threshold dB）矢量面
+    ✅ 整幅只读一遍：按阈值分级为 0..n 的级别栅格（级别 k 表示落在第 k 个阈值区间内）
+    ✅ 按分块在进程池中并行矢量化，多边形在像元坐标系中生成（整数坐标）
+    ✅ 累计图层（>= 阈值）由各级别面自高向低逐级合并得到，不再对每个阈值重新矢量化
+    ✅ 融合按分块进行（不做全局 dissolve），各块结果流式写入 GeoPackage / FlatGeobuf（带空间索引），
+       内存只与在途分块数和写出批大小有关
+    ⚠ 默认输出每个 (分块, 阈值) 一个要素：跨分块的面沿 tile_size 格网被切开（2.空间拓扑相交 会先合并，
+      不受影响）；直接使用输出文件、需要完整面时设 stitch_tiles = True，写完后按阈值全局合并为一个要素
+'''
+
+# === 并行 ===
+tile_size = 4096             # 矢量化分块边长（像元）；输出要素按此格网切开（见 stitch_tiles）
+max_workers = None           # None 表示使用全部核心
+gdal_cache_total_mb = 4096   # GDAL 缓存总量，按进程数均分
+
+# === 输出 ===
+output_driver = "GPKG"       # "GPKG" 或 "FlatGeobuf"
+output_crs = "EPSG:4326"
+batch_size = 256             # 每批（每个事务）写出的要素数
+stitch_tiles = False         # True：写完后把各分块要素合并为一个要素（union_all，整层读入内存，较慢）
+
+
+def quantize(noise_data, thresholds, nodata_val):
+    """噪声值 -> 级别：不超过该值的阈值个数（nodata / NaN 为 0，与原先置 0 后比较一致）"""
+    level = np.searchsorted(thresholds, noise_data, side="right").astype("uint8")
+    level[noise_data == nodata_val] = 0
+    if np.issubdtype(noise_data.dtype, np.floating):
+        level[np.isnan(noise_data)] = 0
+    return level
+
+
+# ======== 进程池：每个进程打开一次源影像 ========
+_worker = {}
+
+
+def _init_worker(gdal_cache_mb):
+    # 父进程通常已初始化 GDAL，fork 出的子进程不再读取环境变量；
+    # 进程存续期间保持一个 rasterio.Env，预算对本进程之后的所有读取生效
+    _worker["env"] = rasterio.Env(GDAL_NUM_THREADS=1, GDAL_CACHEMAX=gdal_cache_mb)
+    _worker["env"].__enter__()
+
+
+def _worker_src(tif_path):
+    if _worker.get("path") != tif_path:
+        if "src" in _worker:
+            _worker["src"].close()
+        _worker["src"] = rasterio.open(tif_path)
+        _worker["path"] = tif_path
+    return _worker["src"]
+
+
+def _worker_transformer(crs_wkt):
+    if _worker.get("crs") != crs_wkt:
+        _worker["transformer"] = Transformer.from_crs(CRS.from_wkt(crs_wkt), output_crs, always_xy=True)
+        _worker["crs"] = crs_wkt
+    return _worker["transformer"]
+
+
+def to_output_coords(geom, transform, transformer):
+    """去掉加密时插入的共线节点（容差 0，形状不变），再由像元坐标转为地图坐标并重投影至输出坐标系"""
+    geom = shapely.simplify(geom, 0)
+
+    def project(xy):
+        x, y = transform * (xy[:, 0], xy[:, 1])
+        return np.column_stack(transformer.transform(x, y))
+
+    return shapely.transform(geom, project)
+
+
+def polygonize_tile(tif_path, window, thresholds):
+    """
+    分块矢量化并在块内融合：返回 {threshold: WKB}（块内 >= threshold 的合并面，输出坐标系），
+    无数据的阈值不包含在内。
+    """
+    with span("vectorize.tile", row=window.row_off, col=window.col_off):
+        src = _worker_src(tif_path)
+        nodata_val = src.nodata if src.nodata is not None else -9999
+        level = quantize(src.read(1, window=window), thresholds, nodata_val)
+        if not level.any():
+            return {}
+
+        # 多边形先在整幅影像的像元行列号坐标系中生成（整数）
+        pixel_transform = rasterio.Affine.translation(window.col_off, window.row_off)
+        bands = {}
+        for geom, value in shapes(level, mask=level > 0, transform=pixel_transform):
+            bands.setdefault(int(value), []).append(shapely.geometry.shape(geom))
+
+        # 在每个像元角点处加密节点：相邻级别的公共边节点完全一致，coverage union 才能合并
+        # 插值得到的坐标取整（角点本来就是整数），避免 14.000000000000002 这类误差破坏节点一致性
+        bands = {value: shapely.transform(shapely.segmentize(geoms, 1.0), np.rint)
+                 for value, geoms in bands.items()}
+
+        # 累计图层：>= 第 k 个阈值 = 级别 k 的面 ∪ (>= 第 k+1 个阈值)
+        transformer = _worker_transformer(src.crs.to_wkt())
+        layers = {}
+        cumulative = None
+        for value in range(len(thresholds), 0, -1):
+            pieces = list(bands.get(value, []))
+            if cumulative is not None:
+                pieces.append(cumulative)
+            if not pieces:
+                continue
+            cumulative = shapely.coverage_union_all(shapely.get_parts(pieces))
+            layers[thresholds[value - 1]] = shapely.to_wkb(
+                to_output_coords(cumulative, src.transform, transformer))
+        return layers
+
+
+def stitch_layer(path, crs_wkt, threshold):
+    """
+    把 path 中的分块要素全局合并为一个要素并原位替换（经 FeatureSink 先写 .partial 再改名）；
+    已只有一个要素时直接返回。分块经简化与重投影后接缝节点不一定一致，因此用 union_all 而不是 coverage union。
+    """
+    if pyogrio.read_info(path)["features"] <= 1:
+        return
+    with span("vectorize.stitch", file=os.path.basename(path)):
+        geoms = pyogrio.read_dataframe(path, columns=[]).geometry.values
+        merged = shapely.union_all(geoms)
+        with FeatureSink(path, crs_wkt, {"dB_level": int}, driver=output_driver, batch_size=1) as sink:
+            sink.add(shapely.to_wkb(merged), dB_level=threshold)
+
+
+def tile_windows(width, height):
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+
+def stream_tiles(executor, tif_path, windows, thresholds, workers):
+    """按完成顺序逐块产出结果；同时在途的分块不超过 2 × workers，结果不会在内存中堆积"""
+    windows = iter(windows)
+    pending = set()
+    with tqdm(total=None, desc="  Tiles") as bar:
+        while True:
+            for window in windows:
+                pending.add(executor.submit(polygonize_tile, tif_path, window, thresholds))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                bar.update(1)
+                yield future.result()
+
 
 def process_all_noise_tifs(input_folder, output_root, thresholds):
     """
-    自动扫描目录下所有TIF，针对每个阈值生成对应的 SHP 矢量。
+    自动扫描目录下所有TIF，针对每个阈值生成对应的矢量文件（GeoPackage / FlatGeobuf）。
+    每个阈值一个文件，每个分块一个要素（块内已融合）；stitch_tiles 为 True 时再全局合并为一个要素，
+    否则分块接缝处的面由下游按需合并。
     """
+    thresholds = sorted(thresholds)
+    workers = max_workers or os.cpu_count() or 1
+
     # 扫描目录下所有 tif 文件
     tif_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.tif', '.tiff'))]
-    
+
     if not tif_files:
         print("❌ 未找到 TIF 文件，请检查路径。")
         return
 
-    for tif_name in tif_files:
-        print(f"\n开始处理原始影像: {tif_name}")
-        tif_path = os.path.join(input_folder, tif_name)
-        
-        # 建立基于文件名的子文件夹，例如 SEL_night_202110
-        file_base_name = os.path.splitext(tif_name)[0]
-        tif_output_dir = os.path.join(output_root, file_base_name)
-        os.makedirs(tif_output_dir, exist_ok=True)
-
-        with rasterio.open(tif_path) as src:
-            noise_data = src.read(1)
-            # 预处理：将 nodata 转为极小值
-            nodata_val = src.nodata if src.nodata is not None else -9999
-            noise_data[noise_data == nodata_val] = 0
+    output_wkt = CRS.from_user_input(output_crs).to_wkt()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(max(64, gdal_cache_total_mb // workers),)) as executor:
+        for tif_name in tif_files:
+            print(f"\n开始处理原始影像: {tif_name}")
+            tif_path = os.path.join(input_folder, tif_name)
+
+            # 建立基于文件名的子文件夹，例如 SEL_night_202110
+            file_base_name = os.path.splitext(tif_name)[0]
+            tif_output_dir = os.path.join(output_root, file_base_name)
+            os.makedirs(tif_output_dir, exist_ok=True)
 
+            output_paths = {t: vector_path(tif_output_dir, f"{file_base_name}_{t}dB", output_driver)
+                            for t in thresholds}
+            # 如果文件已存在则跳过，方便断点续传
+            missing = [t for t, path in output_paths.items() if not os.path.exists(path)]
             for threshold in thresholds:
-                output_shp_path = os.path.join(tif_output_dir, f"{file_base_name}_{threshold}dB.shp")
-                
-                # 如果文件已存在则跳过，方便断点续传
-                if os.path.exists(output_shp_path):
+                if threshold not in missing:
                     print(f"  ⏭  {threshold}dB 已存在，跳过。")
-                    continue
+                    if stitch_tiles:
+                        # 上次中断在写出与合并之间时补做合并
+                        stitch_layer(output_paths[threshold], output_wkt, threshold)
+            if not missing:
+                continue
+
+            with rasterio.open(tif_path) as src:
+                windows = list(tile_windows(src.width, src.height))
+
+            sinks = {t: FeatureSink(output_paths[t], output_wkt, {"dB_level": int},
+                                    driver=output_driver, batch_size=batch_size)
+                     for t in missing}
+            try:
+                with span("vectorize.tif", tif=tif_name, tiles=len(windows)):
+                    for layers in stream_tiles(executor, tif_path, windows, thresholds, workers):
+                        for threshold, wkb in layers.items():
+                            if threshold in sinks:
+                                sinks[threshold].add(wkb, dB_level=threshold)
+            except BaseException:
+                for sink in sinks.values():
+                    sink.discard()
+                raise
 
-                # 掩模：选择大于等于阈值的像素
-                mask = (noise_data >= threshold)
-                
-                if not np.any(mask):
+            for threshold in missing:
+                with span("vectorize.close", tif=tif_name, threshold=threshold):
+                    written = sinks[threshold].close()
+                if written:
+                    if stitch_tiles:
+                        stitch_layer(output_paths[threshold], output_wkt, threshold)
+                    print(f"  ✅ 已生成: {threshold}dB 矢量文件")
+                else:
                     print(f"  ⚠  {threshold}dB 下无数据。")
-                    continue
-
-                # 1. 栅格转矢量 (基于 3857)
-                results = (
-                    {'properties': {'dB_level': threshold}, 'geometry': s}
-                    for s, v in shapes(noise_data, mask=mask, transform=src.transform)
-                )
-                
-                # 2. 创建 GeoDataFrame
-                gdf_3857 = gpd.GeoDataFrame.from_features(list(results), crs=src.crs)
-                
-                # 3. 融合并重投影至 4326
-                # 注意：dissolve 可以极大简化多边形数量，避免后续计算过慢
-                gdf_4326 = gdf_3857.dissolve(by='dB_level').to_crs("EPSG:4326")
-                
-                # 4. 保存为 Shapefile
-                # Shapefile 不支持长字段名，dB_level 会被缩写，但没关系
-                gdf_4326.to_file(output_shp_path, driver='ESRI Shapefile', encoding='utf-8')
-                print(f"  ✅ 已生成: {threshold}dB 矢量文件")
 
 # === 配置参数 ===
 input_folder = r"F:\机场噪音"
 output_root = r"F:\机场噪音\Vector_Results" # 建议输出到独立文件夹
 noise_thresholds = [40, 45, 50, 55, 60, 65, 70]
 
-process_all_noise_tifs(input_folder, output_root, noise_thresholds)
-print("\n🎉 第一步：所有噪音矢量化处理完成！")
\ No newline at end of file
+if __name__ == "__main__":
+    with span("vectorize"):
+        process_all_noise_tifs(input_folder, output_root, noise_thresholds)
+    print("\n🎉 第一步：所有噪音矢量化处理完成！")
@@ -1,95 +1,208 @@
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import re
 import os
 from tqdm import tqdm
 from shapely.prepared import prep
+from multiprocessing import shared_memory
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from vector_sink import is_vector_file, write_gdf
+from boundary_cache import load_boundaries
+from profiling import span
 
-# 1. 修改任务函数：在子进程内部进行 prep
-def check_and_intersect(row_tuple, noise_geom_raw):
+'''
+县级边界 × 噪声面 叠加
+    ✅ 整个运行只建一个进程池；县级边界在进程启动时下发一次（WKB），任务只传县的行号
+    ✅ 每个噪声面合并后只序列化一次：以 WKB 写入共享内存，任务只传共享内存名称
+    ✅ 每个进程对同一个噪声面只解析、prep 一次，之后的任务直接复用
+    ✅ 县按块分发（chunk_size 个一批），减少任务调度开销
+    ✅ 同一噪声组内阈值自低向高处理：噪声面逐级嵌套（70 dB ⊂ 65 dB ⊂ ... ⊂ 40 dB），
+       高阈值只检查上一级有相交结果的县，并与该县上一级的相交面求交，而不是与整个县求交
+'''
+
+chunk_size = 32   # 每个任务处理的县数
+
+# ======== 进程池：县级边界每个进程一份，噪声面按共享内存名称缓存 ========
+_worker = {}
+
+
+def _init_worker(county_wkbs):
+    _worker["counties"] = shapely.from_wkb(county_wkbs)
+
+
+def _worker_noise(shm_name, size):
+    """读取共享内存中的噪声面 WKB，解析并 prep；同一噪声面在该进程内只做一次"""
+    if _worker.get("shm_name") != shm_name:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            wkb = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+        noise_geom = shapely.from_wkb(wkb)
+        _worker["noise"] = noise_geom
+        _worker["prepared"] = prep(noise_geom)
+        _worker["shm_name"] = shm_name
+    return _worker["noise"], _worker["prepared"]
+
+
+def polygon_part(geom):
+    """相交结果中的面：GeometryCollection 只保留其中的 Polygon / MultiPolygon 并合并；没有面时返回 None"""
+    if geom.is_empty:
+        return None
+    if geom.geom_type in ('Polygon', 'MultiPolygon'):
+        return geom
+    if geom.geom_type != 'GeometryCollection':
+        return None
+    parts = shapely.get_parts(geom)
+    parts = parts[np.isin(shapely.get_type_id(parts), [3, 6])]   # 3: Polygon, 6: MultiPolygon
+    return shapely.union_all(parts) if len(parts) else None
+
+
+def check_and_intersect(items, shm_name, size):
     """
-    row_tuple: (Index, GID_2, NAME_1, NAME_2, geometry)
+    items: 一批 (县在县级边界表中的行号, 上一级阈值的相交面 WKB 或 None)；None 时与整个县求交
+    返回 [(行号, 相交面 WKB), ...]，只包含相交结果含面的县（GeometryCollection 只保留面部分）
     """
-    county_geom = row_tuple[4]
-    
-    # 在子进程中创建 Prepared Geometry
-    # 这样可以绕过序列化问题，且每个子进程只需 prep 一次噪声面
-    prepared_noise = prep(noise_geom_raw)
-    
-    if prepared_noise.intersects(county_geom):
-        inter_geom = county_geom.intersection(noise_geom_raw)
-        
-        if not inter_geom.is_empty and inter_geom.geom_type in ['Polygon', 'MultiPolygon']:
-            return {
-                "GID_2": row_tuple[1],
-                "NAME_1": row_tuple[2],
-                "NAME_2": row_tuple[3],
-                "geometry": inter_geom
-            }
-    return None
+    with span("overlay.chunk", counties=len(items)):
+        noise_geom, prepared_noise = _worker_noise(shm_name, size)
+        counties = _worker["counties"]
+
+        results = []
+        for pos, previous_wkb in items:
+            county_geom = counties[pos] if previous_wkb is None else shapely.from_wkb(previous_wkb)
+            if prepared_noise.intersects(county_geom):
+                inter_geom = polygon_part(county_geom.intersection(noise_geom))
+
+                if inter_geom is not None:
+                    results.append((pos, shapely.to_wkb(inter_geom)))
+        return results
+
+
+def publish_geometry(geom):
+    """将几何体以 WKB 写入共享内存，返回 (SharedMemory, 字节数)；用完后由调用方 close + unlink"""
+    wkb = shapely.to_wkb(geom)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(wkb)))
+    shm.buf[:len(wkb)] = wkb
+    return shm, len(wkb)
+
+
+def threshold_of(noise_file):
+    match = re.search(r'(\d+)dB', noise_file)
+    return int(match.group(1)) if match else None
+
+
+def load_intersections(path, gid_index, crs):
+    """读取已有的相交结果，返回 {县行号: 相交面 WKB}"""
+    gdf = gpd.read_file(path, engine="pyogrio")
+    if gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    positions = gid_index.get_indexer(gdf['GID_2'])
+    keep = positions >= 0
+    return dict(zip(positions[keep].tolist(), shapely.to_wkb(gdf.geometry.values[keep])))
+
 
 def step2_overlay_parallel(vector_root, counties_shp_path, output_overlay_root, max_workers=None):
     print("正在加载美国县级边界数据...")
-    counties_gdf = gpd.read_file(counties_shp_path, engine="pyogrio").to_crs("EPSG:4326")
-    counties_gdf = counties_gdf[['GID_2', 'NAME_1', 'NAME_2', 'geometry']]
-    counties_sindex = counties_gdf.sindex
-    usa_total_bounds = counties_gdf.total_bounds 
+    counties = load_boundaries(counties_shp_path, "EPSG:4326", columns=['GID_2', 'NAME_1', 'NAME_2'])
+    counties_gdf = counties.gdf.reset_index(drop=True)
+    counties_sindex = counties.sindex
+    county_wkbs = shapely.to_wkb(counties_gdf.geometry.values)
+    gid_index = pd.Index(counties_gdf['GID_2'])
 
     sub_folders = [f for f in os.listdir(vector_root) if os.path.isdir(os.path.join(vector_root, f))]
 
-    for folder in sub_folders:
-        print(f"\n处理噪音组: {folder}")
-        input_dir = os.path.join(vector_root, folder)
-        output_dir = os.path.join(output_overlay_root, folder)
-        os.makedirs(output_dir, exist_ok=True)
-
-        noise_shps = [f for f in os.listdir(input_dir) if f.endswith('.shp')]
-
-        for noise_file in tqdm(noise_shps, desc="Overall Progress"):
-            output_path = os.path.join(output_dir, f"intersected_{noise_file}")
-            if os.path.exists(output_path): continue
-
-            try:
-                # 读取并获取单一几何体
-                noise_gdf = gpd.read_file(os.path.join(input_dir, noise_file), engine="pyogrio")
-                if noise_gdf.crs != counties_gdf.crs:
-                    noise_gdf = noise_gdf.to_crs(counties_gdf.crs)
-                
-                # 合并几何体，只传原始 geom 给子进程
-                noise_geom_raw = noise_gdf.geometry.unary_union
-                if noise_geom_raw.is_empty: continue
-
-                # 空间索引筛选
-                minx, miny, maxx, maxy = noise_geom_raw.bounds
-                possible_idx = list(counties_sindex.intersection((minx, miny, maxx, maxy)))
-                if not possible_idx: continue
-                
-                relevant_counties = counties_gdf.iloc[possible_idx]
-                
-                # 转换为元组列表
-                tasks = list(relevant_counties.itertuples(index=True, name=None))
-                
-                results = []
-                # 4. 并行计算
-                with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                    # 关键修改：只传递原始的 noise_geom_raw
-                    futures = [executor.submit(check_and_intersect, task, noise_geom_raw) for task in tasks]
-                    
-                    for future in tqdm(as_completed(futures), total=len(futures), desc=f"  Parallel -> {noise_file[-15:]}", leave=False):
-                        res = future.result()
-                        if res:
-                            results.append(res)
-                
-                if results:
-                    intersected_gdf = gpd.GeoDataFrame(results, crs=counties_gdf.crs)
-                    intersected_gdf.to_file(output_path, engine="pyogrio")
-                    
-            except Exception as e:
-                print(f"  ❌ 出错 {noise_file}: {e}")
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(county_wkbs,)) as executor:
+        for folder in sub_folders:
+            print(f"\n处理噪音组: {folder}")
+            input_dir = os.path.join(vector_root, folder)
+            output_dir = os.path.join(output_overlay_root, folder)
+            os.makedirs(output_dir, exist_ok=True)
+
+            # 有阈值的文件按阈值升序排在前面，无法解析阈值的文件单独处理（不剪枝）
+            noise_shps = sorted((f for f in os.listdir(input_dir) if is_vector_file(f)),
+                                key=lambda f: (threshold_of(f) is None, threshold_of(f) or 0, f))
+
+            # 上一级阈值的相交结果 {县行号: 相交面 WKB}；None 表示没有可用的上一级（需检查全部候选县）
+            previous = None
+            previous_path = None
+            for noise_file in tqdm(noise_shps, desc="Overall Progress"):
+                output_path = os.path.join(output_dir, f"intersected_{noise_file}")
+                nested = threshold_of(noise_file) is not None
+                if os.path.exists(output_path):
+                    # 已完成的级别：结果等到下一级需要时再从文件读取
+                    previous, previous_path = None, (output_path if nested else None)
+                    continue
+                if not nested:
+                    previous = previous_path = None
+                elif previous is None and previous_path is not None:
+                    previous = load_intersections(previous_path, gid_index, counties_gdf.crs)
+
+                try:
+                    # 读取并获取单一几何体
+                    noise_gdf = gpd.read_file(os.path.join(input_dir, noise_file), engine="pyogrio")
+                    if noise_gdf.crs != counties_gdf.crs:
+                        noise_gdf = noise_gdf.to_crs(counties_gdf.crs)
+
+                    noise_geom_raw = noise_gdf.geometry.unary_union
+                    level_results = {}
+                    if noise_geom_raw.is_empty:
+                        previous, previous_path = level_results, None
+                        continue
+
+                    # 空间索引筛选；有上一级结果时只保留上一级有相交面的县
+                    possible_idx = counties_sindex.query(noise_geom_raw)
+                    if previous is not None:
+                        possible_idx = np.intersect1d(possible_idx, np.fromiter(previous, dtype=np.int64))
+                    if len(possible_idx) == 0:
+                        previous, previous_path = level_results, None
+                        continue
+                    items = [(pos, None if previous is None else previous[pos]) for pos in possible_idx.tolist()]
+
+                    # 噪声面只序列化一次，进程通过共享内存读取
+                    shm, size = publish_geometry(noise_geom_raw)
+                    try:
+                        with span("overlay.noise_file", folder=folder, file=noise_file,
+                                  candidates=len(items), pruned=previous is not None):
+                            chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+                            futures = [executor.submit(check_and_intersect, chunk, shm.name, size)
+                                       for chunk in chunks]
+
+                            results = []
+                            for future in tqdm(as_completed(futures), total=len(futures),
+                                               desc=f"  Parallel -> {noise_file[-15:]}", leave=False):
+                                results.extend(future.result())
+                    finally:
+                        shm.close()
+                        shm.unlink()
+
+                    level_results = dict(results)
+                    if nested:
+                        previous, previous_path = level_results, None
+
+                    if results:
+                        results.sort()
+                        positions = [pos for pos, _ in results]
+                        intersected_gdf = gpd.GeoDataFrame(
+                            counties_gdf.loc[positions, ['GID_2', 'NAME_1', 'NAME_2']].reset_index(drop=True),
+                            geometry=shapely.from_wkb(np.array([wkb for _, wkb in results], dtype=object)),
+                            crs=counties_gdf.crs,
+                        )
+                        # 先写 *.partial.<ext> 再改名：中断不会留下被当作已完成而跳过的残缺文件
+                        write_gdf(intersected_gdf, output_path)
+
+                except Exception as e:
+                    print(f"  ❌ 出错 {noise_file}: {e}")
+                    # 该级别结果不可用，下一级退回检查全部候选县
+                    previous = previous_path = None
 
 if __name__ == "__main__":
     vector_results_root = r"F:\机场噪音\Vector_Results"
     counties_shp = r"USA\gadm41_USA_2.shp"
     overlay_output = r"F:\机场噪音\County_Noise_Masks\美国"
-    
+
     # 建议设置比最大核心数稍微少一点，防止系统卡死
-    step2_overlay_parallel(vector_results_root, counties_shp, overlay_output, max_workers=None)
\ No newline at end of file
+    with span("overlay"):
+        step2_overlay_parallel(vector_results_root, counties_shp, overlay_output, max_workers=None)
@@ -1,31 +1,191 @@
 import os
+import json
 import pandas as pd
 import geopandas as gpd
 from rasterstats import zonal_stats
 from tqdm import tqdm
 import re
+import numpy as np
 import rasterio
+from label_zonal import grid_key, vector_key, get_label_raster, stream_zonal_sums
+from mask_index import get_pixel_index, get_grid_pixel_index, gather_zonal_sums, gather_stack_sums
+from result_store import build_frame, write_results
+from coverage_weights import get_coverage_matrix, stack_matrices, coverage_sums, coverage_triplets
+from vector_sink import is_vector_file
+from boundary_cache import load_boundaries
+from profiling import span
 
-def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, output_root):
+ledger_name = "_mask_done.jsonl"   # 已完成掩膜的记录（位于 output_root 下），中断后重跑跳过
+
+
+def load_ledger(path):
+    """读取已完成的 (噪声组, 掩膜文件, 输出格式)"""
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    done.add((record["folder"], record["mask"], record["format"]))
+    return done
+
+
+def append_ledger(path, record):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def stack_mask_sums(mask_dir, mask_files, population_root, pop_files, mask_cache_dir, boundary_rule="coverage"):
+    """
+    多栅格统计：一个噪声组的所有掩膜（各阈值）的成员像元拼成一个索引，
+    所有性别 × 年龄人口文件视为一个波段栈，每个窗口在每个文件上只读一次。
+    boundary_rule="coverage" 时各掩膜的覆盖权重矩阵按行拼接，所有文件一次稀疏矩阵乘。
+    返回 {掩膜文件: {人口文件: 长度为该掩膜行数的总和数组}}。
+    """
+    # 人口文件按格网分组（同一年份通常只有一组）
+    grids = {}
+    for pop_tif_name in pop_files:
+        pop_tif_path = os.path.join(population_root, pop_tif_name)
+        with rasterio.open(pop_tif_path) as src:
+            pop_nodata = src.nodata if src.nodata is not None else -99999
+            grids.setdefault(grid_key(src), []).append((pop_tif_name, pop_tif_path, pop_nodata))
+
+    masks = []
+    for mask_file in mask_files:
+        mask_gdf = gpd.read_file(os.path.join(mask_dir, mask_file))
+        if not mask_gdf.empty:
+            masks.append((mask_file, mask_gdf, vector_key(mask_gdf)))
+
+    results = {mask_file: {} for mask_file, _, _ in masks}
+    for members in grids.values():
+        names, paths, nodatas = zip(*members)
+        if not masks:
+            continue
+        spans = []
+        offset = 0
+        for mask_file, mask_gdf, _ in masks:
+            spans.append((mask_file, offset, offset + len(mask_gdf)))
+            offset += len(mask_gdf)
+
+        if boundary_rule == "coverage":
+            with rasterio.open(paths[0]) as src:
+                parts = [get_coverage_matrix(mask_gdf, src, mask_cache_dir, vec_key=mask_key)
+                         for _, mask_gdf, mask_key in masks]
+            matrix, pixels = stack_matrices(parts)
+            sums = coverage_sums(matrix, pixels, paths, nodata=nodatas)
+        else:
+            zones, pixels = [], []
+            for (_, mask_gdf, mask_key), (_, start, _) in zip(masks, spans):
+                z, px = get_pixel_index(mask_gdf, paths[0], mask_cache_dir, vec_key=mask_key)
+                zones.append(z.astype("int64") + start)
+                pixels.append(px)
+            sums = gather_stack_sums(np.concatenate(zones), np.concatenate(pixels), paths, offset, nodata=nodatas)
+        for mask_file, start, stop in spans:
+            for b, name in enumerate(names):
+                results[mask_file][name] = sums[b, start:stop]
+    return results
+
+
+def cube_mask_sums(mask_dir, mask_files, population_cube, year, pop_files, mask_cache_dir, boundary_rule="coverage"):
+    """
+    立方体版本的 stack_mask_sums：一个噪声组的所有掩膜拼成一个索引，对立方体中该年份做一次分块扫描。
+    返回 {掩膜文件: {人口文件: 长度为该掩膜行数的总和数组}}，只包含立方体中有对应 (性别, 年龄) 的人口文件。
+    """
+    from pop_datacube import open_cube, CubeGrid, cube_zonal_sums, parse_band
+
+    cube = open_cube(population_cube)
+    attrs = cube.attrs.asdict()
+    grid = CubeGrid(attrs)
+
+    zones, pixels, parts, spans = [], [], [], []
+    offset = 0
+    for mask_file in mask_files:
+        mask_gdf = gpd.read_file(os.path.join(mask_dir, mask_file))
+        if mask_gdf.empty:
+            continue
+        if boundary_rule == "coverage":
+            parts.append(get_coverage_matrix(mask_gdf, grid, mask_cache_dir, vec_key=vector_key(mask_gdf)))
+        else:
+            z, px = get_grid_pixel_index(mask_gdf, grid, mask_cache_dir, vec_key=vector_key(mask_gdf))
+            zones.append(z.astype("int64") + offset)
+            pixels.append(px)
+        spans.append((mask_file, offset, offset + len(mask_gdf)))
+        offset += len(mask_gdf)
+    if not spans:
+        return {}
+
+    if boundary_rule == "coverage":
+        zones, pixels, weights = coverage_triplets(*stack_matrices(parts))
+        _, sums = cube_zonal_sums(cube, zones, pixels, offset, years=[year], weights=weights)
+    else:
+        _, sums = cube_zonal_sums(cube, np.concatenate(zones), np.concatenate(pixels), offset, years=[year])
+    results = {mask_file: {} for mask_file, _, _ in spans}
+    for pop_tif_name in pop_files:
+        parsed = parse_band(pop_tif_name)
+        if parsed is None or parsed[0] not in attrs["genders"] or parsed[1] not in attrs["ages"]:
+            continue
+        g, a = attrs["genders"].index(parsed[0]), attrs["ages"].index(parsed[1])
+        for mask_file, start, stop in spans:
+            results[mask_file][pop_tif_name] = sums[0, g, a, start:stop]
+    return results
+
+
+def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, output_root,
+                         stream_max_memory_mb=None, stream_workers=4, label_cache_dir=r"./cache/labels",
+                         output_format="parquet", mask_cache_dir=r"./cache/masks", stack_bands=True,
+                         population_cube=None, boundary_rule="coverage"):
+    """
+    默认 boundary_rule="coverage" 按覆盖比例加权，结果与原先的像元中心规则（基准运行）不同；
+    下面 stream_max_memory_mb / mask_cache_dir / stack_bands 的说明只适用于 boundary_rule="center"。
+    stream_max_memory_mb: 设置后改用流式标签栅格统计（按栅格分块读取，峰值内存不超过该值 MB），
+    结果与 zonal_stats(all_touched=False) 一致。
+    mask_cache_dir: stream_max_memory_mb 为 None 时，每个掩膜只栅格化一次为稀疏像元索引并缓存于此，
+    所有人口文件的总和都由该索引直接取值得到（与 zonal_stats(all_touched=False) 一致）；
+    设为 None 时沿用逐文件 zonal_stats（coverage 规则下必须设置，用于缓存覆盖权重矩阵）。
+    stack_bands: 使用掩膜索引时，把一个噪声组的全部掩膜与全部性别 × 年龄文件合并为一次多栅格统计，
+    每个窗口只读一次；False 时逐掩膜、逐人口文件统计。
+    population_cube: 多年份人口数据立方体路径（见 pop_datacube.py）；使用掩膜索引且该年份已入库时，
+    从立方体分块读取全部性别 × 年龄的值，不再逐个打开人口文件（人口文件仍用于确定性别 × 年龄组合）。
+    output_format: "parquet" 写入 output_root/store 列式结果库（按 Year/Day/Noise_Threshold/Gender/Age 分区）；
+    "csv" 每个掩膜输出一个 Stats_*.csv（原方式）。
+    boundary_rule: "coverage"（默认，与 pop_stats / agesex_pop_stats 一致）按像元面积覆盖比例加权
+    （见 coverage_weights.py，权重矩阵缓存于 mask_cache_dir），总是走多栅格 / 立方体路径，
+    忽略 stack_bands 与 stream_max_memory_mb（矩阵乘按栅格分块读取）；
+    "center" 像元中心落入掩膜即全额计入（与 zonal_stats(all_touched=False) 一致）。
+    每个掩膜写出后记入 output_root 下的 ledger_name，中断后重跑跳过已完成的掩膜。
+    """
+    if boundary_rule == "coverage" and not mask_cache_dir:
+        raise ValueError("boundary_rule='coverage' 需要 mask_cache_dir 缓存覆盖权重矩阵")
     # 1. 加载完整市级名录 (基准)
     print("正在加载完整市级名录...")
-    counties_gdf = gpd.read_file(counties_shp_path)
+    counties_gdf = load_boundaries(counties_shp_path, columns=['GID_2', 'NAME_1', 'NAME_2']).gdf
     base_info = counties_gdf[['GID_2', 'NAME_1', 'NAME_2']].copy()
+    gid_index = pd.Index(base_info['GID_2'])
     
     pop_files = [f for f in os.listdir(population_root) if f.endswith('.tif')]
+    os.makedirs(output_root, exist_ok=True)
+    ledger_path = os.path.join(output_root, ledger_name)
+    done = load_ledger(ledger_path)
     noise_folders = [f for f in os.listdir(overlay_root) if os.path.isdir(os.path.join(overlay_root, f))]
 
     for folder in noise_folders:
         noise_year_match = re.search(r'20\d{2}', folder)
         if not noise_year_match: continue
         noise_year = noise_year_match.group()
+        day_match = re.search(r'SEL_([A-Za-z]+)_', folder)
+        day = day_match.group(1) if day_match else folder
         
         print(f"\n🚀 正在处理噪声组: {folder}")
         year_output_dir = os.path.join(output_root, noise_year)
         os.makedirs(year_output_dir, exist_ok=True)
 
         mask_dir = os.path.join(overlay_root, folder)
-        mask_files = [f for f in os.listdir(mask_dir) if f.endswith(".shp")]
+        mask_files = [f for f in os.listdir(mask_dir) if is_vector_file(f)
+                      and (folder, f, output_format) not in done]
+        if not mask_files:
+            print("  ✓ 全部掩膜已完成")
+            continue
         
         # 预筛选该年份的人口文件
         current_pop_files = [f for f in pop_files if f"_{noise_year}_" in f]
@@ -38,6 +198,23 @@ def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, outpu
             if pm: pop_dims.append((pm.group(2), pm.group(3)))
         unique_pop_dims = pd.DataFrame(pop_dims, columns=['Gender', 'Age_Group']).drop_duplicates()
 
+        stacked = {}
+        coverage = boundary_rule == "coverage"
+        cube_ready = False
+        if population_cube and mask_cache_dir and (coverage or not stream_max_memory_mb):
+            from pop_datacube import open_cube, cube_years
+            cube_ready = int(noise_year) in cube_years(open_cube(population_cube))
+        if cube_ready:
+            print(f"  -> 立方体统计: {len(mask_files)} 个掩膜 × {len(current_pop_files)} 个人口波段")
+            with span("mask_stats.cube", folder=folder, masks=len(mask_files), bands=len(current_pop_files)):
+                stacked = cube_mask_sums(mask_dir, mask_files, population_cube, noise_year,
+                                         current_pop_files, mask_cache_dir, boundary_rule=boundary_rule)
+        elif mask_cache_dir and (coverage or (stack_bands and not stream_max_memory_mb)):
+            print(f"  -> 多栅格统计: {len(mask_files)} 个掩膜 × {len(current_pop_files)} 个人口文件")
+            with span("mask_stats.stack", folder=folder, masks=len(mask_files), bands=len(current_pop_files)):
+                stacked = stack_mask_sums(mask_dir, mask_files, population_root, current_pop_files, mask_cache_dir,
+                                          boundary_rule=boundary_rule)
+
         # 遍历每个掩膜文件 (例如: 40dB.shp, 45dB.shp)
         for mask_file in mask_files:
             threshold_match = re.search(r'(\d+)dB', mask_file)
@@ -45,6 +222,9 @@ def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, outpu
             
             mask_path = os.path.join(mask_dir, mask_file)
             mask_gdf = gpd.read_file(mask_path)
+            needs_key = (stream_max_memory_mb or mask_cache_dir) and mask_file not in stacked
+            mask_key = vector_key(mask_gdf) if needs_key and not mask_gdf.empty else None
+            mask_indexes = {}   # 格网 -> (zones, pixels)，同一年份的人口文件通常共用一个格网
             
             # --- 核心逻辑：为当前这个阈值构建全县 x 全性别年龄的底表 ---
             # 这里的 grid 只包含当前这一个 Threshold
@@ -52,6 +232,9 @@ def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, outpu
             grid['Threshold'] = threshold
             
             actual_records = []
+            # 列式输出：每个人口文件一行全县数组（未受影响的县为 0）
+            mask_pos = gid_index.get_indexer(mask_gdf['GID_2'])
+            group_values, group_genders, group_ages = [], [], []
 
             print(f"  -> 统计掩膜: {mask_file} (对应人口文件: {len(current_pop_files)}个)")
             
@@ -64,31 +247,90 @@ def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, outpu
                 # 获取 nodata 并统计
                 with rasterio.open(pop_tif_path) as src:
                     pop_nodata = src.nodata if src.nodata is not None else -99999
+                    pop_grid = grid_key(src)
 
                 if not mask_gdf.empty:
-                    stats = zonal_stats(
-                        mask_gdf, 
-                        pop_tif_path, 
-                        stats="sum", 
-                        all_touched=False,
-                        nodata=pop_nodata
-                    )
+                    with span("mask_stats.file", folder=folder, threshold=threshold, band=pop_tif_name):
+                        if pop_tif_name in stacked.get(mask_file, {}):
+                            sums = stacked[mask_file][pop_tif_name]
+                        elif stream_max_memory_mb:
+                            label_path = get_label_raster(mask_gdf, pop_tif_path, label_cache_dir, vec_key=mask_key)
+                            sums = stream_zonal_sums(
+                                label_path,
+                                pop_tif_path,
+                                len(mask_gdf),
+                                nodata=pop_nodata,
+                                max_memory_mb=stream_max_memory_mb,
+                                workers=stream_workers
+                            )
+                        elif mask_cache_dir:
+                            if pop_grid not in mask_indexes:
+                                mask_indexes[pop_grid] = get_pixel_index(mask_gdf, pop_tif_path, mask_cache_dir,
+                                                                         vec_key=mask_key)
+                            zones, pixels = mask_indexes[pop_grid]
+                            sums = gather_zonal_sums(zones, pixels, pop_tif_path, len(mask_gdf), nodata=pop_nodata)
+                        else:
+                            stats = zonal_stats(
+                                mask_gdf, 
+                                pop_tif_path, 
+                                stats="sum", 
+                                all_touched=False,
+                                nodata=pop_nodata
+                            )
+                            sums = [s['sum'] for s in stats]
                     
+                    # rasterstats 中无像元的要素为 None -> NaN -> 0
+                    mask_values = np.nan_to_num(np.asarray(sums, dtype="float64"))
+                    if output_format == "parquet":
+                        county_values = np.zeros(len(base_info), dtype="float64")
+                        keep = (mask_pos >= 0) & (mask_values > 0)
+                        np.add.at(county_values, mask_pos[keep], mask_values[keep])
+                        group_values.append(county_values)
+                        group_genders.append(gender)
+                        group_ages.append(age)
+                        continue
+
                     # 收集该人口文件下有值的县
-                    for i in range(len(mask_gdf)):
-                        pop_sum = stats[i]['sum']
-                        if pop_sum and pop_sum > 0:
-                            actual_records.append({
-                                'GID_2': mask_gdf.iloc[i]['GID_2'],
-                                'Gender': gender,
-                                'Age_Group': age,
-                                'Affected_Pop': pop_sum
-                            })
+                    keep = mask_values > 0
+                    actual_records.append(pd.DataFrame({
+                        'GID_2': mask_gdf['GID_2'].to_numpy()[keep],
+                        'Gender': gender,
+                        'Age_Group': age,
+                        'Affected_Pop': mask_values[keep]
+                    }))
+                elif output_format == "parquet":
+                    # 空掩膜（该阈值无暴露）也写入全 0 结果，与 CSV 的全量底表一致，
+                    # 结果库中可区分"0 人受影响"与"未统计"
+                    group_values.append(np.zeros(len(base_info), dtype="float64"))
+                    group_genders.append(gender)
+                    group_ages.append(age)
+
+            clean_mask_name = os.path.splitext(mask_file)[0]
+
+            if output_format == "parquet":
+                if not threshold.isdigit():
+                    print(f"  ⚠  无法从文件名解析阈值，跳过写入: {mask_file}")
+                    continue
+                if group_values:
+                    df = build_frame(
+                        base_info,
+                        np.vstack(group_values),
+                        "Affected_Pop",
+                        Year=int(noise_year),
+                        Day=day,
+                        Noise_Threshold=int(threshold),
+                        Gender=group_genders,
+                        Age=group_ages,
+                    )
+                    with span("mask_stats.write", folder=folder, threshold=threshold):
+                        write_results(df, os.path.join(output_root, "store"), clean_mask_name)
+                append_ledger(ledger_path, {"folder": folder, "mask": mask_file, "format": output_format})
+                continue
 
             # --- 每一个掩膜文件合并一次并输出 ---
             if not grid.empty:
                 if actual_records:
-                    affected_df = pd.DataFrame(actual_records)
+                    affected_df = pd.concat(actual_records, ignore_index=True)
                     # 合并统计结果到全量底表
                     final_df = grid.merge(
                         affected_df, 
@@ -102,16 +344,27 @@ def step3_per_mask_stats(overlay_root, population_root, counties_shp_path, outpu
                 final_df['Affected_Pop'] = final_df['Affected_Pop'].fillna(0)
                 
                 # 输出文件名：包含年份、组名和阈值
-                clean_mask_name = mask_file.replace('.shp', '')
                 output_csv = os.path.join(year_output_dir, f"Stats_{clean_mask_name}.csv")
                 
-                final_df.to_csv(output_csv, index=False, encoding="utf-8-sig")
+                final_df.to_csv(output_csv + ".partial", index=False, encoding="utf-8-sig")
+                os.replace(output_csv + ".partial", output_csv)
+            append_ledger(ledger_path, {"folder": folder, "mask": mask_file, "format": output_format})
 
 # 参数配置...
 overlay_root = r"F:\机场噪音\County_Noise_Masks\美国"
 population_root = r"F:\wordpop_USA\both\2023\fm"
 counties_shp = r"USA\gadm41_USA_2.shp"
 output_csv_root = r"F:\机场噪音\Final_Consolidated_Results\美国"
+stream_max_memory_mb = None  # 例如 2048：全国 100m 栅格按块流式统计，避免内存溢出
+output_format = "parquet"    # "parquet"：列式分区结果库；"csv"：每个掩膜一个 Stats_*.csv
+# "coverage"（默认）：像元面积覆盖比例加权（与 pop_stats / agesex 一致）；"center"：像元中心规则（原方式）
+# ⚠ 默认的 coverage 输出与基准运行（像元中心规则）的数值不同：掩膜边界像元按面积比例计入，
+#   需要与旧结果逐项对比时改为 "center"
+boundary_rule = "coverage"
+population_cube = None       # 例如 r"./cube/worldpop_usa.zarr"：从多年份人口数据立方体读取（pop_datacube.py 入库）
 
 if __name__ == "__main__":
-    step3_per_mask_stats(overlay_root, population_root, counties_shp, output_csv_root)
\ No newline at end of file
+    with span("mask_stats"):
+        step3_per_mask_stats(overlay_root, population_root, counties_shp, output_csv_root,
+                             stream_max_memory_mb=stream_max_memory_mb, output_format=output_format,
+                             population_cube=population_cube, boundary_rule=boundary_rule)
\ No newline at end of file
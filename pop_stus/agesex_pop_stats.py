@@ -1,10 +1,13 @@
 import os
-import geopandas as gpd
-import pandas as pd
 from rasterstats import zonal_stats
 import rasterio
 import numpy as np
 from tqdm import tqdm
+from result_store import build_frame, write_results
+from exposure_cube import zone_pixel_index, threshold_cube_sums
+from coverage_weights import Grid, get_coverage_matrix, coverage_triplets
+from profiling import span
+from boundary_cache import load_boundaries, release_boundaries
 
 # ================= 配置 =================
 year = 2023
@@ -16,96 +19,282 @@ population_root = rf"F:\wordpop_USA\both\{year}\clip\usa"
 noise_root = rf"./noise/USA_tiles/{year}/{day}/noise_aligned"
 shapefile_folder = r"USA\split3857"
 output_root = rf"./noise/USA_tiles/{year}/{day}/results"
+# "parquet"：写入 store_root 下按 Year/Day/Noise_Threshold/Gender/Age 分区的列式结果库（所有年份/时段共用）
+# "csv"：每个区域一个 {region}_affected_population.csv（原方式）
+output_format = "parquet"
+store_root = r"./noise/USA_tiles/store"
+
+# "cube"：区域内所有性别 × 年龄波段叠成立方体，噪声分级一次，一次归约得到全部 (县, 性别, 年龄, 阈值)
+# "zonal_stats"：逐波段、逐阈值 np.where + zonal_stats（原方式）
+stats_engine = "cube"
+cube_max_memory_mb = 4096  # 单个立方体的内存上限，超过时按波段分批
+
+# cube 引擎的县界像元归属：
+# "coverage"：按像元面积覆盖比例加权（与 pop_stats / 步骤 3 的 coverage 规则一致，边界像元不重复计入），
+#             权重矩阵按 (县界, 格网) 缓存于 coverage_cache_folder
+# "all_touched"：与原 zonal_stats(all_touched=True) 相同，相邻县的边界像元在两边都计入
+boundary_rule = "coverage"
+coverage_cache_folder = r"./cache/coverage"
 
 genders = ["f", "m"]
-age_groups = [d for d in os.listdir(os.path.join(population_root, "f"))
-              if os.path.isdir(os.path.join(population_root, "f", d))]
 
-os.makedirs(output_root, exist_ok=True)
 
-# ================= 遍历区域 shapefile =================
-shp_files = [f for f in os.listdir(shapefile_folder) if f.endswith(".shp")]
+def region_bands(region_name, age_groups):
+    """该区域存在人口切片的 (性别, 年龄, 路径)，按 性别 -> 年龄 顺序"""
+    bands = []
+    for gender in genders:
+        for age in age_groups:
+            pop_path = os.path.join(population_root, gender, age, f"{region_name}_clip_3857.tif")
+            if os.path.exists(pop_path):
+                bands.append((gender, age, pop_path))
+    return bands
 
-for shp_file in tqdm(shp_files, desc="Processing regions"):
-    region_name = os.path.splitext(shp_file)[0]
-    shp_path = os.path.join(shapefile_folder, shp_file)
 
-    counties = gpd.read_file(shp_path)
+def export_affected(pop_src, pop_data, noise_data, region_name, gender, age, threshold):
+    """可选：输出受影响人口 TIFF"""
+    pop_nodata = pop_src.nodata if pop_src.nodata is not None else -9999
+    affected_pop_data = np.where(
+        (noise_data >= threshold) & (pop_data != pop_nodata),
+        pop_data,
+        0
+    ).astype(pop_data.dtype)
 
-    all_results = []
+    out_tif_folder = os.path.join(output_root, "tif", f"{threshold}dB")
+    os.makedirs(out_tif_folder, exist_ok=True)
+    out_tif_path = os.path.join(out_tif_folder,
+        f"{region_name}_{gender}_{age}_affected_{threshold}dB.tif")
 
-    # ================= 遍历（性别 × 年龄） =================
-    for gender in genders:
-        for age in age_groups:
+    meta = pop_src.meta.copy()
+    meta.update({"dtype": affected_pop_data.dtype, "nodata": 0})
+
+    with rasterio.open(out_tif_path, "w", **meta) as dst:
+        dst.write(affected_pop_data, 1)
+    return affected_pop_data
+
+
+class RegionContext:
+    """
+    单个区域内所有波段共用的上下文，区域结束（退出 with）时释放：
+        - 县界：从预投影边界缓存读取（boundary_cache.py），按目标 CRS 各读取一次
+        - 噪声：{region}_aligned.tif 只解码一次
+        - 县像元成员表：按人口切片格网 (CRS, transform, shape) 缓存，只栅格化一次
+          （coverage 规则下为覆盖权重矩阵，另按 (县界, 格网) 缓存在磁盘上）
+    """
+
+    def __init__(self, region_name, shp_path, noise_path):
+        self.region_name = region_name
+        self.noise_path = noise_path
+        self.shp_path = shp_path
+        self._source = load_boundaries(shp_path).gdf
+        self._projected = {}
+        self._noise = None
+        self._coverage = {}
 
-            pop_folder = os.path.join(population_root, gender, age)
-            pop_path = os.path.join(pop_folder, f"{region_name}_clip_3857.tif")
-            noise_path = os.path.join(noise_root, f"{region_name}_aligned.tif")
+    @property
+    def n_counties(self):
+        return len(self._source)
 
-            if not os.path.exists(pop_path) or not os.path.exists(noise_path):
+    def counties(self, crs=None):
+        """按 crs 投影后的县界（crs=None 时为原始投影）"""
+        if crs is None:
+            return self._source
+        key = str(crs)
+        if key not in self._projected:
+            self._projected[key] = (crs, load_boundaries(self.shp_path, crs).gdf)
+        return self._projected[key][1]
+
+    @property
+    def noise(self):
+        if self._noise is None:
+            with rasterio.open(self.noise_path) as noise_src:
+                self._noise = noise_src.read(1)
+        return self._noise
+
+    def coverage(self, crs, transform, shape):
+        """
+        (zones, pixels, weights) 县像元成员表：
+        boundary_rule 为 "all_touched" 时 weights 为 None，与原 zonal_stats 设置一致；
+        为 "coverage" 时 weights 为像元面积覆盖比例
+        """
+        key = (str(crs), tuple(transform)[:6], tuple(shape))
+        if key not in self._coverage:
+            if boundary_rule == "coverage":
+                grid = Grid(crs, transform, shape[1], shape[0])
+                matrix, pixels = get_coverage_matrix(self.counties(crs), grid, coverage_cache_folder)
+                self._coverage[key] = coverage_triplets(matrix, pixels)
+            else:
+                zones, pixels = zone_pixel_index(self.counties(crs), transform, shape, all_touched=True)
+                self._coverage[key] = (zones, pixels, None)
+        return self._coverage[key]
+
+    def release(self):
+        release_boundaries(self.shp_path)
+        for crs, _ in self._projected.values():
+            release_boundaries(self.shp_path, crs)
+        self._projected.clear()
+        self._coverage.clear()
+        self._noise = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def region_stats_cube(ctx, bands):
+    """
+    返回 (counties, values, bands)，values 形状为 (n_bands, n_thresholds, n_counties)。
+    波段按切片格网分组：同组波段共用一份县像元成员表，每组按 cube_max_memory_mb 叠成立方体统计。
+    """
+    noise_data = ctx.noise
+
+    # 按格网分组；与原方式相同，与噪声尺寸不一致的切片无法逐像元对齐，跳过
+    groups = {}
+    for band in bands:
+        with rasterio.open(band[2]) as src:
+            if src.shape != noise_data.shape:
+                print(f"⚠ 格网与噪声不一致（跳过）: {band[2]}")
                 continue
+            nodata = src.nodata if src.nodata is not None else -9999
+            key = (str(src.crs), tuple(src.transform)[:6], src.shape, nodata, src.dtypes[0])
+            groups.setdefault(key, {"crs": src.crs, "transform": src.transform, "bands": []})
+            groups[key]["bands"].append(band)
 
-            with rasterio.open(pop_path) as pop_src, rasterio.open(noise_path) as noise_src:
+    usable = [band for group in groups.values() for band in group["bands"]]
+    if not usable:
+        return ctx.counties(), np.zeros((0, len(noise_thresholds), ctx.n_counties)), []
 
-                counties = counties.to_crs(pop_src.crs)
+    values = np.zeros((len(usable), len(noise_thresholds), ctx.n_counties), dtype="float64")
+    offset = 0
+    for (_, _, shape, pop_nodata, dtype), group in groups.items():
+        zones, pixels, weights = ctx.coverage(group["crs"], group["transform"], shape)
+        group_bands = group["bands"]
+        bands_per_cube = max(1, int(cube_max_memory_mb * 1024 ** 2) // (shape[0] * shape[1] * np.dtype(dtype).itemsize))
+
+        for b0 in range(0, len(group_bands), bands_per_cube):
+            chunk = group_bands[b0:b0 + bands_per_cube]
+            layers = []
+            for gender, age, pop_path in chunk:
+                with rasterio.open(pop_path) as pop_src:
+                    pop_data = pop_src.read(1)
+                    if export_affected_raster:
+                        for threshold in noise_thresholds:
+                            export_affected(pop_src, pop_data, noise_data, ctx.region_name, gender, age, threshold)
+                layers.append(pop_data)
 
-                pop_nodata = pop_src.nodata if pop_src.nodata is not None else -9999
-                noise_nodata = noise_src.nodata if noise_src.nodata is not None else -9999
+            cube = np.stack(layers)
+            del layers
+            values[offset + b0:offset + b0 + len(chunk)] = threshold_cube_sums(
+                cube, noise_data, zones, pixels, ctx.n_counties, noise_thresholds, pop_nodata, weights=weights
+            )
+            del cube
+        offset += len(group_bands)
 
-                pop_data = pop_src.read(1)
-                noise_data = noise_src.read(1)
+    return ctx.counties(groups[next(iter(groups))]["crs"]), values, usable
 
-                # ================= 遍历阈值 =================
-                for threshold in noise_thresholds:
 
-                    # 直接生成 numpy 数组
+def region_stats_zonal(ctx, bands):
+    """原方式：逐波段、逐阈值 np.where + zonal_stats，返回格式同 region_stats_cube"""
+    values = []
+    noise_data = ctx.noise
+    for gender, age, pop_path in bands:
+        with rasterio.open(pop_path) as pop_src:
+
+            counties = ctx.counties(pop_src.crs)
+
+            pop_data = pop_src.read(1)
+
+            band_values = []
+            # ================= 遍历阈值 =================
+            for threshold in noise_thresholds:
+                if export_affected_raster:
+                    affected_pop_data = export_affected(pop_src, pop_data, noise_data,
+                                                        ctx.region_name, gender, age, threshold)
+                else:
+                    pop_nodata = pop_src.nodata if pop_src.nodata is not None else -9999
                     affected_pop_data = np.where(
                         (noise_data >= threshold) & (pop_data != pop_nodata),
                         pop_data,
                         0
                     ).astype(pop_data.dtype)
 
-                    # ===== 可选：输出受影响人口 TIFF =====
-                    if export_affected_raster:
-                        out_tif_folder = os.path.join(output_root, "tif", f"{threshold}dB")
-                        os.makedirs(out_tif_folder, exist_ok=True)
-                        out_tif_path = os.path.join(out_tif_folder,
-                            f"{region_name}_{gender}_{age}_affected_{threshold}dB.tif")
-
-                        meta = pop_src.meta.copy()
-                        meta.update({"dtype": affected_pop_data.dtype, "nodata": 0})
-
-                        with rasterio.open(out_tif_path, "w", **meta) as dst:
-                            dst.write(affected_pop_data, 1)
-
-                    # ===== 使用 zonal_stats（不需写 tif!!!）=====
-                    stats = zonal_stats(
-                        vectors=counties,
-                        raster=affected_pop_data,         # 直接塞 ndarray
-                        affine=pop_src.transform,         # 提供 transform
-                        nodata=0,
-                        stats=["sum"],
-                        all_touched=True
-                    )
-
-                    # 整理结果
-                    for idx, row in counties.iterrows():
-                        all_results.append({
-                            "GID_2": row["GID_2"],
-                            "Province": row["NAME_1"],
-                            "City": row["NAME_2"],
-                            "Gender": gender,
-                            "Age": age,
-                            "Noise_Threshold": threshold,
-                            "Affected_Pop": int(stats[idx]["sum"] or 0)
-                        })
-
-    # ================= 输出当前 region 的 csv =================
-    if all_results:
-        df = pd.DataFrame(all_results)
-        os.makedirs(os.path.join(output_root, "csv"), exist_ok=True)
-        df.to_csv(
-            os.path.join(output_root, "csv", f"{region_name}_affected_population.csv"),
-            index=False,
-            encoding="utf-8-sig"
-        )
+                # ===== 使用 zonal_stats（不需写 tif!!!）=====
+                stats = zonal_stats(
+                    vectors=counties,
+                    raster=affected_pop_data,         # 直接塞 ndarray
+                    affine=pop_src.transform,         # 提供 transform
+                    nodata=0,
+                    stats=["sum"],
+                    all_touched=True
+                )
+                band_values.append([s["sum"] or 0 for s in stats])
+            values.append(band_values)
+
+    return counties, np.array(values, dtype="float64").reshape(len(bands), len(noise_thresholds), -1), bands
+
+
+def save_region(region_name, counties, values, bands):
+    # 每个 (性别, 年龄, 阈值) 组合一行各县结果，顺序为 性别 -> 年龄 -> 阈值
+    n_thresholds = len(noise_thresholds)
+    df = build_frame(
+        counties,
+        values.reshape(-1, len(counties)).astype("int64"),  # 与原先 int(sum) 一样截断取整
+        "Affected_Pop",
+        Year=year,
+        Day=day,
+        Noise_Threshold=np.tile(noise_thresholds, len(bands)),
+        Gender=np.repeat([b[0] for b in bands], n_thresholds),
+        Age=np.repeat([b[1] for b in bands], n_thresholds),
+    )
+
+    if output_format == "parquet":
+        write_results(df, store_root, region_name)
+        return
+
+    df = df.rename(columns={"NAME_1": "Province", "NAME_2": "City"})[
+        ["GID_2", "Province", "City", "Gender", "Age", "Noise_Threshold", "Affected_Pop"]
+    ]
+    os.makedirs(os.path.join(output_root, "csv"), exist_ok=True)
+    df.to_csv(
+        os.path.join(output_root, "csv", f"{region_name}_affected_population.csv"),
+        index=False,
+        encoding="utf-8-sig"
+    )
+
+
+def main():
+    age_groups = [d for d in os.listdir(os.path.join(population_root, "f"))
+                  if os.path.isdir(os.path.join(population_root, "f", d))]
+
+    os.makedirs(output_root, exist_ok=True)
+
+    # ================= 遍历区域 shapefile =================
+    shp_files = [f for f in os.listdir(shapefile_folder) if f.endswith(".shp")]
+
+    for shp_file in tqdm(shp_files, desc="Processing regions"):
+        region_name = os.path.splitext(shp_file)[0]
+        shp_path = os.path.join(shapefile_folder, shp_file)
+        noise_path = os.path.join(noise_root, f"{region_name}_aligned.tif")
+
+        bands = region_bands(region_name, age_groups)
+        if not bands or not os.path.exists(noise_path):
+            continue
+
+        # ================= 统计（性别 × 年龄 × 阈值），区域上下文在区域结束时释放 =================
+        with RegionContext(region_name, shp_path, noise_path) as ctx, \
+                span(f"agesex_pop_stats.{stats_engine}", region=region_name, bands=len(bands)):
+            if stats_engine == "cube":
+                counties, values, bands = region_stats_cube(ctx, bands)
+            else:
+                counties, values, bands = region_stats_zonal(ctx, bands)
+
+        # ================= 输出当前 region 的结果 =================
+        if bands:
+            with span("agesex_pop_stats.save", region=region_name):
+                save_region(region_name, counties, values, bands)
+
+
+if __name__ == "__main__":
+    with span("agesex_pop_stats", year=year, day=day):
+        main()
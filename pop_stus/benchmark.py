@@ -0,0 +1,446 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+import numpy as np
+import profiling
+from pipeline import load_script
+
+'''
+全流程基准测试（离线合成数据）
+    1. 按规模生成合成数据：WorldPop 式性别 × 年龄人口栅格（EPSG:4326，约 100m）、
+       噪声栅格（EPSG:3857，机场处高斯峰）、GADM 式县界（共边抖动网格，EPSG:4326）及按州拆分的区域 SHP（EPSG:3857）
+    2. 依次在独立子进程中运行各阶段：pop_stats → split_pop → resample_bianli → agesex_pop_stats
+       → 1.噪声矢量化 → 2.空间拓扑相交 → 3.基于市级遮罩统计受影响人口
+       各脚本的目录配置在子进程中改写为合成数据目录，其余配置保持脚本自身的默认值
+    3. 每个阶段记录耗时、峰值内存（进程树 RSS 之和的最大值）与读取字节数（进程树累计），
+       与已保存的基线对比，超过容差的指标标记为退化
+    4. profile_stages = True 时各阶段同时写出 profiling 计量（work/<规模>/profile/<阶段>），并打印该阶段的热点
+    ⚠ 内存与读取字节数通过 psutil 轮询进程树得到（未安装 psutil 时只记录耗时）；
+      子进程在两次轮询之间退出时，其最后一段读取量会漏计，耗时较短的阶段读数偏低
+    ⚠ Windows 下进程池以 spawn 方式启动，子进程重新导入脚本、看不到改写后的目录配置，
+      因此基准测试中各脚本的进程数由 stage_workers 统一指定，Windows 上应保持为 1
+'''
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ======== 配置 ========
+scale = "small"                    # scales 中的规模名
+data_root = r"./bench/data"        # 合成数据（按规模分子目录，已存在时直接复用）
+work_root = r"./bench/work"        # 各阶段输出（每次运行前清空）
+baseline_path = r"./bench/baseline.json"
+report_path = r"./bench/last_run.json"
+update_baseline = False            # True：本次结果写为该规模的新基线
+tolerance = 0.15                   # 指标超过基线 (1 + tolerance) 倍视为退化
+stage_workers = 1 if os.name == "nt" else None   # None 表示使用全部核心
+poll_interval = 0.05               # 进程树轮询间隔（秒）
+profile_stages = True              # 各阶段写出 span 计量并打印热点
+profile_top = 5                    # 每个阶段打印的热点条数
+stages_to_run = None               # None 表示全部阶段，也可指定名称列表，例如 ["split_pop", "resample_bianli"]
+
+year = 2023
+day = "night"
+noise_thresholds = [40, 45, 50, 55, 60, 65, 70]
+seed = 20231010
+
+# 规模：人口格网宽 × 高（像元，0.001°）、县网格列 × 行、每个州的县列数、年龄组、机场数
+scales = {
+    "small":  {"width": 1200, "height": 900, "counties": (8, 6), "state_cols": 4,
+               "ages": ["00", "05"], "airports": 3},
+    "medium": {"width": 4000, "height": 3000, "counties": (24, 18), "state_cols": 6,
+               "ages": ["00", "05", "10", "15", "20", "25"], "airports": 10},
+    "large":  {"width": 12000, "height": 9000, "counties": (60, 45), "state_cols": 10,
+               "ages": [f"{a:02d}" for a in range(0, 90, 5)], "airports": 30},
+}
+
+POP_RES = 0.001           # 人口格网分辨率（度）
+POP_ORIGIN = (-95.0, 40.0)  # 左上角（经度, 纬度）
+POP_NODATA = -99999.0
+NOISE_RES = 200.0         # 噪声格网分辨率（米，EPSG:3857），粗于人口格网
+NOISE_NODATA = -9999.0
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+METRICS = ("wall_s", "peak_rss_mb", "read_mb")
+
+
+# ======== 合成数据 ========
+def data_paths(root):
+    return {
+        "counties": os.path.join(root, "counties", "counties.shp"),
+        "regions": os.path.join(root, "regions"),
+        "worldpop": os.path.join(root, "worldpop"),
+        "noise": os.path.join(root, "noise"),
+    }
+
+
+def pop_transform():
+    from affine import Affine
+    return Affine(POP_RES, 0, POP_ORIGIN[0], 0, -POP_RES, POP_ORIGIN[1])
+
+
+def make_counties(cfg, rng):
+    """共边抖动网格：内部节点随机偏移，相邻县共用同一条边，互不重叠"""
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    nx, ny = cfg["counties"]
+    west, north = POP_ORIGIN
+    east = west + cfg["width"] * POP_RES
+    south = north - cfg["height"] * POP_RES
+    xs = np.linspace(west, east, nx + 1)
+    ys = np.linspace(north, south, ny + 1)
+    gx, gy = np.meshgrid(xs, ys)
+    jitter = 0.3 * min((east - west) / nx, (north - south) / ny)
+    gx[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (ny - 1, nx - 1))
+    gy[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (ny - 1, nx - 1))
+
+    records, geoms = [], []
+    for j in range(ny):
+        for i in range(nx):
+            ring = [(gx[j, i], gy[j, i]), (gx[j, i + 1], gy[j, i + 1]),
+                    (gx[j + 1, i + 1], gy[j + 1, i + 1]), (gx[j + 1, i], gy[j + 1, i])]
+            state = i // cfg["state_cols"]
+            records.append({
+                "GID_2": f"USA.{state + 1}.{j * nx + i + 1}_1",
+                "NAME_1": f"State{state + 1:02d}",
+                "NAME_2": f"County{j * nx + i + 1:04d}",
+            })
+            geoms.append(Polygon(ring))
+    return gpd.GeoDataFrame(records, geometry=geoms, crs="EPSG:4326")
+
+
+def write_pop_rasters(cfg, rng, folder):
+    import rasterio
+
+    os.makedirs(folder, exist_ok=True)
+    height, width = cfg["height"], cfg["width"]
+    # 所有波段共用同一片“水域”（nodata）和同一个人口密度场，各波段按比例缩放
+    yy, xx = np.mgrid[0:height, 0:width]
+    density = (1 + np.sin(xx / 97.0) * np.cos(yy / 131.0)) * 5
+    water = (xx - width * 0.8) ** 2 + (yy - height * 0.2) ** 2 < (min(height, width) * 0.1) ** 2
+    profile = {
+        "driver": "GTiff", "dtype": "float32", "count": 1, "width": width, "height": height,
+        "crs": "EPSG:4326", "transform": pop_transform(), "nodata": POP_NODATA,
+        "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+    }
+    for gender in ("f", "m"):
+        for age in cfg["ages"]:
+            values = (density * rng.gamma(2.0, 0.5, (height, width))).astype("float32")
+            values[water] = POP_NODATA
+            path = os.path.join(folder, f"usa_{gender}_{age}_{year}_CN_100m_R2025A_v1.tif")
+            with rasterio.open(path, "w", **profile) as dst:
+                dst.write(values, 1)
+
+
+def write_noise_raster(cfg, rng, folder):
+    import rasterio
+    from affine import Affine
+    from pyproj import Transformer
+
+    os.makedirs(folder, exist_ok=True)
+    to_3857 = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    west, north = POP_ORIGIN
+    east = west + cfg["width"] * POP_RES
+    south = north - cfg["height"] * POP_RES
+    (x0, x1), (y0, y1) = to_3857.transform([west, east], [south, north])
+    width = int(np.ceil((x1 - x0) / NOISE_RES))
+    height = int(np.ceil((y1 - y0) / NOISE_RES))
+
+    yy, xx = np.mgrid[0:height, 0:width].astype("float32")
+    noise = np.full((height, width), 30.0, dtype="float32")
+    for _ in range(cfg["airports"]):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        sigma = rng.uniform(0.02, 0.06) * min(width, height)
+        noise += rng.uniform(35, 50) * np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * sigma ** 2))
+    noise[:, :max(1, width // 50)] = NOISE_NODATA
+
+    profile = {
+        "driver": "GTiff", "dtype": "float32", "count": 1, "width": width, "height": height,
+        "crs": "EPSG:3857", "transform": Affine(NOISE_RES, 0, x0, 0, -NOISE_RES, y1),
+        "nodata": NOISE_NODATA, "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+    }
+    with rasterio.open(os.path.join(folder, f"SEL_{day}_{year}10_95.tiff"), "w", **profile) as dst:
+        dst.write(noise, 1)
+
+
+def generate_data(root, cfg):
+    """生成一套合成数据；完成标记存在时直接复用"""
+    marker = os.path.join(root, "_complete.json")
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            if json.load(f) == json.loads(json.dumps(cfg)):   # 元组经 JSON 往返后为列表
+                return data_paths(root)
+    shutil.rmtree(root, ignore_errors=True)
+
+    print(f"生成合成数据: {root}")
+    rng = np.random.default_rng(seed)
+    paths = data_paths(root)
+
+    counties = make_counties(cfg, rng)
+    os.makedirs(os.path.dirname(paths["counties"]), exist_ok=True)
+    counties.to_file(paths["counties"])
+
+    os.makedirs(paths["regions"], exist_ok=True)
+    for state, group in counties.to_crs("EPSG:3857").groupby("NAME_1"):
+        group.to_file(os.path.join(paths["regions"], f"{state}.shp"))
+
+    write_pop_rasters(cfg, rng, os.path.join(paths["worldpop"], str(year)))
+    write_noise_raster(cfg, rng, paths["noise"])
+
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(cfg, f)
+    return paths
+
+
+# ======== 各阶段（在子进程中运行） ========
+def stage_pop_stats(data, work):
+    m = load_script("pop_stats", "pop_stats.py")
+    m.vector_path = data["counties"]
+    m.base_raster_folder = data["worldpop"]
+    m.output_folder = os.path.join(work, "pop_stats")
+    m.label_cache_folder = os.path.join(work, "cache", "labels")
+    m.coverage_cache_folder = os.path.join(work, "cache", "coverage")
+    m.target_years = [str(year)]
+    m.max_workers = stage_workers
+    m.main()
+
+
+def stage_split_pop(data, work):
+    m = load_script("split_pop", "split_pop.py")
+    m.year = year
+    m.shapefile_folder = data["regions"]
+    m.tif_folder = os.path.join(data["worldpop"], str(year))
+    m.output_root = os.path.join(work, "clip")
+    m.plan_cache_folder = os.path.join(work, "cache", "warp_plans")
+    m.max_workers = stage_workers
+    m.main()
+
+
+def stage_resample_bianli(data, work):
+    m = load_script("resample_bianli", "resample_bianli.py")
+    m.years = [year]
+    m.days = [day]
+    m.population_folder = os.path.join(work, "clip", "usa", "f", scales[scale]["ages"][0])
+    m.noise_path_template = os.path.join(data["noise"], "SEL_{day}_{year}10_95.tiff")
+    m.output_template = os.path.join(work, "noise", "{year}", "{day}", "noise_aligned")
+    m.main()
+
+
+def stage_agesex_pop_stats(data, work):
+    m = load_script("agesex_pop_stats", "agesex_pop_stats.py")
+    m.year = year
+    m.day = day
+    m.noise_thresholds = noise_thresholds
+    m.population_root = os.path.join(work, "clip", "usa")
+    m.noise_root = os.path.join(work, "noise", str(year), day, "noise_aligned")
+    m.shapefile_folder = data["regions"]
+    m.output_root = os.path.join(work, "agesex")
+    m.store_root = os.path.join(work, "agesex", "store")
+    m.coverage_cache_folder = os.path.join(work, "cache", "coverage")
+    m.main()
+
+
+def stage_vectorize(data, work):
+    m = load_script("noise_vectorize", "1.噪声矢量化.py")
+    m.max_workers = stage_workers
+    m.process_all_noise_tifs(data["noise"], os.path.join(work, "vectors"), noise_thresholds)
+
+
+def stage_overlay(data, work):
+    m = load_script("noise_overlay", "2.空间拓扑相交.py")
+    m.step2_overlay_parallel(os.path.join(work, "vectors"), data["counties"],
+                             os.path.join(work, "overlay"), max_workers=stage_workers)
+
+
+def stage_mask_stats(data, work):
+    m = load_script("mask_stats", "3.基于市级遮罩统计受影响人口.py")
+    m.step3_per_mask_stats(os.path.join(work, "overlay"), os.path.join(data["worldpop"], str(year)),
+                           data["counties"], os.path.join(work, "mask_stats"),
+                           mask_cache_dir=os.path.join(work, "cache", "masks"))
+
+
+# 按依赖顺序排列：后面的阶段读取前面阶段的输出
+STAGES = {
+    "pop_stats": stage_pop_stats,
+    "split_pop": stage_split_pop,
+    "resample_bianli": stage_resample_bianli,
+    "agesex_pop_stats": stage_agesex_pop_stats,
+    "vectorize": stage_vectorize,
+    "overlay": stage_overlay,
+    "mask_stats": stage_mask_stats,
+}
+
+
+# ======== 计量 ========
+class TreeMonitor:
+    """轮询进程树：峰值 RSS 为每次轮询时各进程 RSS 之和的最大值，读取量为各进程最后一次读数之和"""
+
+    def __init__(self, pid):
+        self.peak_rss = 0
+        self._read = {}
+        self._stop = threading.Event()
+        self._root = psutil.Process(pid)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _bytes_read(proc):
+        io = proc.io_counters()
+        # Linux 的 read_chars 含页缓存命中，read_bytes 只计磁盘读；其它平台只有 read_bytes
+        return getattr(io, "read_chars", io.read_bytes)
+
+    def _sample(self):
+        try:
+            procs = [self._root] + self._root.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    self._read[proc.pid] = self._bytes_read(proc)
+            except (psutil.Error, AttributeError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(poll_interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def bytes_read(self):
+        return sum(self._read.values())
+
+
+def run_stage(name, data_root_dir, work):
+    """在子进程中运行一个阶段，返回计量记录"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--stage", name, data_root_dir, work]
+    env = dict(os.environ)
+    if profile_stages:
+        env[profiling.ENV_VAR] = os.path.join(work, "profile", name)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=work, env=env)
+    monitor = TreeMonitor(proc.pid).start() if psutil is not None else None
+    returncode = proc.wait()
+    wall = time.perf_counter() - t0
+    if monitor is not None:
+        monitor.stop()
+
+    record = {"stage": name, "ok": returncode == 0, "wall_s": wall, "peak_rss_mb": None, "read_mb": None}
+    if monitor is not None:
+        record["peak_rss_mb"] = monitor.peak_rss / 1024 ** 2
+        record["read_mb"] = monitor.bytes_read / 1024 ** 2
+    return record
+
+
+def compare(records, baseline):
+    """对每个指标计算 本次 / 基线，超过 1 + tolerance 记为退化"""
+    regressions = []
+    for r in records:
+        base = baseline.get(r["stage"])
+        r["ratio"] = {}
+        if not base or not r["ok"]:
+            continue
+        for metric in METRICS:
+            if r.get(metric) is None or not base.get(metric):
+                continue
+            ratio = r[metric] / base[metric]
+            r["ratio"][metric] = ratio
+            if ratio > 1 + tolerance:
+                regressions.append((r["stage"], metric, base[metric], r[metric]))
+    return regressions
+
+
+def print_report(records):
+    def fmt(value, ratio):
+        if value is None:
+            return f"{'-':>18}"
+        text = f"{value:.2f}" + (f" ({ratio:.2f}x)" if ratio is not None else "")
+        return f"{text:>18}"
+
+    print(f"\n{'阶段':<18}{'耗时 s':>18}{'峰值内存 MB':>18}{'读取 MB':>18}")
+    for r in records:
+        status = "" if r["ok"] else "  ❌ 失败"
+        cells = "".join(fmt(r[m], r["ratio"].get(m)) for m in METRICS)
+        print(f"{r['stage']:<18}{cells}{status}")
+
+
+def main():
+    if scale not in scales:
+        raise ValueError(f"未知规模: {scale}")
+    cfg = scales[scale]
+    if psutil is None:
+        print("⚠ 未安装 psutil，只记录耗时（pip install psutil）")
+
+    data_dir = os.path.abspath(os.path.join(data_root, scale))
+    generate_data(data_dir, cfg)
+
+    work = os.path.abspath(os.path.join(work_root, scale))
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+
+    names = list(STAGES) if stages_to_run is None else [n for n in STAGES if n in stages_to_run]
+    records = []
+    for name in names:
+        print(f"\n===== {name} =====")
+        record = run_stage(name, data_dir, work)
+        records.append(record)
+        if profile_stages and os.path.isdir(os.path.join(work, "profile", name)):
+            profiling.print_report(os.path.join(work, "profile", name), top=profile_top)
+        if not record["ok"]:
+            print(f"❌ 阶段失败，后续阶段依赖其输出，停止: {name}")
+            break
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding="utf-8") as f:
+            baselines = json.load(f)
+    regressions = compare(records, baselines.get(scale, {}))
+    print_report(records)
+
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"scale": scale, "config": cfg, "records": records}, f, ensure_ascii=False, indent=1)
+
+    if update_baseline:
+        if all(r["ok"] for r in records):
+            baselines[scale] = {r["stage"]: {m: r[m] for m in METRICS} for r in records}
+            with open(baseline_path, "w", encoding="utf-8") as f:
+                json.dump(baselines, f, ensure_ascii=False, indent=1)
+            print(f"\n基线已更新: {baseline_path}")
+        else:
+            print("\n⚠ 有阶段失败，基线未更新")
+    elif not baselines.get(scale):
+        print(f"\n⚠ 没有 {scale} 规模的基线（设置 update_baseline = True 生成）")
+
+    for stage, metric, base, value in regressions:
+        print(f"⚠ 退化: {stage} {metric} {base:.2f} -> {value:.2f}")
+    if regressions or not all(r["ok"] for r in records):
+        sys.exit(1)
+    print("\n✅ 没有超过容差的退化")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--stage":
+        # 子进程：python benchmark.py --stage <阶段> <合成数据目录> <工作目录>
+        with profiling.span(sys.argv[2], scale=scale):
+            STAGES[sys.argv[2]](data_paths(sys.argv[3]), sys.argv[4])
+    else:
+        main()
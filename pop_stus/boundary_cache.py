@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+from hash_cache import HashCache
+
+'''
+预投影边界缓存（GeoParquet）
+    - 每个 (源矢量文件内容, 目标 CRS) 一个缓存目录：boundaries.parquet（已投影的 GeoParquet）
+      + bounds.npy（各要素外包框）+ meta.json
+    - 键 = 源文件（shapefile 含 .shx / .dbf / .prj / .cpg）内容哈希 + 目标 CRS 的 WKT；
+      内容哈希按 (大小, 修改时间) 缓存，文件未变化时不重新读取
+    - 读取时 Parquet 与外包框均以内存映射方式打开；空间索引为外包框的 STRtree，
+      由 bounds.npy 直接构建，不需要解析几何体，查询结果与 GeoDataFrame.sindex.query（无谓词）相同
+    - 同一进程内重复读取返回同一对象（调用方不要原地修改 gdf）；用完后 release_boundaries 释放，
+      之后再读取时重新打开缓存目录
+    - reproject.py 并行预构建各区域与全国县界的缓存
+'''
+
+cache_root = r"./cache/boundaries"
+
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+_loaded = {}
+_hashes = {}
+
+
+def source_files(path):
+    """源矢量文件及其附属文件（shapefile 的 .shx / .dbf / .prj / .cpg）"""
+    stem, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    return [stem + part for part in SHAPEFILE_PARTS if os.path.exists(stem + part)]
+
+
+def crs_wkt(crs):
+    return "" if crs is None else CRS.from_user_input(crs).to_wkt()
+
+
+def entry_key(path, crs, cache_dir=None):
+    cache_dir = cache_dir or cache_root
+    if cache_dir not in _hashes:
+        _hashes[cache_dir] = HashCache(os.path.join(cache_dir, "hash_cache.json"))
+    hashes = _hashes[cache_dir]
+    h = hashlib.sha1()
+    for part in source_files(path):
+        h.update(os.path.splitext(part)[1].lower().encode())
+        h.update(hashes.file_hash(part).encode())
+    h.update(crs_wkt(crs).encode())
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes.save()
+    return h.hexdigest()
+
+
+def entry_dir(path, key, cache_dir=None):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir or cache_root, f"{stem}_{key[:16]}")
+
+
+def build_entry(path, crs, key, cache_dir=None):
+    """读取源文件、投影并写入缓存目录（先写临时目录再改名）；已存在时直接返回"""
+    out_dir = entry_dir(path, key, cache_dir)
+    if os.path.exists(out_dir):
+        return out_dir
+
+    gdf = gpd.read_file(path, engine="pyogrio")
+    if crs is not None and gdf.crs is not None and CRS.from_user_input(crs) != gdf.crs:
+        gdf = gdf.to_crs(crs)
+
+    tmp_dir = f"{out_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    gdf.to_parquet(os.path.join(tmp_dir, "boundaries.parquet"), index=False)
+    np.save(os.path.join(tmp_dir, "bounds.npy"), shapely.bounds(gdf.geometry.values))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"source": os.path.abspath(path), "crs": crs_wkt(gdf.crs), "key": key,
+                   "count": len(gdf), "columns": list(gdf.columns)}, f, ensure_ascii=False)
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        # 其它进程已构建同一缓存
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+class Boundaries:
+    """一个缓存目录：gdf（已投影）、bounds（内存映射的 (n, 4) 外包框）、sindex（外包框 STRtree）"""
+
+    def __init__(self, folder, columns=None):
+        self.folder = folder
+        if columns is not None and "geometry" not in columns:
+            columns = list(columns) + ["geometry"]
+        self.gdf = gpd.read_parquet(os.path.join(folder, "boundaries.parquet"), columns=columns, memory_map=True)
+        self.bounds = np.load(os.path.join(folder, "bounds.npy"), mmap_mode="r")
+        self._sindex = None
+
+    @property
+    def sindex(self):
+        if self._sindex is None:
+            self._sindex = shapely.STRtree(shapely.box(*np.asarray(self.bounds).T))
+        return self._sindex
+
+    @property
+    def total_bounds(self):
+        bounds = np.asarray(self.bounds)
+        return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+def load_boundaries(path, crs=None, columns=None, cache_dir=None):
+    """
+    返回 path 投影到 crs（None 表示保持原投影）后的 Boundaries，缓存不存在时构建。
+    columns: 只读取这些属性列（几何列总是读取）。
+    """
+    key = entry_key(path, crs, cache_dir)
+    memo_key = (key, None if columns is None else tuple(columns))
+    if memo_key not in _loaded:
+        _loaded[memo_key] = Boundaries(build_entry(path, crs, key, cache_dir), columns=columns)
+    return _loaded[memo_key]
+
+
+def release_boundaries(path, crs=None, cache_dir=None):
+    """释放 load_boundaries 对 (path, crs) 的进程内引用（全部 columns 组合），调用方不再持有时内存即可回收"""
+    key = entry_key(path, crs, cache_dir)
+    for memo_key in [k for k in _loaded if k[0] == key]:
+        del _loaded[memo_key]
@@ -1,33 +1,72 @@
 import os
 import sys
+import json
+import time
 import numpy as np
 from osgeo import gdal
-import rasterio
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from profiling import span
 
-def Image_Compress(path_image, path_out_image):
+'''
+批量压缩 GeoTIFF：
+    1. 先在抽样文件上对比各候选压缩方案（压缩比、压缩 / 解压吞吐量、是否无损）
+    2. 选定方案后用进程池在所有核心上压缩整个目录树
+    3. 可选：逐文件校验输出与原文件逐位一致
+WorldPop 为 float32，浮点数据应使用浮点预测器 PREDICTOR=3（原先的 PREDICTOR=2 为整型预测器）；
+整型数据会自动改用 PREDICTOR=2。
+'''
+
+# ======== 配置 ========
+year = 2023
+population_root = Path(rf"F:\wordpop_USA\both\{year}\clip\usa")  # 原始数据根目录
+output_folder = Path(rf"compress\{year}")                          # 压缩输出根目录
+
+# 候选方案：名称 -> GTiff 创建选项（PREDICTOR=3 对整型数据自动换成 2）
+candidate_profiles = {
+    "LZW":        ["COMPRESS=LZW", "PREDICTOR=2"],   # 原方式
+    "DEFLATE":    ["COMPRESS=DEFLATE", "PREDICTOR=3", "ZLEVEL=6"],
+    "ZSTD":       ["COMPRESS=ZSTD", "PREDICTOR=3", "ZSTD_LEVEL=9"],
+    "LERC":       ["COMPRESS=LERC", "MAX_Z_ERROR=0"],
+    "LERC_ZSTD":  ["COMPRESS=LERC_ZSTD", "MAX_Z_ERROR=0"],
+}
+common_options = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"]
+
+# "auto"：在无损且解压吞吐量不低于 min_decompress_mb_s 的方案中选压缩比最高的；也可直接写方案名
+profile = "auto"
+min_decompress_mb_s = 200
+benchmark_samples = 4        # 参与基准测试的抽样文件数
+benchmark_only = False       # True：只输出基准测试报告，不压缩
+
+verify = True                # 压缩后逐位校验
+max_workers = None           # None 表示使用全部核心
+gdal_cache_total_mb = 4096   # GDAL 缓存总量，按进程数均分
+
+
+def Image_Compress(path_image, path_out_image, options=None, callback=None):
     # 转为字符串（兼容 pathlib.Path）
     path_image = str(path_image)
     path_out_image = str(path_out_image)
-    
+
     ds = gdal.Open(path_image)
     if ds is None:
         raise RuntimeError(f"无法打开输入文件: {path_image}")
-    
+
+    if options is None:
+        options = creation_options(candidate_profiles["LZW"], ds)
+
     driver = gdal.GetDriverByName('GTiff')
     out_ds = driver.CreateCopy(
         path_out_image,
         ds,
         strict=1,
-        callback=Show_Progress,
-        options=[
-            "COMPRESS=LZW",
-            "PREDICTOR=2"
-        ]
+        callback=callback,
+        options=options
     )
     if out_ds is None:
         raise RuntimeError(f"CreateCopy 失败: {path_out_image}")
-    
+
     # 显式关闭
     del ds
     del out_ds
@@ -49,52 +88,236 @@ def Show_Progress(percent, msg, tag):
         print("进度：" + "%.2f" % (percent*100) + "%")
     if 99 <= percent * 100 <= 100:
         print("进度：" + "%.2f" % (1 * 100) + "%")
-def main():
-    year = 2023
-    population_root = Path(rf"F:\wordpop_USA\both\{year}\clip\usa")  # 原始数据根目录
-    output_folder = Path(rf"compress\{year}")            # 压缩输出根目录
 
+
+def available_codecs():
+    """当前 GDAL 的 GTiff 驱动支持的压缩算法"""
+    option_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ""
+    start = option_list.find("name='COMPRESS'")
+    end = option_list.find("</Option>", start)
+    return set(v.split("<")[0] for v in option_list[start:end].split("<Value>")[1:])
+
+
+def is_float(ds):
+    return gdal.GetDataTypeName(ds.GetRasterBand(1).DataType).startswith(("Float", "CFloat"))
+
+
+def creation_options(profile_options, ds):
+    """方案选项 + 通用选项；整型数据不能用浮点预测器"""
+    options = list(profile_options)
+    if not is_float(ds):
+        options = ["PREDICTOR=2" if o == "PREDICTOR=3" else o for o in options]
+    return options + common_options
+
+
+def raw_mb(ds):
+    itemsize = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * itemsize / 1024 ** 2
+
+
+def same_pixels(ds_a, ds_b, rows_per_chunk=1024):
+    """逐位比较两个数据集（含 nodata 与 NaN 的位模式），按行条带读取控制内存"""
+    if (ds_a.RasterXSize, ds_a.RasterYSize, ds_a.RasterCount) != \
+            (ds_b.RasterXSize, ds_b.RasterYSize, ds_b.RasterCount):
+        return False
+    for i in range(1, ds_a.RasterCount + 1):
+        band_a, band_b = ds_a.GetRasterBand(i), ds_b.GetRasterBand(i)
+        if band_a.DataType != band_b.DataType:
+            return False
+        nd_a, nd_b = band_a.GetNoDataValue(), band_b.GetNoDataValue()
+        # NaN != NaN，两边都为 NaN 时视为一致
+        if nd_a != nd_b and not (nd_a is not None and nd_b is not None and np.isnan(nd_a) and np.isnan(nd_b)):
+            return False
+        for row in range(0, ds_a.RasterYSize, rows_per_chunk):
+            n = min(rows_per_chunk, ds_a.RasterYSize - row)
+            a = band_a.ReadAsArray(0, row, ds_a.RasterXSize, n)
+            b = band_b.ReadAsArray(0, row, ds_a.RasterXSize, n)
+            if a.tobytes() != b.tobytes():
+                return False
+    return True
+
+
+def benchmark_file(path, profiles):
+    """在内存中（/vsimem）对一个文件测试各方案，返回每个方案一条记录"""
+    src = gdal.Open(str(path))
+    # 先把原始数据读入内存数据集，压缩计时不包含读原文件的开销
+    mem = gdal.GetDriverByName('MEM').CreateCopy('', src)
+    size_mb = raw_mb(mem)
+    del src
+
+    records = []
+    for name, profile_options in profiles.items():
+        vsi_path = f"/vsimem/benchmark_{os.getpid()}_{name}.tif"
+        options = creation_options(profile_options, mem)
+
+        t0 = time.perf_counter()
+        out = gdal.GetDriverByName('GTiff').CreateCopy(vsi_path, mem, strict=1, options=options)
+        del out
+        compress_s = time.perf_counter() - t0
+        comp_mb = gdal.VSIStatL(vsi_path).size / 1024 ** 2
+
+        t0 = time.perf_counter()
+        out = gdal.Open(vsi_path)
+        for i in range(1, out.RasterCount + 1):
+            out.GetRasterBand(i).ReadAsArray()
+        decompress_s = time.perf_counter() - t0
+
+        records.append({
+            "file": str(path),
+            "profile": name,
+            "raw_mb": size_mb,
+            "compressed_mb": comp_mb,
+            "ratio": size_mb / comp_mb if comp_mb > 0 else 0,
+            "compress_mb_s": size_mb / compress_s if compress_s > 0 else float("inf"),
+            "decompress_mb_s": size_mb / decompress_s if decompress_s > 0 else float("inf"),
+            "lossless": same_pixels(mem, out),
+        })
+        del out
+        gdal.Unlink(vsi_path)
+    return records
+
+
+def summarize(records):
+    """按方案汇总：压缩比按总量计算，吞吐量按总数据量 / 总耗时计算"""
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r["profile"], {"raw_mb": 0.0, "compressed_mb": 0.0,
+                                              "compress_s": 0.0, "decompress_s": 0.0, "lossless": True})
+        s["raw_mb"] += r["raw_mb"]
+        s["compressed_mb"] += r["compressed_mb"]
+        s["compress_s"] += r["raw_mb"] / r["compress_mb_s"]
+        s["decompress_s"] += r["raw_mb"] / r["decompress_mb_s"]
+        s["lossless"] &= r["lossless"]
+    for s in summary.values():
+        s["ratio"] = s["raw_mb"] / s["compressed_mb"] if s["compressed_mb"] > 0 else 0
+        s["compress_mb_s"] = s["raw_mb"] / s["compress_s"] if s["compress_s"] > 0 else float("inf")
+        s["decompress_mb_s"] = s["raw_mb"] / s["decompress_s"] if s["decompress_s"] > 0 else float("inf")
+    return summary
+
+
+def choose_profile(summary):
+    usable = [name for name, s in summary.items()
+              if s["lossless"] and s["decompress_mb_s"] >= min_decompress_mb_s]
+    if not usable:
+        usable = [name for name, s in summary.items() if s["lossless"]]
+    if not usable:
+        raise RuntimeError("没有无损的候选压缩方案")
+    return max(usable, key=lambda name: summary[name]["ratio"])
+
+
+def run_benchmark(file_list, profiles):
+    """抽样文件逐个测试（串行，吞吐量不受其它进程争用核心的干扰）"""
+    step = max(1, len(file_list) // benchmark_samples)
+    samples = file_list[::step][:benchmark_samples]
+    print(f"基准测试：{len(samples)} 个抽样文件 × {len(profiles)} 个方案")
+
+    records = []
+    for path in tqdm(samples, desc="Benchmark"):
+        records.extend(benchmark_file(path, profiles))
+
+    summary = summarize(records)
+    print(f"\n{'方案':<12}{'压缩比':>8}{'压缩 MB/s':>12}{'解压 MB/s':>12}{'无损':>6}")
+    for name, s in sorted(summary.items(), key=lambda kv: -kv[1]["ratio"]):
+        print(f"{name:<12}{s['ratio']:>8.2f}{s['compress_mb_s']:>12.1f}"
+              f"{s['decompress_mb_s']:>12.1f}{'✓' if s['lossless'] else '✗':>6}")
+
+    report_path = output_folder / "compression_benchmark.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"records": records, "summary": summary}, f, ensure_ascii=False, indent=1)
+    print(f"基准测试报告: {report_path}\n")
+    return summary
+
+
+# ======== 进程池：每个进程 1 个 GDAL 线程，缓存按进程数均分 ========
+def _init_worker(gdal_cache_mb):
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "1")
+    gdal.SetCacheMax(gdal_cache_mb * 1024 ** 2)
+    gdal.UseExceptions()
+
+
+def compress_file(file_path, output_path, profile_options, check):
+    """压缩单个文件：先写临时文件，（可选）校验通过后再替换为正式输出"""
+    with span("compress.file", file=file_path.name):
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output_path.with_name(output_path.stem + ".partial.tif")
+
+        src = gdal.Open(str(file_path))
+        Image_Compress(file_path, tmp_path, creation_options(profile_options, src))
+
+        if check:
+            out = gdal.Open(str(tmp_path))
+            identical = same_pixels(src, out)
+            del out
+            if not identical:
+                del src
+                os.remove(tmp_path)
+                raise RuntimeError("压缩结果与原文件不一致")
+        del src
+
+        os.replace(tmp_path, output_path)
+        return file_path, file_path.stat().st_size, output_path.stat().st_size
+
+
+def main():
     # 创建输出根目录（虽然会在子目录中自动创建，但提前确保更安全）
     output_folder.mkdir(parents=True, exist_ok=True)
 
     # 递归获取所有 .tif 文件
-    file_list = list(population_root.rglob("*.tif"))
+    file_list = sorted(population_root.rglob("*.tif"))
     if not file_list:
         print("❌ 未在目录中找到任何 .tif 文件！")
         return
 
-    print(f"共找到 {len(file_list)} 个 GeoTIFF 文件，开始压缩...\n")
+    print(f"共找到 {len(file_list)} 个 GeoTIFF 文件\n")
+    workers = max_workers or os.cpu_count() or 1
 
-    # 遍历每个文件
-    for file_path in file_list:
-        try:
-            # 计算相对路径（如 f/00/xxx.tif）
-            print(file_path)
-            rel_path = file_path.relative_to(population_root)
-            output_path = output_folder / rel_path
+    codecs = available_codecs()
+    profiles = {name: options for name, options in candidate_profiles.items()
+                if options[0].split("=", 1)[1] in codecs}
+    skipped = sorted(set(candidate_profiles) - set(profiles))
+    if skipped:
+        print(f"⚠ 当前 GDAL 不支持，跳过: {', '.join(skipped)}")
 
-            # 创建输出子目录
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-
-            # 获取原始大小
-            orig_size = file_path.stat().st_size
-
-            # 执行压缩
-            Image_Compress(file_path, output_path)
-
-            # 获取压缩后大小
-            comp_size = output_path.stat().st_size
-            ratio = orig_size / comp_size if comp_size > 0 else 0
-
-            print(f"✅ 处理完成: {rel_path}")
-            print(f"    原始大小: {orig_size / (1024**2):.2f} MB")
-            print(f"    压缩大小: {comp_size / (1024**2):.2f} MB")
-            print(f"    压缩比:   {ratio:.2f}:1\n")
+    # ======== 选择压缩方案 ========
+    chosen = profile
+    if profile == "auto" or benchmark_only:
+        summary = run_benchmark(file_list, profiles)
+        if profile == "auto":
+            chosen = choose_profile(summary)
+    if benchmark_only:
+        print(f"推荐方案: {chosen}")
+        return
+    if chosen not in profiles:
+        raise ValueError(f"未知或不可用的压缩方案: {chosen}")
+    print(f"使用压缩方案: {chosen} {profiles[chosen]}，进程数 {workers}\n")
 
-        except Exception as e:
-            print(f"❌ 处理失败: {file_path}\n    错误: {e}\n")
+    # ======== 并行压缩 ========
+    total_orig, total_comp, failed = 0, 0, []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(max(64, gdal_cache_total_mb // workers),)) as executor:
+        futures = {
+            executor.submit(compress_file, file_path, output_folder / file_path.relative_to(population_root),
+                            profiles[chosen], verify): file_path
+            for file_path in file_list
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Compress"):
+            file_path = futures[future]
+            try:
+                _, orig_size, comp_size = future.result()
+                total_orig += orig_size
+                total_comp += comp_size
+            except Exception as e:
+                failed.append(file_path)
+                print(f"❌ 处理失败: {file_path}\n    错误: {e}\n")
 
-    print("✅ 所有文件处理完成！")
+    ratio = total_orig / total_comp if total_comp > 0 else 0
+    print(f"\n原始大小: {total_orig / (1024**2):.2f} MB")
+    print(f"压缩大小: {total_comp / (1024**2):.2f} MB")
+    print(f"压缩比:   {ratio:.2f}:1")
+    if failed:
+        print(f"⚠ {len(failed)} 个文件失败")
+    else:
+        print("✅ 所有文件处理完成！")
 
 if __name__ == "__main__":
     # 验证 GDAL 是否可用
@@ -103,5 +326,6 @@ if __name__ == "__main__":
     except ImportError:
         print("❌ 未找到 GDAL Python 绑定，请安装：conda install -c conda-forge gdal")
         sys.exit(1)
-    
-    main()
\ No newline at end of file
+
+    with span("compress", profile=profile):
+        main()
@@ -0,0 +1,186 @@
+import os
+import hashlib
+from collections import namedtuple
+import numpy as np
+import rasterio
+import shapely
+from affine import Affine
+from rasterio.features import rasterize
+from scipy import sparse
+from exposure_cube import _bounds_window
+from label_zonal import grid_key, vector_key, valid_mask
+from mask_index import gather_groups
+
+'''
+县 × 像元 覆盖权重稀疏矩阵
+    - 权重 = 像元面积中落入多边形的比例：内部像元为 1，边界像元按像元方框与多边形的精确相交面积计算；
+      相邻县在共享边界像元上的权重之和为 1，人口不会重复计入或遗漏（不再依赖 all_touched / 像元中心规则）
+    - 每个 (矢量几何, 格网) 只构建一次，以 .npz 缓存：CSC 矩阵（行 = 县，列 = 用到的像元，权重 float32）
+      + 列对应的展平像元号（升序）
+    - coverage_sums：像元按栅格内部分块分组（同 mask_index.gather_groups），每组读取一个有界窗口，
+      一次稀疏矩阵 × (像元 × 波段) 矩阵乘，所有波段的各县总和一次得到
+'''
+
+Grid = namedtuple("Grid", ["crs", "transform", "width", "height"])
+
+# 边界像元按 EDGE_BLOCK × EDGE_BLOCK 像元分块：多边形先按块裁剪，块内像元方框再与裁剪后的小块求交，
+# 噪声掩膜这类像元阶梯状多边形顶点极多，逐像元与整个多边形求交的代价为 边界像元数 × 顶点数
+EDGE_BLOCK = 64
+
+
+def coverage_cache_path(vec_key, grid, cache_dir):
+    h = hashlib.sha1()
+    h.update(vec_key.encode())
+    h.update(repr(grid).encode())
+    h.update(b"coverage")
+    return os.path.join(cache_dir, f"coverage_{h.hexdigest()[:16]}.npz")
+
+
+def geometry_coverage(geom, transform, shape):
+    """
+    单个多边形的覆盖像元与权重，返回 (pixels, weights)。
+    all_touched 栅格化得到候选像元；边界线经过的像元按方框求交计算面积比例，其余候选像元完全在内部，权重为 1。
+    边界像元按 EDGE_BLOCK 分块，多边形先用 clip_by_rect 裁到块范围，像元方框只与块内的部分求交。
+    """
+    height, width = shape
+    row0, row1, col0, col1 = _bounds_window(geom.bounds, transform)
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, height), min(col1, width)
+    if row1 <= row0 or col1 <= col0:
+        return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+
+    win_transform = transform * Affine.translation(col0, row0)
+    out_shape = (row1 - row0, col1 - col0)
+    touched = rasterize([(geom, 1)], out_shape=out_shape, transform=win_transform,
+                        fill=0, all_touched=True, dtype="uint8")
+    edge = rasterize([(geom.boundary, 1)], out_shape=out_shape, transform=win_transform,
+                     fill=0, all_touched=True, dtype="uint8")
+    rows, cols = np.nonzero(touched | edge)
+    weights = np.ones(len(rows), dtype="float64")
+
+    on_edge = np.flatnonzero(edge[rows, cols] > 0)
+    if len(on_edge):
+        r, c = rows[on_edge], cols[on_edge]
+        x0 = win_transform.c + c * win_transform.a
+        y0 = win_transform.f + r * win_transform.e
+        x1, y1 = x0 + win_transform.a, y0 + win_transform.e
+        xmin, xmax = np.minimum(x0, x1), np.maximum(x0, x1)
+        ymin, ymax = np.minimum(y0, y1), np.maximum(y0, y1)
+
+        block_id = (r // EDGE_BLOCK) * (-(-out_shape[1] // EDGE_BLOCK)) + c // EDGE_BLOCK
+        order = np.argsort(block_id, kind="stable")
+        _, starts = np.unique(block_id[order], return_index=True)
+        area = np.empty(len(on_edge), dtype="float64")
+        for members in np.split(order, starts[1:]):
+            piece = shapely.clip_by_rect(geom, xmin[members].min(), ymin[members].min(),
+                                         xmax[members].max(), ymax[members].max())
+            area[members] = shapely.area(shapely.clip_by_rect(
+                piece, xmin[members], ymin[members], xmax[members], ymax[members]))
+        weights[on_edge] = np.clip(area / abs(win_transform.a * win_transform.e), 0, 1)
+
+    keep = weights > 0
+    pixels = (rows[keep] + row0).astype("int64") * width + (cols[keep] + col0)
+    return pixels, weights[keep].astype("float32")
+
+
+def build_coverage_matrix(gdf, transform, shape):
+    """返回 (CSC 矩阵 (n_zones, n_pixels), 升序像元号)；gdf 已是目标格网的投影"""
+    zones, pixels, weights = [], [], []
+    for i, geom in enumerate(gdf.geometry.values):
+        if geom is None or geom.is_empty:
+            continue
+        px, w = geometry_coverage(geom, transform, shape)
+        pixels.append(px)
+        weights.append(w)
+        zones.append(np.full(len(px), i, dtype="int32"))
+    if not zones:
+        return sparse.csc_matrix((len(gdf), 0), dtype="float32"), np.empty(0, dtype="int64")
+
+    pixels = np.concatenate(pixels)
+    used, columns = np.unique(pixels, return_inverse=True)
+    matrix = sparse.csc_matrix((np.concatenate(weights), (np.concatenate(zones), columns)),
+                               shape=(len(gdf), len(used)), dtype="float32")
+    return matrix, used
+
+
+def get_coverage_matrix(gdf, grid, cache_dir, vec_key=None):
+    """
+    grid: 任何带 crs / transform / width / height 属性的对象（rasterio 数据集、Grid、pop_datacube.CubeGrid）。
+    返回 (CSC 矩阵, 像元号)，缓存不存在时构建。
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if vec_key is None:
+        vec_key = vector_key(gdf)
+    path = coverage_cache_path(vec_key, grid_key(grid), cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            matrix = sparse.csc_matrix((cached["data"], cached["indices"], cached["indptr"]),
+                                       shape=tuple(cached["shape"]))
+            return matrix, cached["pixels"]
+
+    if gdf.crs is not None and grid.crs is not None and gdf.crs != grid.crs:
+        gdf = gdf.to_crs(grid.crs)
+    matrix, pixels = build_coverage_matrix(gdf, grid.transform, (grid.height, grid.width))
+
+    # 先写临时文件再改名，中断时不会留下残缺的缓存
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+             shape=np.array(matrix.shape), pixels=pixels)
+    os.replace(tmp_path, path)
+    return matrix, pixels
+
+
+def coverage_triplets(matrix, pixels):
+    """矩阵展开为 (zones, pixels, weights) 成员列表，可直接用于 threshold_cube_sums"""
+    coo = matrix.tocoo()
+    return coo.row.astype("int32"), pixels[coo.col], coo.data
+
+
+def stack_matrices(parts):
+    """
+    parts: [(矩阵, 像元号), ...]（同一格网）；按行拼接为一个矩阵，列为各部分像元号的并集。
+    返回 (CSC 矩阵, 像元号)。
+    """
+    used = np.unique(np.concatenate([pixels for _, pixels in parts]))
+    blocks = []
+    for matrix, pixels in parts:
+        coo = matrix.tocoo()
+        columns = np.searchsorted(used, pixels)
+        blocks.append(sparse.csc_matrix((coo.data, (coo.row, columns[coo.col])), shape=(matrix.shape[0], len(used))))
+    return sparse.vstack(blocks, format="csc"), used
+
+
+def coverage_sums(matrix, pixels, raster_paths, nodata=None, band=1):
+    """
+    各栅格的县加权总和，返回 (len(raster_paths), n_zones) 的 float64 数组（格网必须与矩阵一致）。
+    像元按栅格分块分组，每组只读取组内像元的外包窗口（不超过一个分块），
+    取出 (像元 × 波段) 值矩阵后与对应的矩阵列做一次矩阵乘；峰值内存与栅格大小、掩膜分布无关。
+    nodata: 标量、与 raster_paths 等长的序列，或 None（各栅格使用自身的 nodata）；无效像元按 0 计。
+    """
+    n_bands = len(raster_paths)
+    totals = np.zeros((matrix.shape[0], n_bands), dtype="float64")
+    if len(pixels) == 0 or n_bands == 0:
+        return totals.T
+
+    matrix = matrix.tocsc()
+    srcs = [rasterio.open(path) for path in raster_paths]
+    try:
+        grid = grid_key(srcs[0])
+        for path, src in zip(raster_paths, srcs):
+            if grid_key(src) != grid:
+                raise ValueError(f"栅格格网不一致: {path}")
+        if nodata is None or np.ndim(nodata) == 0:
+            nodatas = [src.nodata if nodata is None else nodata for src in srcs]
+        else:
+            nodatas = list(nodata)
+
+        for window, members, r, c in gather_groups(srcs[0], pixels):
+            values = np.empty((len(members), n_bands), dtype="float64")
+            for j, (src, nd) in enumerate(zip(srcs, nodatas)):
+                block = src.read(band, window=window)[r, c]
+                values[:, j] = np.where(valid_mask(block, nd), block, 0)
+            totals += matrix[:, members] @ values
+    finally:
+        for src in srcs:
+            src.close()
+    return totals.T
@@ -0,0 +1,102 @@
+import math
+import numpy as np
+from affine import Affine
+from rasterio.features import rasterize
+from label_zonal import valid_mask
+
+'''
+性别 × 年龄 × 阈值 融合统计核
+    - zone_pixel_index：每个县单独栅格化（与 zonal_stats 逐要素处理一致，重叠像元在各县都计入），
+      得到 (县, 像元) 成员列表，一个区域只需计算一次
+    - threshold_cube_sums：把一个区域所有性别 × 年龄波段叠成 (n_bands, H, W) 的立方体，
+      噪声按阈值分级一次，一次加权 bincount 得到全部 (波段, 阈值, 县) 的受影响人口
+'''
+
+
+def _bounds_window(bounds, transform):
+    """与 rasterstats.io.bounds_window 相同的取整规则：左上角向下取整，右下角向上取整"""
+    w, s, e, n = bounds
+    row_start = int(math.floor((n - transform.f) / transform.e))
+    col_start = int(math.floor((w - transform.c) / transform.a))
+    row_stop = int(math.ceil((s - transform.f) / transform.e))
+    col_stop = int(math.ceil((e - transform.c) / transform.a))
+    return row_start, row_stop, col_start, col_stop
+
+
+def zone_pixel_index(gdf, transform, shape, all_touched=False):
+    """
+    返回 (zones, pixels)：第 k 条记录表示 gdf 第 zones[k] 行（按位置）包含展平后的像元 pixels[k]。
+    每个多边形在自己的外包窗口内单独栅格化，像元归属规则与 zonal_stats 相同。
+    """
+    height, width = shape
+    zones, pixels = [], []
+    for i, geom in enumerate(gdf.geometry.values):
+        if geom is None or geom.is_empty:
+            continue
+        row0, row1, col0, col1 = _bounds_window(geom.bounds, transform)
+        row0, col0 = max(row0, 0), max(col0, 0)
+        row1, col1 = min(row1, height), min(col1, width)
+        if row1 <= row0 or col1 <= col0:
+            continue
+
+        burned = rasterize(
+            [(geom, 1)],
+            out_shape=(row1 - row0, col1 - col0),
+            transform=transform * Affine.translation(col0, row0),
+            fill=0,
+            all_touched=all_touched,
+            dtype="uint8",
+        )
+        rows, cols = np.nonzero(burned)
+        pixels.append((rows + row0).astype("int64") * width + (cols + col0))
+        zones.append(np.full(len(rows), i, dtype="int32"))
+
+    if not zones:
+        return np.empty(0, dtype="int32"), np.empty(0, dtype="int64")
+    return np.concatenate(zones), np.concatenate(pixels)
+
+
+def threshold_cube_sums(cube, noise, zones, pixels, n_zones, thresholds, nodata,
+                        max_chunk_elements=2 ** 26, weights=None):
+    """
+    cube:   (n_bands, H, W) 人口立方体；noise: (H, W) 已对齐的噪声
+    返回 (n_bands, n_thresholds, n_zones) 的 float64 数组，
+    [b, k, z] = 县 z 内 noise >= thresholds[k] 且人口有效的像元之和（与逐阈值 np.where + zonal_stats 相同）。
+
+    每个像元的噪声级别 = 不超过其噪声值的阈值个数，(县, 级别) 组合成一个键，
+    所有波段的键再按波段偏移拼接，一次 bincount 完成归约；
+    ">= 阈值" 的累计值由各级别从高到低的累加得到。
+    max_chunk_elements 限制单次归约的 (波段 × 成员像元) 数，超过时按波段分批。
+    weights: 与 pixels 等长的成员权重（如 coverage_weights 的覆盖比例），None 时每个成员权重为 1。
+    """
+    thresholds = np.asarray(thresholds)
+    order = np.argsort(thresholds, kind="stable")
+    n_levels = len(thresholds) + 1
+    n_keys = n_zones * n_levels
+
+    noise_px = noise.ravel()[pixels]
+    level = np.searchsorted(thresholds[order], noise_px, side="right")
+    if np.issubdtype(noise_px.dtype, np.floating):
+        level[np.isnan(noise_px)] = 0
+    key = zones.astype("int64") * n_levels + level
+
+    n_bands = cube.shape[0]
+    flat = cube.reshape(n_bands, -1)
+    by_key = np.zeros((n_bands, n_keys), dtype="float64")
+    bands_per_chunk = max(1, max_chunk_elements // max(len(pixels), 1))
+    for b0 in range(0, n_bands, bands_per_chunk):
+        values = flat[b0:b0 + bands_per_chunk][:, pixels]
+        values = np.where(valid_mask(values, nodata), values, 0)
+        if weights is not None:
+            values = values * weights[None, :]
+        nb = values.shape[0]
+        band_key = (np.arange(nb, dtype="int64")[:, None] * n_keys + key[None, :]).ravel()
+        by_key[b0:b0 + nb] = np.bincount(
+            band_key, weights=values.ravel(), minlength=nb * n_keys
+        ).reshape(nb, n_keys)
+
+    by_level = by_key.reshape(n_bands, n_zones, n_levels)
+    at_least = by_level[..., ::-1].cumsum(axis=-1)[..., ::-1]  # [..., j] = 级别 >= j 的和
+    sums = np.empty((n_bands, n_zones, len(thresholds)), dtype="float64")
+    sums[..., order] = at_least[..., 1:]
+    return sums.transpose(0, 2, 1)
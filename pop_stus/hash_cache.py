@@ -0,0 +1,63 @@
+import os
+import json
+import hashlib
+
+'''
+文件内容哈希缓存与 JSON 原子写入（pipeline.py 的阶段键与 boundary_cache.py 的缓存键共用）
+    - HashCache：文件内容 SHA-1 按 (路径, 大小, 修改时间) 缓存在 JSON 文件中，文件未变化时不重新读取
+    - write_json_atomic：先写临时文件再改名，中断时不会留下残缺的 JSON
+'''
+
+
+class HashCache:
+    """文件内容 SHA-1，按 (大小, 修改时间) 缓存；文件未变化时不重新读取"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self.entries[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        self.dirty = True
+        return h.hexdigest()
+
+    def path_hash(self, path):
+        """文件取内容哈希；目录取 (相对路径, 内容哈希) 列表的哈希；不存在时为 missing"""
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return "missing"
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                full = os.path.join(root, filename)
+                h.update(os.path.relpath(full, path).replace(os.sep, "/").encode())
+                h.update(self.file_hash(full).encode())
+        return h.hexdigest()
+
+    def save(self):
+        if self.dirty:
+            write_json_atomic(self.path, self.entries)
+            self.dirty = False
+
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
@@ -0,0 +1,215 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window, bounds as window_bounds, transform as window_transform
+from shapely.geometry import box
+
+'''
+标签栅格分区统计
+    - 县界按格网只栅格化一次，得到与人口栅格对齐的 int32 标签栅格（第 i 行 -> i+1，0 = 不属于任何县）
+    - 标签栅格缓存为分块压缩的 GeoTIFF，键为（矢量几何哈希, 格网, all_touched）
+    - 每个人口文件只需一次加权 np.bincount 即可得到全部县的总和
+    - all_touched=False 时像元归属规则与 zonal_stats 相同（像元中心落入多边形）
+    - stream_zonal_sums：按栅格内部分块逐块读取并累加，线程池并行，峰值内存由 max_memory_mb 限定
+    ⚠ 标签栅格中每个像元只能属于一个县：多边形互相重叠时，重叠像元归编号较大的县，
+      而 zonal_stats 会重复计入。GADM 县界互不重叠，不受影响。
+'''
+
+LABEL_NODATA = 0
+
+
+def grid_key(src):
+    """栅格格网标识：(CRS WKT, transform 六参数, 宽, 高)"""
+    crs_wkt = src.crs.to_wkt() if src.crs else ""
+    return (crs_wkt, tuple(src.transform)[:6], src.width, src.height)
+
+
+def vector_key(gdf):
+    """矢量几何内容哈希（按行顺序），用作缓存键"""
+    h = hashlib.sha1()
+    h.update(str(gdf.crs).encode())
+    for wkb in gdf.geometry.to_wkb():
+        h.update(wkb if wkb is not None else b"\0")
+    return h.hexdigest()
+
+
+def label_cache_path(vec_key, grid, cache_dir, all_touched=False):
+    h = hashlib.sha1()
+    h.update(vec_key.encode())
+    h.update(repr(grid).encode())
+    h.update(b"all_touched" if all_touched else b"center")
+    return os.path.join(cache_dir, f"labels_{h.hexdigest()[:16]}.tif")
+
+
+def build_label_raster(gdf, src, out_path, all_touched=False, block_size=1024):
+    """
+    将 gdf 的多边形烧录为与 src 格网对齐的标签栅格并写入 out_path。
+    按输出块逐块栅格化，每块只处理外包框与之相交的多边形。
+    """
+    if gdf.crs is not None and src.crs is not None and gdf.crs != src.crs:
+        gdf = gdf.to_crs(src.crs)
+
+    geoms = gdf.geometry.values
+    sindex = gdf.sindex
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "int32",
+        "count": 1,
+        "crs": src.crs,
+        "transform": src.transform,
+        "width": src.width,
+        "height": src.height,
+        "nodata": LABEL_NODATA,
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "deflate",
+    }
+
+    # 先写临时文件再改名，中断时不会留下残缺的缓存
+    tmp_path = out_path + ".tmp"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        for _, window in dst.block_windows(1):
+            candidates = sindex.query(box(*window_bounds(window, src.transform)))
+            shapes = [
+                (geoms[i], int(i) + 1) for i in np.sort(candidates)
+                if geoms[i] is not None and not geoms[i].is_empty
+            ]
+            if shapes:
+                labels = rasterize(
+                    shapes,
+                    out_shape=(window.height, window.width),
+                    transform=window_transform(window, src.transform),
+                    fill=LABEL_NODATA,
+                    all_touched=all_touched,
+                    dtype="int32",
+                )
+            else:
+                labels = np.zeros((window.height, window.width), dtype="int32")
+            dst.write(labels, 1, window=window)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def get_label_raster(gdf, raster_path, cache_dir, all_touched=False, vec_key=None):
+    """返回与 raster_path 格网对齐的标签栅格路径，缓存不存在时构建"""
+    os.makedirs(cache_dir, exist_ok=True)
+    if vec_key is None:
+        vec_key = vector_key(gdf)
+    with rasterio.open(raster_path) as src:
+        label_path = label_cache_path(vec_key, grid_key(src), cache_dir, all_touched)
+        if not os.path.exists(label_path):
+            build_label_raster(gdf, src, label_path, all_touched=all_touched)
+    return label_path
+
+
+def valid_mask(values, nodata):
+    """有效像元：不等于 nodata 且（浮点型时）不是 NaN，与 zonal_stats 的掩膜规则一致"""
+    valid = np.ones(values.shape, dtype=bool) if nodata is None else (values != nodata)
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    return valid
+
+
+def zonal_sums(label_path, raster_path, n_zones, nodata=None, band=1):
+    """
+    一次加权 bincount 得到每个县的总和，返回长度为 n_zones 的 float64 数组
+    （与 gdf 行顺序一致，无有效像元的县为 0）。
+    nodata=None 时使用栅格自身的 nodata。
+    """
+    with rasterio.open(label_path) as label_src, rasterio.open(raster_path) as src:
+        if grid_key(label_src) != grid_key(src):
+            raise ValueError(f"标签栅格与人口栅格格网不一致: {raster_path}")
+        labels = label_src.read(1)
+        values = src.read(band)
+        if nodata is None:
+            nodata = src.nodata
+
+    valid = valid_mask(values, nodata) & (labels != LABEL_NODATA)
+    sums = np.bincount(labels[valid], weights=values[valid], minlength=n_zones + 1)
+    return sums[1:n_zones + 1]
+
+
+# 流式模式下每个像元的估算内存：值 + 标签 + 掩膜 + 筛选后的副本
+_BYTES_PER_PIXEL_OVERHEAD = 4 + 1 + 8 + 4
+
+
+def stream_windows(src, max_task_pixels):
+    """
+    按 src 的内部分块生成读取窗口。
+    分块（tiled）影像逐块返回；条带（stripped）影像把相邻条带合并为不超过 max_task_pixels 的行块。
+    """
+    block_h, block_w = src.block_shapes[0]
+    if block_w < src.width:
+        for _, window in src.block_windows(1):
+            yield window
+        return
+
+    rows = max(block_h, (max_task_pixels // max(src.width, 1)) // block_h * block_h)
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+
+def stream_zonal_sums(label_path, raster_path, n_zones, nodata=None, band=1,
+                      max_memory_mb=512, workers=4):
+    """
+    流式版本的 zonal_sums：逐块读取标签与人口栅格，各块的 bincount 结果累加为县总和。
+    同时在处理中的块数受 max_memory_mb 限制，峰值内存与栅格大小无关。
+    每个工作线程持有各自的数据集句柄（rasterio 数据集不可跨线程共享）。
+    """
+    workers = max(1, int(workers))
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def open_handles():
+        local.labels = rasterio.open(label_path)
+        local.values = rasterio.open(raster_path)
+        with handles_lock:
+            handles.extend([local.labels, local.values])
+
+    with rasterio.open(label_path) as label_src, rasterio.open(raster_path) as src:
+        if grid_key(label_src) != grid_key(src):
+            raise ValueError(f"标签栅格与人口栅格格网不一致: {raster_path}")
+        if nodata is None:
+            nodata = src.nodata
+        per_pixel = np.dtype(src.dtypes[band - 1]).itemsize + _BYTES_PER_PIXEL_OVERHEAD
+        # 在途任务数 = 2 * workers（执行中 + 排队中），每个任务平分内存上限
+        max_inflight = 2 * workers
+        max_task_pixels = max(1, int(max_memory_mb * 1024 ** 2) // (per_pixel * max_inflight))
+        windows = list(stream_windows(src, max_task_pixels))
+
+    def block_sums(window):
+        labels = local.labels.read(1, window=window)
+        values = local.values.read(band, window=window)
+        valid = valid_mask(values, nodata) & (labels != LABEL_NODATA)
+        if not valid.any():
+            return None
+        return np.bincount(labels[valid], weights=values[valid], minlength=n_zones + 1)[:n_zones + 1]
+
+    totals = np.zeros(n_zones + 1, dtype="float64")
+    try:
+        with ThreadPoolExecutor(max_workers=workers, initializer=open_handles) as executor:
+            pending = set()
+            for window in windows:
+                if len(pending) >= max_inflight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        part = future.result()
+                        if part is not None:
+                            totals += part
+                pending.add(executor.submit(block_sums, window))
+            for future in pending:
+                part = future.result()
+                if part is not None:
+                    totals += part
+    finally:
+        for handle in handles:
+            handle.close()
+
+    return totals[1:]
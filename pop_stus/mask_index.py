@@ -0,0 +1,130 @@
+import os
+import hashlib
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from exposure_cube import zone_pixel_index
+from label_zonal import grid_key, vector_key, valid_mask
+
+'''
+掩膜稀疏像元索引
+    - 每个掩膜文件（县 × 噪声相交面）在人口格网上只栅格化一次，得到 (县行号, 像元) 成员列表
+    - 成员列表缓存为 .npz，键为（掩膜几何哈希, 格网, all_touched）；同一格网的所有人口文件共用
+    - 统计时按栅格分块分组，只读取成员像元所在的窗口，一次加权 bincount 得到全部县的总和
+    - 每个多边形单独栅格化（zone_pixel_index），像元归属规则与 zonal_stats 相同，重叠像元在各县都计入
+'''
+
+
+def index_cache_path(vec_key, grid, cache_dir, all_touched=False):
+    h = hashlib.sha1()
+    h.update(vec_key.encode())
+    h.update(repr(grid).encode())
+    h.update(b"all_touched" if all_touched else b"center")
+    return os.path.join(cache_dir, f"pixels_{h.hexdigest()[:16]}.npz")
+
+
+def get_pixel_index(gdf, raster_path, cache_dir, all_touched=False, vec_key=None):
+    """返回与 raster_path 格网对齐的 (zones, pixels)，缓存不存在时构建"""
+    with rasterio.open(raster_path) as src:
+        return get_grid_pixel_index(gdf, src, cache_dir, all_touched=all_touched, vec_key=vec_key)
+
+
+def get_grid_pixel_index(gdf, grid, cache_dir, all_touched=False, vec_key=None):
+    """
+    grid: 任何带 crs / transform / width / height 属性的对象（rasterio 数据集、pop_datacube.CubeGrid）。
+    同一格网上的索引与 get_pixel_index 共用缓存。
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if vec_key is None:
+        vec_key = vector_key(gdf)
+    path = index_cache_path(vec_key, grid_key(grid), cache_dir, all_touched)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached["zones"], cached["pixels"]
+    if gdf.crs is not None and grid.crs is not None and gdf.crs != grid.crs:
+        gdf = gdf.to_crs(grid.crs)
+    zones, pixels = zone_pixel_index(gdf, grid.transform, (grid.height, grid.width), all_touched=all_touched)
+
+    # 先写临时文件再改名，中断时不会留下残缺的缓存
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, zones=zones, pixels=pixels)
+    os.replace(tmp_path, path)
+    return zones, pixels
+
+
+def gather_groups(src, pixels, min_rows=256, group_cols=1024):
+    """
+    按栅格内部分块对成员像元分组，依次产出 (读取窗口, 该组在 pixels 中的位置)。
+    读取窗口为组内像元的外包框；条带影像按 min_rows 行 × group_cols 列分组。
+    """
+    block_h, block_w = src.block_shapes[0]
+    if block_w >= src.width:
+        block_h, block_w = max(block_h, min_rows), group_cols
+    rows, cols = np.divmod(pixels, src.width)
+    n_block_cols = -(-src.width // block_w)
+    block_id = (rows // block_h) * n_block_cols + cols // block_w
+
+    order = np.argsort(block_id, kind="stable")
+    _, starts = np.unique(block_id[order], return_index=True)
+    for members in np.split(order, starts[1:]):
+        if len(members) == 0:
+            continue
+        r, c = rows[members], cols[members]
+        r0, c0 = int(r.min()), int(c.min())
+        window = Window(c0, r0, int(c.max()) - c0 + 1, int(r.max()) - r0 + 1)
+        yield window, members, r - r0, c - c0
+
+
+def gather_zonal_sums(zones, pixels, raster_path, n_zones, nodata=None, band=1):
+    """
+    由成员列表直接取值求和，返回长度为 n_zones 的 float64 数组（无有效像元的县为 0）。
+    nodata=None 时使用栅格自身的 nodata。
+    """
+    totals = np.zeros(n_zones, dtype="float64")
+    if len(pixels) == 0:
+        return totals
+    with rasterio.open(raster_path) as src:
+        if nodata is None:
+            nodata = src.nodata
+        for window, members, r, c in gather_groups(src, pixels):
+            values = src.read(band, window=window)[r, c]
+            valid = valid_mask(values, nodata)
+            totals += np.bincount(zones[members][valid], weights=values[valid], minlength=n_zones)
+    return totals
+
+
+def gather_stack_sums(zones, pixels, raster_paths, n_zones, nodata=None, band=1):
+    """
+    多栅格版本的 gather_zonal_sums：raster_paths 视为一个虚拟波段栈（格网必须一致），
+    每个读取窗口在所有栅格上各读一次，一次 bincount 得到全部 (栅格, 县) 的总和。
+    nodata: 标量、与 raster_paths 等长的序列，或 None（各栅格使用自身的 nodata）。
+    返回 (len(raster_paths), n_zones) 的 float64 数组。
+    """
+    n_bands = len(raster_paths)
+    totals = np.zeros((n_bands, n_zones), dtype="float64")
+    if len(pixels) == 0 or n_bands == 0:
+        return totals
+
+    srcs = [rasterio.open(path) for path in raster_paths]
+    try:
+        grid = grid_key(srcs[0])
+        for path, src in zip(raster_paths, srcs):
+            if grid_key(src) != grid:
+                raise ValueError(f"波段栈中的栅格格网不一致: {path}")
+        if nodata is None or np.ndim(nodata) == 0:
+            nodatas = [src.nodata if nodata is None else nodata for src in srcs]
+        else:
+            nodatas = list(nodata)
+
+        band_offset = np.arange(n_bands, dtype="int64")[:, None] * n_zones
+        for window, members, r, c in gather_groups(srcs[0], pixels):
+            values = np.empty((n_bands, len(members)), dtype="float64")
+            for b, (src, nd) in enumerate(zip(srcs, nodatas)):
+                block = src.read(band, window=window)[r, c]
+                values[b] = np.where(valid_mask(block, nd), block, 0)
+            key = (band_offset + zones[members][None, :]).ravel()
+            totals += np.bincount(key, weights=values.ravel(), minlength=n_bands * n_zones).reshape(n_bands, n_zones)
+    finally:
+        for src in srcs:
+            src.close()
+    return totals
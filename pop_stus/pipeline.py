@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hash_cache import HashCache, write_json_atomic
+
+'''
+噪声暴露全流程增量运行器
+    栅格链：reproject → split_pop → resample_bianli → agesex_pop_stats（每个时段一个阶段）
+    矢量链：1.噪声矢量化 → 2.空间拓扑相交 → 3.基于市级遮罩统计受影响人口
+    ✅ 各阶段构成依赖图；阶段键 = 哈希（阶段名, 脚本及其辅助模块源码, 参数, 输入文件内容, 上游阶段键）
+    ✅ 阶段输出目录中记录阶段键，键未变化的阶段直接跳过；输入、参数或代码变化时只重建受影响的阶段及其下游
+    ✅ 互不依赖的阶段（栅格链与矢量链）并发运行，每个阶段在独立子进程中执行
+    ✅ 阶段先写入 <阶段>.partial 临时目录，成功后整体改名替换正式目录，中断不会留下看似完整的半成品；
+       .partial 中记录阶段键，键未变化时中断重跑保留已写出的文件，键变化时清空；
+       split_pop（ledger）、resample_bianli、1.噪声矢量化、2.空间拓扑相交、3.基于市级遮罩统计（ledger）
+       跳过已完成的输出，从断点继续；reproject 与 agesex_pop_stats 仍整阶段重跑（reproject 的边界缓存本身可复用）
+    输入文件的内容哈希按 (路径, 大小, 修改时间) 缓存在 hash_cache.json 中，文件未变化时不再重新读取
+    ⚠ Windows 下进程池以 spawn 方式启动，子进程重新导入脚本、看不到改写后的目录配置，
+      因此各脚本的进程数由 stage_workers 统一指定，Windows 上应保持为 1
+'''
+
+# ======== 配置 ========
+year = 2023
+days = ["oneday", "night"]
+noise_thresholds = [40, 45, 50, 55, 60, 65, 70]
+
+split_boundary_folder = r"./USA/split"                  # 按区域拆分的县界（reproject 输入）
+counties_shp = r"USA\gadm41_USA_2.shp"                  # 全国县界
+worldpop_folder = rf"F:\wordpop_USA\both\{year}\fm"     # WorldPop 性别 × 年龄原始影像（EPSG:4326）
+noise_folder = r"F:\机场噪音"                            # 原始噪声大影像
+noise_name_template = "SEL_{day}_{year}10_95.tiff"
+
+pipeline_root = r"./pipeline"      # 各阶段输出：<pipeline_root>/<阶段>/
+cache_root = r"./cache"            # 各脚本的格网 / 计划缓存（本身按内容取键，可跨运行共用）
+max_parallel_stages = 2            # 同时运行的阶段数
+stage_workers = 1 if os.name == "nt" else None   # 各脚本的进程数，None 表示使用全部核心
+targets = None                     # None 表示全部阶段，也可指定阶段名列表（自动包含上游）
+force = []                         # 无论键是否变化都重建的阶段
+
+# 各阶段参数（写入脚本的模块配置，并计入阶段键）
+params = {
+    "reproject": {"dst_crs": "EPSG:3857"},
+    "split_pop": {"buffer_distance": 1000, "warp_mode": "plan", "cog_compress": "ZSTD", "cog_block_size": 512},
+    "resample_bianli": {},
+    "agesex_pop_stats": {"noise_thresholds": noise_thresholds, "stats_engine": "cube", "boundary_rule": "coverage",
+                         "output_format": "parquet"},
+    "vectorize": {"noise_thresholds": noise_thresholds, "tile_size": 4096, "output_driver": "GPKG",
+                  "output_crs": "EPSG:4326"},
+    "overlay": {"chunk_size": 32},
+    "mask_stats": {"output_format": "parquet", "boundary_rule": "coverage"},
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+STAGE_MARKER = "_stage.json"
+PARTIAL_MARKER = "_partial.json"
+
+
+def load_script(name, filename):
+    """按文件路径导入脚本（文件名可含中文），注册到 sys.modules 以便进程池子进程反序列化任务函数"""
+    for folder in (HERE, REPO):
+        if folder not in sys.path:
+            sys.path.insert(0, folder)
+    path = os.path.join(HERE if filename != "pop_stats.py" else REPO, filename)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def configure(module, values):
+    for name, value in values.items():
+        if not hasattr(module, name):
+            raise AttributeError(f"{module.__name__} 没有配置项 {name}")
+        setattr(module, name, value)
+
+
+# ======== 阶段定义 ========
+def stage_dir(name):
+    return os.path.abspath(os.path.join(pipeline_root, name))
+
+
+def noise_paths():
+    return [os.path.join(noise_folder, noise_name_template.format(day=d, year=year)) for d in days]
+
+
+def stages():
+    """
+    阶段名 -> {deps: 上游阶段, inputs: 输入文件 / 目录, code: 脚本与辅助模块, params: 参数}
+    """
+    specs = {
+        "reproject": {
+            "deps": [], "inputs": [split_boundary_folder, counties_shp],
+            "code": ["reproject.py", "boundary_cache.py"], "params": params["reproject"],
+        },
+        "split_pop": {
+            "deps": ["reproject"], "inputs": [worldpop_folder],
+            "code": ["split_pop.py", "boundary_cache.py"], "params": dict(params["split_pop"], year=year),
+        },
+        "resample_bianli": {
+            "deps": ["split_pop"], "inputs": noise_paths(),
+            "code": ["resample_bianli.py"], "params": dict(params["resample_bianli"], year=year, days=days),
+        },
+        "vectorize": {
+            "deps": [], "inputs": noise_paths(),
+            "code": ["1.噪声矢量化.py", "vector_sink.py"], "params": params["vectorize"],
+        },
+        "overlay": {
+            "deps": ["vectorize"], "inputs": [counties_shp],
+            "code": ["2.空间拓扑相交.py", "vector_sink.py", "boundary_cache.py"], "params": params["overlay"],
+        },
+        "mask_stats": {
+            "deps": ["overlay"], "inputs": [worldpop_folder, counties_shp],
+            "code": ["3.基于市级遮罩统计受影响人口.py", "mask_index.py", "coverage_weights.py", "pop_datacube.py",
+                     "exposure_cube.py", "label_zonal.py", "result_store.py", "vector_sink.py", "boundary_cache.py"],
+            "params": params["mask_stats"],
+        },
+    }
+    for day in days:
+        specs[f"agesex_pop_stats-{day}"] = {
+            "deps": ["reproject", "split_pop", "resample_bianli"], "inputs": [],
+            "code": ["agesex_pop_stats.py", "exposure_cube.py", "coverage_weights.py", "label_zonal.py",
+                     "result_store.py", "boundary_cache.py"],
+            "params": dict(params["agesex_pop_stats"], year=year, day=day),
+        }
+    return specs
+
+
+def run_reproject(out, deps):
+    m = load_script("reproject", "reproject.py")
+    configure(m, dict(params["reproject"], input_folder=split_boundary_folder, output_folder=out,
+                      extra_sources=[counties_shp], cache_folder=os.path.join(cache_root, "boundaries"),
+                      max_workers=stage_workers))
+    m.main()
+
+
+def run_split_pop(out, deps):
+    m = load_script("split_pop", "split_pop.py")
+    configure(m, dict(params["split_pop"], year=year, shapefile_folder=deps["reproject"],
+                      tif_folder=worldpop_folder, output_root=out,
+                      plan_cache_folder=os.path.join(cache_root, "warp_plans"), max_workers=stage_workers))
+    m.main()
+
+
+def run_resample_bianli(out, deps):
+    m = load_script("resample_bianli", "resample_bianli.py")
+    split_out = os.path.join(deps["split_pop"], "usa", "f")
+    first_age = sorted(os.listdir(split_out))[0]
+    configure(m, dict(params["resample_bianli"], years=[year], days=days,
+                      population_folder=os.path.join(split_out, first_age),
+                      noise_path_template=os.path.join(noise_folder, noise_name_template),
+                      output_template=os.path.join(out, "{year}", "{day}", "noise_aligned")))
+    m.main()
+
+
+def run_agesex_pop_stats(out, deps, day):
+    m = load_script("agesex_pop_stats", "agesex_pop_stats.py")
+    configure(m, dict(params["agesex_pop_stats"], year=year, day=day,
+                      population_root=os.path.join(deps["split_pop"], "usa"),
+                      noise_root=os.path.join(deps["resample_bianli"], str(year), day, "noise_aligned"),
+                      shapefile_folder=deps["reproject"], output_root=out,
+                      store_root=os.path.join(out, "store"),
+                      coverage_cache_folder=os.path.join(cache_root, "coverage")))
+    m.main()
+
+
+def run_vectorize(out, deps):
+    m = load_script("noise_vectorize", "1.噪声矢量化.py")
+    p = dict(params["vectorize"])
+    thresholds = p.pop("noise_thresholds")
+    configure(m, dict(p, max_workers=stage_workers))
+    # 只矢量化本次配置的噪声影像：输入目录中放入指向原始影像的链接（不支持时复制）
+    # 续跑时 .partial 中可能留有上次的 _inputs，先清空再重建链接
+    inputs = os.path.join(out, "_inputs")
+    shutil.rmtree(inputs, ignore_errors=True)
+    os.makedirs(inputs)
+    for path in noise_paths():
+        link = os.path.join(inputs, os.path.basename(path))
+        try:
+            os.symlink(os.path.abspath(path), link)
+        except OSError:
+            shutil.copy2(path, link)
+    m.process_all_noise_tifs(inputs, os.path.join(out, "vectors"), thresholds)
+    shutil.rmtree(inputs)
+
+
+def run_overlay(out, deps):
+    m = load_script("noise_overlay", "2.空间拓扑相交.py")
+    configure(m, params["overlay"])
+    m.step2_overlay_parallel(os.path.join(deps["vectorize"], "vectors"), counties_shp, out,
+                             max_workers=stage_workers)
+
+
+def run_mask_stats(out, deps):
+    m = load_script("mask_stats", "3.基于市级遮罩统计受影响人口.py")
+    m.step3_per_mask_stats(deps["overlay"], worldpop_folder, counties_shp, out,
+                           mask_cache_dir=os.path.join(cache_root, "masks"),
+                           label_cache_dir=os.path.join(cache_root, "labels"), **params["mask_stats"])
+
+
+def runner(name):
+    if name.startswith("agesex_pop_stats-"):
+        day = name.split("-", 1)[1]
+        return lambda out, deps: run_agesex_pop_stats(out, deps, day)
+    return globals()[f"run_{name}"]
+
+
+def topological(specs, wanted):
+    """wanted 及其全部上游，按依赖顺序排列"""
+    order, seen = [], set()
+
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        for dep in specs[name]["deps"]:
+            visit(dep)
+        order.append(name)
+
+    for name in wanted:
+        if name not in specs:
+            raise ValueError(f"未知阶段: {name}")
+        visit(name)
+    return order
+
+
+def stage_keys(specs, order, hashes):
+    keys = {}
+    for name in order:
+        spec = specs[name]
+        h = hashlib.sha1()
+        h.update(name.encode())
+        for filename in spec["code"]:
+            h.update(hashes.file_hash(os.path.join(HERE, filename)).encode())
+        h.update(json.dumps(spec["params"], sort_keys=True, default=str).encode())
+        for path in spec["inputs"]:
+            h.update(hashes.path_hash(path).encode())
+        for dep in spec["deps"]:
+            h.update(keys[dep].encode())
+        keys[name] = h.hexdigest()
+    return keys
+
+
+def read_key(folder, marker):
+    path = os.path.join(folder, marker)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get("key")
+
+
+def built_key(name):
+    return read_key(stage_dir(name), STAGE_MARKER)
+
+
+# ======== 运行 ========
+def run_stage(name, key, fresh=False):
+    """
+    在子进程中把阶段写入临时目录，成功后替换正式目录；返回是否成功。
+    临时目录为上次中断留下、且阶段键相同时保留（续跑），否则清空；fresh=True 时总是清空。
+    """
+    out = stage_dir(name)
+    tmp = out + ".partial"
+    if fresh or read_key(tmp, PARTIAL_MARKER) != key:
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        write_json_atomic(os.path.join(tmp, PARTIAL_MARKER), {"stage": name, "key": key, "started": time.time()})
+    else:
+        print(f"↻  续跑: {name}（保留 {tmp} 中已完成的输出）")
+
+    t0 = time.perf_counter()
+    returncode = subprocess.call([sys.executable, os.path.abspath(__file__), "--stage", name, tmp])
+    if returncode != 0:
+        return False
+
+    os.remove(os.path.join(tmp, PARTIAL_MARKER))
+    write_json_atomic(os.path.join(tmp, STAGE_MARKER),
+                      {"stage": name, "key": key, "seconds": time.perf_counter() - t0, "finished": time.time()})
+    old = out + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(out):
+        os.replace(out, old)
+    os.replace(tmp, out)
+    shutil.rmtree(old, ignore_errors=True)
+    return True
+
+
+def main():
+    specs = stages()
+    order = topological(specs, targets or list(specs))
+    os.makedirs(pipeline_root, exist_ok=True)
+
+    hashes = HashCache(os.path.join(pipeline_root, "hash_cache.json"))
+    print("计算阶段键（输入内容哈希）...")
+    keys = stage_keys(specs, order, hashes)
+    hashes.save()
+
+    stale = [name for name in order if name in force or built_key(name) != keys[name]]
+    for name in order:
+        print(f"  {'重建' if name in stale else '最新'}  {name}  {keys[name][:12]}")
+    if not stale:
+        print("✅ 所有阶段均为最新")
+        return
+
+    # 上游全部完成（或本来就是最新）的阶段即可启动，互不依赖的阶段并发运行
+    done = {name for name in order if name not in stale}
+    failed = set()
+    pending = list(stale)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel_stages) as executor:
+        while pending or running:
+            for name in list(pending):
+                deps = specs[name]["deps"]
+                if any(dep in failed for dep in deps):
+                    pending.remove(name)
+                    failed.add(name)
+                    print(f"⏭  上游失败，跳过: {name}")
+                elif all(dep in done for dep in deps):
+                    pending.remove(name)
+                    print(f"▶  开始: {name}")
+                    running[executor.submit(run_stage, name, keys[name], name in force)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.result():
+                    done.add(name)
+                    print(f"✓  完成: {name}")
+                else:
+                    failed.add(name)
+                    print(f"❌ 失败: {name}")
+
+    if failed:
+        print(f"\n⚠ {len(failed)} 个阶段未完成: {', '.join(sorted(failed))}")
+        sys.exit(1)
+    print("\n🎉 流程完成！")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--stage":
+        # 子进程：python pipeline.py --stage <阶段> <输出目录>
+        stage_name = sys.argv[2]
+        import boundary_cache
+        boundary_cache.cache_root = os.path.join(cache_root, "boundaries")
+        stage_deps = {dep: stage_dir(dep) for dep in stages()[stage_name]["deps"]}
+        runner(stage_name)(sys.argv[3], stage_deps)
+    else:
+        main()
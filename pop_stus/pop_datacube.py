@@ -0,0 +1,241 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import rasterio
+import zarr
+from affine import Affine
+from rasterio.crs import CRS
+from label_zonal import grid_key, valid_mask
+from profiling import span
+
+'''
+多年份人口数据立方体（Zarr）
+    - 维度 (year, gender, age, y, x)：每个年份的 性别 × 年龄 全部波段打包进一个分块压缩的数组库
+      （压缩使用 zarr 默认编码器），之后跨年份的统计不再逐个打开 both/{year} 下的 GeoTIFF
+    - 分块 (1, 全部性别, 全部年龄, chunk_size, chunk_size)：一个空间分块的所有波段在同一块中，
+      一次解压即得到该范围内全部性别 × 年龄的值；年份轴可追加（新年份只写入新的块）
+    - 格网（CRS / transform / 宽高）、nodata、维度标签记录在数组属性中；所有年份、波段必须同一格网
+    - cube_zonal_sums：按 (县, 像元) 成员列表，按存储顺序只扫描含成员像元的分块，
+      一次 bincount 得到全部 (年份, 性别, 年龄, 县) 的总和
+    - 入库可中断重跑：年份写完后才记入 complete_years，未完成的年份重跑时整年重写
+'''
+
+# ======== 配置（python pop_datacube.py 时使用） ========
+base_raster_folder = r"F:\wordpop_USA\both"   # 各年份目录 both/{year}（含子文件夹如 fm）
+cube_path = r"./cube/worldpop_usa.zarr"
+target_years = ["2021", "2022", "2023"]
+chunk_size = 256       # 空间分块边长（像元）
+ingest_workers = 4     # 入库读取 / 压缩线程数
+
+BAND_PATTERN = re.compile(r'[a-zA-Z]+_([fm])_(\d+)_(\d{4})_')
+
+
+def parse_band(tif_name):
+    """usa_f_00_2023_CN_100m_R2025A_v1.tif -> ('f', '00', 2023)；不匹配时返回 None"""
+    match = BAND_PATTERN.match(os.path.basename(tif_name))
+    if not match:
+        return None
+    gender, age, year = match.groups()
+    return gender, age, int(year)
+
+
+def find_year_bands(root, year):
+    """递归扫描 root/{year} 下的 tif，返回 {(性别, 年龄): 路径}"""
+    bands = {}
+    for folder, _, files in os.walk(os.path.join(root, str(year))):
+        for f in files:
+            parsed = parse_band(f) if f.endswith(".tif") else None
+            if parsed and parsed[2] == int(year):
+                bands[parsed[:2]] = os.path.join(folder, f)
+    return bands
+
+
+class CubeGrid:
+    """立方体的格网，属性与 rasterio 数据集相同（crs / transform / width / height），可直接用于 grid_key"""
+
+    def __init__(self, attrs):
+        self.crs = CRS.from_wkt(attrs["crs"]) if attrs["crs"] else None
+        self.transform = Affine(*attrs["transform"])
+        self.width = attrs["width"]
+        self.height = attrs["height"]
+
+
+def open_cube(path, mode="r"):
+    return zarr.open_array(path, mode=mode)
+
+
+def cube_years(cube):
+    """已完整入库的年份"""
+    return list(cube.attrs.get("complete_years", []))
+
+
+def create_cube(path, src, genders, ages, chunk=256):
+    """按 src 的格网新建空立方体（年份轴长度为 0）"""
+    nodata = src.nodata if src.nodata is not None else -99999
+    cube = zarr.open_array(
+        path, mode="w",
+        shape=(0, len(genders), len(ages), src.height, src.width),
+        chunks=(1, len(genders), len(ages), chunk, chunk),
+        dtype=src.dtypes[0], fill_value=nodata,
+    )
+    cube.attrs.update({
+        "dims": ["year", "gender", "age", "y", "x"],
+        "years": [], "complete_years": [],
+        "genders": list(genders), "ages": list(ages),
+        "crs": src.crs.to_wkt() if src.crs else "",
+        "transform": list(src.transform)[:6],
+        "width": src.width, "height": src.height,
+        "nodata": nodata,
+    })
+    return cube
+
+
+def chunk_windows(cube):
+    """按存储顺序（行优先）列出空间分块 (row0, row1, col0, col1)"""
+    height, width = cube.shape[3:]
+    chunk_h, chunk_w = cube.chunks[3:]
+    for row0 in range(0, height, chunk_h):
+        for col0 in range(0, width, chunk_w):
+            yield row0, min(row0 + chunk_h, height), col0, min(col0 + chunk_w, width)
+
+
+def ingest_year(cube_path, year, band_paths, chunk=256, workers=4):
+    """
+    将一个年份的全部 性别 × 年龄 波段写入立方体（不存在时按第一个波段的格网新建）。
+    band_paths: {(性别, 年龄): tif 路径}；缺失的波段保持 fill_value（nodata）。
+    每个工作线程持有各自的数据集句柄，同时在途的分块数为 2 * workers。
+    """
+    year = int(year)
+    if os.path.exists(cube_path):
+        cube = open_cube(cube_path, mode="r+")
+    else:
+        with rasterio.open(next(iter(band_paths.values()))) as src:
+            genders = sorted({g for g, _ in band_paths})
+            ages = sorted({a for _, a in band_paths})
+            cube = create_cube(cube_path, src, genders, ages, chunk=chunk)
+
+    attrs = cube.attrs.asdict()
+    if year in attrs["complete_years"]:
+        return cube
+    cube_grid = grid_key(CubeGrid(attrs))
+    band_index = {}
+    for (gender, age), path in band_paths.items():
+        if gender not in attrs["genders"] or age not in attrs["ages"]:
+            raise ValueError(f"立方体中没有该波段（性别 {gender}, 年龄 {age}）: {path}")
+        with rasterio.open(path) as src:
+            if grid_key(src) != cube_grid:
+                raise ValueError(f"栅格格网与立方体不一致: {path}")
+        band_index[path] = (attrs["genders"].index(gender), attrs["ages"].index(age))
+
+    # 年份轴：已有（上次未完成）的年份原位重写，新年份追加一层
+    if year in attrs["years"]:
+        y = attrs["years"].index(year)
+    else:
+        y = cube.shape[0]
+        cube.resize((y + 1,) + tuple(cube.shape[1:]))
+        cube.attrs["years"] = attrs["years"] + [year]
+
+    n_genders, n_ages = cube.shape[1:3]
+    fill = attrs["nodata"]
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def open_handles():
+        local.srcs = {path: rasterio.open(path) for path in band_index}
+        with handles_lock:
+            handles.extend(local.srcs.values())
+
+    def write_chunk(row0, row1, col0, col1):
+        window = ((row0, row1), (col0, col1))
+        block = np.full((n_genders, n_ages, row1 - row0, col1 - col0), fill, dtype=cube.dtype)
+        for path, (g, a) in band_index.items():
+            block[g, a] = local.srcs[path].read(1, window=window)
+        cube[y, :, :, row0:row1, col0:col1] = block
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, initializer=open_handles) as executor:
+            pending = set()
+            for bounds in chunk_windows(cube):
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(write_chunk, *bounds))
+            for future in pending:
+                future.result()
+    finally:
+        for handle in handles:
+            handle.close()
+
+    cube.attrs["complete_years"] = cube_years(cube) + [year]
+    return cube
+
+
+def year_positions(cube, years=None):
+    """年份 -> 年份轴位置；years=None 时取全部已完成年份"""
+    attrs = cube.attrs.asdict()
+    complete = attrs["complete_years"]
+    years = complete if years is None else [int(y) for y in years]
+    missing = [y for y in years if y not in complete]
+    if missing:
+        raise ValueError(f"立方体中没有完整入库的年份: {missing}")
+    return years, np.array([attrs["years"].index(y) for y in years], dtype="int64")
+
+
+def cube_zonal_sums(cube, zones, pixels, n_zones, years=None, weights=None):
+    """
+    zones / pixels：立方体格网上的 (县行号, 展平像元) 成员列表（见 mask_index.get_grid_pixel_index）。
+    weights：与 pixels 等长的成员权重（见 coverage_weights.coverage_triplets），None 时权重均为 1。
+    按分块分组，只读取含成员像元的分块（按存储顺序），每块一次读出所选年份的全部波段。
+    返回 (年份列表, 形状为 (n_years, n_genders, n_ages, n_zones) 的 float64 数组)。
+    """
+    years, positions = year_positions(cube, years)
+    n_genders, n_ages, height, width = cube.shape[1:]
+    n_bands = len(positions) * n_genders * n_ages
+    totals = np.zeros((n_bands, n_zones), dtype="float64")
+    if len(pixels) == 0 or n_bands == 0:
+        return years, totals.reshape(len(positions), n_genders, n_ages, n_zones)
+
+    nodata = cube.attrs["nodata"]
+    chunk_h, chunk_w = cube.chunks[3:]
+    rows, cols = np.divmod(pixels, width)
+    chunk_id = (rows // chunk_h) * (-(-width // chunk_w)) + cols // chunk_w
+    order = np.argsort(chunk_id, kind="stable")
+    _, starts = np.unique(chunk_id[order], return_index=True)
+
+    band_offset = np.arange(n_bands, dtype="int64")[:, None] * n_zones
+    for members in np.split(order, starts[1:]):
+        r, c = rows[members], cols[members]
+        r0, c0 = int(r.min()), int(c.min())
+        block = cube.oindex[positions, :, :, r0:int(r.max()) + 1, c0:int(c.max()) + 1]
+        values = block[..., r - r0, c - c0].reshape(n_bands, len(members))
+        values = np.where(valid_mask(values, nodata), values, 0).astype("float64")
+        if weights is not None:
+            values *= weights[members][None, :]
+        key = (band_offset + zones[members][None, :]).ravel()
+        totals += np.bincount(key, weights=values.ravel(), minlength=n_bands * n_zones).reshape(n_bands, n_zones)
+    return years, totals.reshape(len(positions), n_genders, n_ages, n_zones)
+
+
+def main():
+    os.makedirs(os.path.dirname(os.path.abspath(cube_path)), exist_ok=True)
+    for year in target_years:
+        bands = find_year_bands(base_raster_folder, year)
+        if not bands:
+            print(f"⚠️ Skip: no bands found for {year}")
+            continue
+        if os.path.exists(cube_path) and int(year) in cube_years(open_cube(cube_path)):
+            print(f"✓ {year} 已入库")
+            continue
+        print(f"Ingesting {year}: {len(bands)} bands -> {cube_path}")
+        with span("datacube.ingest", year=year, bands=len(bands)):
+            ingest_year(cube_path, year, bands, chunk=chunk_size, workers=ingest_workers)
+    print("\nAll done!")
+
+
+if __name__ == "__main__":
+    with span("datacube"):
+        main()
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import multiprocessing.util
+from collections import defaultdict
+from contextlib import contextmanager
+
+'''
+分阶段计时与 I/O 计量（JSON Lines）
+    - 设置环境变量 WORLDPOP_PROFILE_DIR 后启用（进程池子进程继承环境变量，导入本模块时自动启用）；
+      未设置时 span() 直接返回，开销可忽略
+    - 每个进程写一个 profile_<pid>.jsonl，各行一条记录：
+        span：    名称、字段（区域 / 波段 / 阈值等）、耗时、CPU 时间、父 span、期间各栅格读取的字节数与分块数、
+                  进程峰值内存
+        process： 进程退出时的各栅格读取总量与峰值内存
+    - 栅格读取通过包装 rasterio 数据集的 read() 计量（调用处无需修改）；
+      分块数按读取窗口覆盖的内部分块估算，重复读取同一分块会重复计数（即使命中 GDAL 缓存）
+    - python profiling.py <目录>：汇总报告，按自身耗时（扣除子 span）对热点排序
+'''
+
+ENV_VAR = "WORLDPOP_PROFILE_DIR"
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_state = {"enabled": False, "file": None, "next_id": 0}
+_lock = threading.Lock()
+_local = threading.local()
+# 栅格路径 -> [字节数, 分块数, 调用次数]
+_reads = defaultdict(lambda: [0, 0, 0])
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def peak_memory_mb():
+    """进程峰值内存（MB）：psutil 可用时取峰值工作集 / RSS，否则用 resource（仅 POSIX）"""
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        peak = getattr(info, "peak_wset", None)   # Windows
+        if peak is not None:
+            return peak / 1024 ** 2
+    try:
+        import resource
+    except ImportError:
+        return psutil.Process().memory_info().rss / 1024 ** 2 if psutil is not None else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _write(record):
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _lock:
+        _state["file"].write(line)
+        _state["file"].flush()
+
+
+def _blocks_touched(src, window):
+    block_h, block_w = src.block_shapes[0]
+    if window is None:
+        row0, col0, height, width = 0, 0, src.height, src.width
+    else:
+        from rasterio.windows import Window
+        if not isinstance(window, Window):
+            window = Window.from_slices(*window, height=src.height, width=src.width)
+        row0, col0 = max(int(window.row_off), 0), max(int(window.col_off), 0)
+        height = min(int(window.row_off + window.height), src.height) - row0
+        width = min(int(window.col_off + window.width), src.width) - col0
+        if height <= 0 or width <= 0:
+            return 0
+    rows = (row0 + height - 1) // block_h - row0 // block_h + 1
+    cols = (col0 + width - 1) // block_w - col0 // block_w + 1
+    return rows * cols
+
+
+def _wrap_read(cls):
+    original = cls.read
+
+    def read(self, indexes=None, *args, **kwargs):
+        data = original(self, indexes, *args, **kwargs)
+        if _state["enabled"]:
+            if isinstance(indexes, int):
+                n_bands = 1
+            else:
+                n_bands = self.count if indexes is None else len(indexes)
+            try:
+                blocks = _blocks_touched(self, kwargs.get("window")) * n_bands
+            except Exception:
+                blocks = 0
+            counter = _reads[self.name]
+            with _lock:
+                counter[0] += getattr(data, "nbytes", 0)
+                counter[1] += blocks
+                counter[2] += 1
+        return data
+
+    read.__wrapped__ = original
+    cls.read = read
+
+
+def _instrument_rasterio():
+    try:
+        import rasterio.io
+        import rasterio.vrt
+    except ImportError:
+        return
+    for cls in (rasterio.io.DatasetReader, rasterio.vrt.WarpedVRT):
+        if not hasattr(cls.read, "__wrapped__"):
+            _wrap_read(cls)
+
+
+def _reads_snapshot():
+    with _lock:
+        return {path: tuple(v) for path, v in _reads.items()}
+
+
+def _reads_delta(before):
+    delta = {}
+    for path, (nbytes, blocks, calls) in _reads_snapshot().items():
+        b0, k0, c0 = before.get(path, (0, 0, 0))
+        if calls > c0:
+            delta[path] = {"bytes": nbytes - b0, "blocks": blocks - k0, "calls": calls - c0}
+    return delta
+
+
+def _on_exit():
+    if not _state["enabled"]:
+        return
+    reads = {path: {"bytes": b, "blocks": k, "calls": c} for path, (b, k, c) in _reads_snapshot().items()}
+    _write({"type": "process", "pid": os.getpid(), "argv": sys.argv,
+            "peak_mb": peak_memory_mb(), "reads": reads})
+    _state["file"].close()
+    _state["enabled"] = False
+
+
+def _open_file():
+    _state["file"] = open(os.path.join(_state["folder"], f"profile_{os.getpid()}.jsonl"), "a", encoding="utf-8")
+
+
+def _after_fork():
+    """fork 出的子进程（Linux 进程池）：改写自己的文件，清空继承来的 span 栈与读取计数"""
+    if not _state["enabled"]:
+        return
+    global _lock
+    _lock = threading.Lock()
+    _local.stack = []
+    _reads.clear()
+    _open_file()
+
+
+def _register_exit_hook(_=None):
+    """
+    进程池子进程退出时不执行 atexit，由 multiprocessing 的退出钩子写出进程汇总。
+    multiprocessing 在 fork 出的子进程中会清空继承来的退出钩子（在 os.register_at_fork 之后），
+    因此通过 register_after_fork 在子进程中重新注册。
+    """
+    if _state["enabled"]:
+        multiprocessing.util.Finalize(None, _on_exit, exitpriority=0)
+
+
+def enable(folder=None):
+    """开始写入 folder（默认取环境变量）下的 profile_<pid>.jsonl；子进程通过环境变量继承"""
+    if _state["enabled"]:
+        return
+    folder = folder or os.environ.get(ENV_VAR)
+    if not folder:
+        return
+    os.makedirs(folder, exist_ok=True)
+    os.environ[ENV_VAR] = folder
+    _state["folder"] = folder
+    _open_file()
+    _state["enabled"] = True
+    _instrument_rasterio()
+    atexit.register(_on_exit)
+    _register_exit_hook()
+    multiprocessing.util.register_after_fork(_register_exit_hook, _register_exit_hook)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork)
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    计时单元，例如 span("split_pop.job", region=..., band=...)；可嵌套，记录父 span。
+    fields 中的值需可 JSON 序列化（其它类型转为字符串）。
+    """
+    if not _state["enabled"]:
+        yield
+        return
+
+    with _lock:
+        span_id = f"{os.getpid()}-{_state['next_id']}"
+        _state["next_id"] += 1
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(span_id)
+
+    before = _reads_snapshot()
+    t0, c0 = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        _write({
+            "type": "span", "id": span_id, "parent": parent, "pid": os.getpid(),
+            "name": name, "fields": fields,
+            "start": time.time() - (time.perf_counter() - t0),
+            "wall_s": time.perf_counter() - t0, "cpu_s": time.process_time() - c0,
+            "reads": _reads_delta(before),
+            "peak_mb": peak_memory_mb(), "error": error,
+        })
+
+
+# ======== 汇总报告 ========
+def load_records(folder):
+    records = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.startswith("profile_") and filename.endswith(".jsonl"):
+            with open(os.path.join(folder, filename), encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def summarize(records):
+    """
+    返回 (按名称汇总的 span 列表, 按栅格汇总的读取列表)，均按降序排列。
+    自身耗时 = span 耗时 - 直接子 span 耗时之和（同一进程内嵌套），避免外层阶段把内层热点吞掉。
+    """
+    spans = [r for r in records if r["type"] == "span"]
+    child_wall = defaultdict(float)
+    for s in spans:
+        if s["parent"] is not None:
+            child_wall[s["parent"]] += s["wall_s"]
+
+    by_name = {}
+    for s in spans:
+        agg = by_name.setdefault(s["name"], {"name": s["name"], "count": 0, "wall_s": 0.0, "self_s": 0.0,
+                                             "cpu_s": 0.0, "max_s": 0.0, "read_mb": 0.0, "blocks": 0,
+                                             "peak_mb": 0.0, "errors": 0})
+        own_reads = s["reads"]
+        agg["count"] += 1
+        agg["wall_s"] += s["wall_s"]
+        agg["self_s"] += max(0.0, s["wall_s"] - child_wall[s["id"]])
+        agg["cpu_s"] += s["cpu_s"]
+        agg["max_s"] = max(agg["max_s"], s["wall_s"])
+        agg["read_mb"] += sum(r["bytes"] for r in own_reads.values()) / 1024 ** 2
+        agg["blocks"] += sum(r["blocks"] for r in own_reads.values())
+        agg["peak_mb"] = max(agg["peak_mb"], s["peak_mb"] or 0.0)
+        agg["errors"] += s["error"] is not None
+
+    # 各栅格读取量取自进程汇总；被强制结束、没有汇总记录的进程用其顶层 span 的读取量代替
+    rasters = defaultdict(lambda: {"bytes": 0, "blocks": 0, "calls": 0})
+    finished = {r["pid"] for r in records if r["type"] == "process"}
+    sources = [r["reads"] for r in records if r["type"] == "process"]
+    sources += [s["reads"] for s in spans if s["parent"] is None and s["pid"] not in finished]
+    for reads in sources:
+        for path, stats in reads.items():
+            for key in ("bytes", "blocks", "calls"):
+                rasters[path][key] += stats[key]
+
+    ranked_spans = sorted(by_name.values(), key=lambda a: -a["self_s"])
+    ranked_rasters = sorted(({"path": p, **v} for p, v in rasters.items()), key=lambda r: -r["bytes"])
+    return ranked_spans, ranked_rasters
+
+
+def print_report(folder, top=20):
+    records = load_records(folder)
+    if not records:
+        print(f"❌ 没有找到计量记录: {folder}")
+        return
+    spans, rasters = summarize(records)
+    total_self = sum(a["self_s"] for a in spans) or 1.0
+
+    print(f"\n热点（按自身耗时排序，共 {len(spans)} 类 span）")
+    print(f"{'名称':<32}{'次数':>8}{'自身 s':>10}{'占比':>8}{'总耗时 s':>10}{'CPU s':>10}"
+          f"{'最长 s':>10}{'读取 MB':>10}{'分块数':>10}{'峰值 MB':>10}")
+    for a in spans[:top]:
+        print(f"{a['name']:<32}{a['count']:>8}{a['self_s']:>10.2f}{a['self_s'] / total_self:>8.1%}"
+              f"{a['wall_s']:>10.2f}{a['cpu_s']:>10.2f}{a['max_s']:>10.2f}{a['read_mb']:>10.1f}"
+              f"{a['blocks']:>10}{a['peak_mb']:>10.0f}"
+              + (f"  ⚠ {a['errors']} 个出错" if a["errors"] else ""))
+
+    if rasters:
+        print(f"\n读取量最大的栅格（共 {len(rasters)} 个）")
+        print(f"{'读取 MB':>10}{'分块数':>10}{'调用':>8}  路径")
+        for r in rasters[:top]:
+            print(f"{r['bytes'] / 1024 ** 2:>10.1f}{r['blocks']:>10}{r['calls']:>8}  {r['path']}")
+
+
+# 进程池子进程导入本模块时按环境变量自动启用
+enable()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python profiling.py <计量目录> [显示条数]")
+        sys.exit(1)
+    print_report(sys.argv[1], top=int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -1,45 +1,72 @@
 import os
-import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+import boundary_cache
+from boundary_cache import entry_key, build_entry, Boundaries
+
+'''
+边界缓存并行预构建（见 boundary_cache.py）
+    ✅ input_folder 下的全部区域 SHP 与 extra_sources（全国县界）按 [dst_crs] + extra_crs 各构建一份
+       预投影 GeoParquet 缓存，各脚本之后直接读取缓存，不再各自读取 SHP、重投影、重建空间索引
+    ✅ (文件, CRS) 任务在进程池中并行；缓存键取决于源文件内容，已构建的条目直接跳过
+    ✅ output_folder 不为 None 时，仍按原目录结构导出 dst_crs 投影的 SHP（由缓存写出）
+'''
 
 # 输入文件夹
 input_folder = "./USA/split"
 
-# 输出文件夹
+# 输出文件夹（None 表示只构建缓存，不导出 SHP）
 output_folder = "./USA/split3857"
-os.makedirs(output_folder, exist_ok=True)
 
 # 目标投影
 dst_crs = "EPSG:3857"
 
-# 遍历所有子文件夹
-for root, dirs, files in os.walk(input_folder):
+# 额外缓存的投影与源文件
+extra_crs = ["EPSG:4326"]
+extra_sources = [r"USA\gadm41_USA_2.shp"]
+
+cache_folder = boundary_cache.cache_root
+max_workers = None   # None 表示使用全部核心
 
-    for filename in files:
-        if not filename.lower().endswith(".shp"):
-            continue
 
-        src_path = os.path.join(root, filename)
+def build_task(src_path, crs, key, export_path, cache_dir):
+    entry = build_entry(src_path, crs, key, cache_dir)
+    if export_path:
+        os.makedirs(os.path.dirname(export_path), exist_ok=True)
+        Boundaries(entry).gdf.to_file(export_path, encoding="utf-8")
+    return src_path, crs, export_path
 
-        # 保持与输入相同的子目录结构
-        rel_path = os.path.relpath(root, input_folder)
-        out_dir = os.path.join(output_folder, rel_path)
-        os.makedirs(out_dir, exist_ok=True)
 
-        # 输出文件路径
-        out_name = filename.replace(".shp", ".shp")
-        dst_path = os.path.join(out_dir, out_name)
-        print(f"Processing: {src_path}")
+def main():
+    # 遍历所有子文件夹，保持与输入相同的子目录结构
+    tasks = []
+    for root, dirs, files in os.walk(input_folder):
+        for filename in files:
+            if not filename.lower().endswith(".shp"):
+                continue
+            src_path = os.path.join(root, filename)
+            export_path = None
+            if output_folder:
+                export_path = os.path.join(output_folder, os.path.relpath(root, input_folder), filename)
+            tasks.append((src_path, dst_crs, export_path))
+            tasks.extend((src_path, crs, None) for crs in extra_crs)
+    for src_path in extra_sources:
+        if os.path.exists(src_path):
+            tasks.extend((src_path, crs, None) for crs in [dst_crs] + list(extra_crs))
 
-        # 读取矢量数据
-        gdf = gpd.read_file(src_path)
+    # 内容哈希在主进程计算（结果缓存在 hash_cache.json 中），进程只负责读取、投影与写出
+    keyed = [(src_path, crs, entry_key(src_path, crs, cache_folder), export_path)
+             for src_path, crs, export_path in tqdm(tasks, desc="Hashing")]
 
-        # 重投影
-        gdf_3857 = gdf.to_crs(dst_crs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(build_task, *task, cache_folder) for task in keyed]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Building"):
+            src_path, crs, export_path = future.result()
+            if export_path:
+                print(f"Saved: {export_path}")
 
-        # 写出转换后的矢量文件
-        gdf_3857.to_file(dst_path, encoding="utf-8")
+    print(f"全部边界缓存完成 ✔ ({len(keyed)} 个条目 -> {cache_folder})")
 
-        print(f"Saved: {dst_path}")
 
-print("全部 SHP 投影到 EPSG:3857 完成 ✔")
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,163 @@
 import os
+import numpy as np
 import rasterio
-from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
+from rasterio.warp import reproject, transform_bounds, Resampling
+from pyproj import Transformer
+from profiling import span
 
 '''
 自动裁剪 & 重采样噪音数据，使其格网与人口数据对齐
 输入：
     - population_folder: 已处理的人口数据文件夹（EPSG:3857, 100m）
-    - noise_path: 原始噪音大影像（整幅）
+    - noise_path_template: 原始噪音大影像（整幅），按 (年份, 时段) 填充
 输出：
     - 按人口区域裁剪 & 对齐后的噪音数据（分辨率100m）
+    ✅ 只读取每个人口切片覆盖范围下的源窗口（按源像元跨度外扩给双线性卷积核），交给 GDAL reproject，
+       不再整幅遍历噪音影像
+    ✅ 所有 (年份, 时段) 情景在一次切片遍历中完成对齐
+    ✅ 输出先写 *.partial.tif 再改名，已存在的输出直接跳过，中断后重跑从断点继续
 '''
 
 # === 配置 ===
-year = 2023
-day = "oneday"
-population_folder = rf"F:\wordpop_USA\both\2023\clip\usa\f\00"  # 人口数据
-noise_path = rf"F:\机场噪音\SEL_{day}_{year}10_95.tiff"             # 原始大影像
-output_folder = rf"./noise/USA_tiles/{year}/{day}/noise_aligned"
-os.makedirs(output_folder, exist_ok=True)
-
-# === 扫描人口数据文件 ===
-pop_files = [f for f in os.listdir(population_folder) if f.endswith(".tif")]
-
-for pop_file in pop_files:
-    pop_path = os.path.join(population_folder, pop_file)
-    
-    # 输出噪音文件名
-    region_name = pop_file.replace("_clip_3857.tif", "")
-    out_noise_path = os.path.join(output_folder, f"{region_name}_aligned.tif")
-    
-    with rasterio.open(pop_path) as pop_src, rasterio.open(noise_path) as noise_src:
+years = [2023]
+days = ["oneday", "night"]
+population_folder = rf"F:\wordpop_USA\both\2023\clip\usa\f\00"  # 人口数据（只用于取格网，各年份相同）
+noise_path_template = r"F:\机场噪音\SEL_{day}_{year}10_95.tiff"  # 原始大影像
+output_template = r"./noise/USA_tiles/{year}/{day}/noise_aligned"
+
+
+def scenarios():
+    """存在源影像的 (年份, 时段, 噪音路径, 输出目录)"""
+    found = []
+    for year in years:
+        for day in days:
+            noise_path = noise_path_template.format(year=year, day=day)
+            if not os.path.exists(noise_path):
+                print(f"⚠ 未找到噪音影像（跳过）: {noise_path}")
+                continue
+            found.append((year, day, noise_path, output_template.format(year=year, day=day)))
+    return found
+
+
+def grid_of(ds):
+    return {"crs": ds.crs, "transform": ds.transform, "width": ds.width, "height": ds.height}
+
+
+def _src_coords(to_src, inverse, transform, cols, rows):
+    """目标像元中心 -> 源影像的连续行列坐标（像元边界为整数）"""
+    xs, ys = transform * (cols, rows)
+    x, y = to_src.transform(xs, ys)
+    return inverse * (np.asarray(x), np.asarray(y))
+
+
+def estimate_scale(tile, src, n_sample=16):
+    """
+    源像元在目标像元上的跨度（> 1 表示源影像比目标更细），由 n_sample × n_sample 个采样目标像元
+    与其右侧、下方相邻像元的源坐标差估计
+    """
+    to_src = Transformer.from_crs(tile["crs"], src.crs, always_xy=True)
+    inverse = ~src.transform
+    width, height = tile["width"], tile["height"]
+    cc, rr = np.meshgrid(np.linspace(0, width - 1, min(n_sample, width)) + 0.5,
+                         np.linspace(0, height - 1, min(n_sample, height)) + 0.5)
+    u, v = _src_coords(to_src, inverse, tile["transform"], cc.ravel(), rr.ravel())
+    scale = 0
+    for dc, dr in ((1, 0), (0, 1)):
+        u1, v1 = _src_coords(to_src, inverse, tile["transform"], cc.ravel() + dc, rr.ravel() + dr)
+        step = np.hypot(u1 - u, v1 - v)
+        step = step[np.isfinite(step)]
+        if len(step):
+            scale = max(scale, float(np.median(step)))
+    return scale
+
+
+def footprint_window(tile, noise_src, pad):
+    """切片范围投影到源影像后的窗口（外扩 pad 个像元给卷积核），与源影像不相交时返回 None"""
+    bounds = rasterio.transform.array_bounds(tile["height"], tile["width"], tile["transform"])
+    left, bottom, right, top = transform_bounds(tile["crs"], noise_src.crs, *bounds, densify_pts=21)
+    window = noise_src.window(left, bottom, right, top)
+    col0, row0 = int(np.floor(window.col_off)) - pad, int(np.floor(window.row_off)) - pad
+    col1 = int(np.ceil(window.col_off + window.width)) + pad
+    row1 = int(np.ceil(window.row_off + window.height)) + pad
+    window = Window(col0, row0, col1 - col0, row1 - row0)
+    try:
+        return window.intersection(Window(0, 0, noise_src.width, noise_src.height))
+    except rasterio.errors.WindowError:
+        return None
+
+
+def align_with_gdal(tile, noise_src, nodata, dst, pad):
+    """只读取切片覆盖范围下的源窗口，交给 GDAL reproject（双线性）"""
+    window = footprint_window(tile, noise_src, pad)
+    if window is None:
+        dst.write(np.full((tile["height"], tile["width"]), nodata, dtype=noise_src.dtypes[0]), 1)
+        return
+    reproject(
+        source=noise_src.read(1, window=window),
+        destination=rasterio.band(dst, 1),
+        src_transform=noise_src.window_transform(window),
+        src_crs=noise_src.crs,
+        dst_transform=tile["transform"],         # 人口影像 transform
+        dst_crs=tile["crs"],                     # 人口影像 CRS
+        dst_width=tile["width"],                 # 人口影像宽高
+        dst_height=tile["height"],
+        resampling=Resampling.bilinear,
+        src_nodata=nodata,
+        dst_nodata=nodata
+    )
+
+
+def align_tile(pop_path, sources):
+    """对一个人口切片对齐所有情景（已存在的输出跳过），先写 *.partial.tif 再改名"""
+    region_name = os.path.basename(pop_path).replace("_clip_3857.tif", "")
+    with rasterio.open(pop_path) as pop_src:
+        tile = grid_of(pop_src)
         pop_meta = pop_src.meta.copy()
-        pop_nodata = pop_src.nodata if pop_src.nodata is not None else -9999
-        noise_nodata = noise_src.nodata if noise_src.nodata is not None else -9999
-
-        # 更新输出元信息
-        pop_meta.update({
-            "dtype": noise_src.dtypes[0],  # 使用噪音数据类型
-            "nodata": noise_nodata
-        })
-
-        # === 直接重采样噪音影像到人口栅格（完全对齐） ===
-        with rasterio.open(out_noise_path, "w", **pop_meta) as dst:
-            reproject(
-                source=rasterio.band(noise_src, 1),      # 原始噪音影像
-                destination=rasterio.band(dst, 1),       # 输出影像
-                src_transform=noise_src.transform,
-                src_crs=noise_src.crs,
-                dst_transform=pop_src.transform,         # 人口影像 transform
-                dst_crs=pop_src.crs,                     # 人口影像 CRS
-                dst_width=pop_src.width,                 # 人口影像宽高
-                dst_height=pop_src.height,
-                resampling=Resampling.bilinear,          # 或 nearest
-                src_nodata=noise_nodata,
-                dst_nodata=noise_nodata
-            )
-
-    print(f"✓ 噪音数据已裁剪并对齐输出: {out_noise_path}")
-
-print("\n🎉 所有噪音数据已完成裁剪与对齐！")
+
+    for (year, day, noise_path, output_folder), (noise_src, nodata) in sources.items():
+        out_path = os.path.join(output_folder, f"{region_name}_aligned.tif")
+        if os.path.exists(out_path):
+            continue
+        tmp_path = out_path[:-len(".tif")] + ".partial.tif"
+        meta = dict(pop_meta, dtype=noise_src.dtypes[0], nodata=nodata)  # 使用噪音数据类型
+        # 源影像比目标更细时 GDAL 放大卷积核，窗口按采样估计的跨度外扩
+        pad = int(np.ceil(max(estimate_scale(tile, noise_src), 1))) + 2
+        with rasterio.open(tmp_path, "w", **meta) as dst:
+            align_with_gdal(tile, noise_src, nodata, dst, pad=pad)
+        os.replace(tmp_path, out_path)
+        print(f"✓ 噪音数据已裁剪并对齐输出: {out_path}")
+
+
+def main():
+    found = scenarios()
+    if not found:
+        print("❌ 没有可用的噪音影像")
+        return
+    for _, _, _, output_folder in found:
+        os.makedirs(output_folder, exist_ok=True)
+
+    # === 扫描人口数据文件 ===
+    pop_files = sorted(f for f in os.listdir(population_folder) if f.endswith(".tif"))
+
+    # 所有情景的源影像只打开一次，整个切片遍历中保持打开
+    sources = {}
+    try:
+        for year, day, noise_path, output_folder in found:
+            noise_src = rasterio.open(noise_path)
+            noise_nodata = noise_src.nodata if noise_src.nodata is not None else -9999
+            sources[(year, day, noise_path, output_folder)] = (noise_src, noise_nodata)
+
+        for pop_file in pop_files:
+            with span("resample_bianli.tile", tile=pop_file, scenarios=len(sources)):
+                align_tile(os.path.join(population_folder, pop_file), sources)
+    finally:
+        for noise_src, _ in sources.values():
+            noise_src.close()
+
+    print("\n🎉 所有噪音数据已完成裁剪与对齐！")
+
+
+if __name__ == "__main__":
+    with span("resample_bianli"):
+        main()
@@ -0,0 +1,133 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+'''
+列式分区结果库（Parquet）
+    - build_frame：直接由统计数组（组合 × 县）构建列，不再逐行 iterrows 拼字典
+    - GID_2 / NAME_1 / NAME_2 存为类别列（dictionary 编码）
+    - write_results：按 Year / Day / Noise_Threshold / Gender / Age 分区写入（hive 目录结构）
+    - read_results / sum_results：过滤条件（如 Noise_Threshold == 40）下推到分区，只扫描需要的文件与列
+'''
+
+# 分区维度（按此顺序组织目录）及其类型
+DIMENSIONS = {
+    "Year": pa.int16(),
+    "Day": pa.string(),
+    "Noise_Threshold": pa.int16(),
+    "Gender": pa.string(),
+    "Age": pa.string(),
+}
+
+NAME_COLUMNS = ["GID_2", "NAME_1", "NAME_2"]
+
+
+def build_frame(counties, values, value_name, **dims):
+    """
+    values: 形状为 (n_groups, n_counties) 的数组（单个组合时可为 (n_counties,)），列顺序与 counties 行顺序一致
+    dims:   维度列，取值为标量（所有组合相同）或长度为 n_groups 的序列
+    返回长表：每个组合 × 每个县一行
+    """
+    n_counties = len(counties)
+    values = np.asarray(values).reshape(-1, n_counties)
+    n_groups = values.shape[0]
+    county_pos = np.tile(np.arange(n_counties), n_groups)
+
+    data = {}
+    for col in NAME_COLUMNS:
+        codes, uniques = pd.factorize(counties[col].to_numpy())
+        data[col] = pd.Categorical.from_codes(codes[county_pos], categories=uniques)
+
+    for name, value in dims.items():
+        if np.ndim(value) == 0:
+            data[name] = np.full(n_groups * n_counties, value)
+        else:
+            value = np.asarray(value)
+            if len(value) != n_groups:
+                raise ValueError(f"维度 {name} 长度 {len(value)} 与组合数 {n_groups} 不一致")
+            data[name] = np.repeat(value, n_counties)
+
+    data[value_name] = values.ravel()
+    return pd.DataFrame(data)
+
+
+def write_results(df, root, part_name):
+    """
+    将结果追加写入 root 下的分区目录。
+    part_name 用作文件名前缀（例如区域名），重跑同一部分时先删除该部分的旧文件，不会重复写入，
+    也不会在本次没有数据的分区中留下旧结果；删除范围限于 df 中取值唯一的前导分区（如同一 Year / Day）。
+    """
+    partition_cols = [d for d in DIMENSIONS if d in df.columns]
+    prefix = []
+    for col in partition_cols:
+        values = df[col].unique()
+        if len(values) != 1:
+            break
+        prefix.append(f"{col}={values[0]}")
+    remove_part(os.path.join(root, *prefix), part_name)
+    fields = []
+    for col in df.columns:
+        if col in DIMENSIONS:
+            fields.append(pa.field(col, DIMENSIONS[col]))
+        elif col in NAME_COLUMNS:
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(col, pa.from_numpy_dtype(df[col].dtype)))
+
+    table = pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
+    os.makedirs(root, exist_ok=True)
+    pq.write_to_dataset(
+        table,
+        root,
+        partition_cols=partition_cols,
+        basename_template=f"{part_name}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def remove_part(root, part_name):
+    """删除 root（或其下某个分区目录）中 part_name 写出的文件（{part_name}-{i}.parquet）"""
+    pattern = re.compile(re.escape(part_name) + r"-\d+\.parquet")
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if pattern.fullmatch(filename):
+                os.remove(os.path.join(dirpath, filename))
+
+
+def _partitioning(root):
+    """从目录名（key=value）识别该结果库实际使用的分区维度"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        if any(f.endswith(".parquet") for f in filenames):
+            rel = os.path.relpath(dirpath, root)
+            keys = [p.split("=", 1)[0] for p in rel.split(os.sep) if "=" in p]
+            schema = pa.schema([(k, DIMENSIONS.get(k, pa.string())) for k in keys])
+            return ds.partitioning(schema, flavor="hive")
+    return None
+
+
+def open_results(root):
+    return ds.dataset(root, format="parquet", partitioning=_partitioning(root))
+
+
+def read_results(root, filters=None, columns=None):
+    """
+    读取结果库。filters 使用 pyarrow 的写法，例如：
+        [("Year", "==", 2023), ("Noise_Threshold", "==", 40)]
+    分区维度上的条件直接裁剪目录，不会读取无关文件。
+    """
+    dataset = open_results(root)
+    expr = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(filter=expr, columns=columns).to_pandas()
+
+
+def sum_results(root, value_name, filters=None, by=None):
+    """过滤后按 by 分组求和（by=None 时返回全国总数），只扫描需要的列"""
+    by = [by] if isinstance(by, str) else list(by or [])
+    df = read_results(root, filters=filters, columns=by + [value_name])
+    if not by:
+        return df[value_name].sum()
+    return df.groupby(by, observed=True)[value_name].sum()
@@ -1,9 +1,22 @@
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import geopandas as gpd
+import shapely
 from shapely.geometry import box
 import rasterio
-from rasterio.mask import mask
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import rasterio.shutil
+from rasterio.enums import Resampling as OverviewResampling
+from rasterio.features import geometry_window
+from rasterio.mask import mask, raster_geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds, Resampling
+from pyproj import Transformer
+from profiling import span
+from boundary_cache import load_boundaries, release_boundaries
 
 
 '''
@@ -12,6 +25,16 @@ from rasterio.warp import calculate_default_transform, reproject, Resampling
     输出影像：EPSG:3857，分辨率=100m
     输出目录：clip/<region>/<age>/<shpName>_clip_3857.tif
     ✅ 已处理 NoData，避免负值
+    ✅ 同一源格网上的所有波段共用一个最近邻重采样计划（目标像元 -> 源像元索引表），
+       第一个波段之后只需按索引取值，不再逐个执行 GDAL 重投影；计划缓存在磁盘上，换年份重跑时直接复用
+    ✅ stream 模式：通过 WarpedVRT 虚拟重投影，按输出分块逐块读取所需的源窗口，峰值内存只与分块大小有关
+    ✅ (波段, 区域) 任务可在进程池中并行：GDAL 缓存与线程总预算按进程数均分，大区域优先调度，
+       完成的输出记录在 ledger 中，中断后重跑从断点继续
+    ✅ 直接输出分块 + 压缩 + 内部金字塔的 GeoTIFF，不再需要 compress.py 二次压缩，
+       后续 resample_bianli / agesex_pop_stats 也能按分块高效窗口读取
+       ⚠ 默认（cog_layout = False）输出不是严格的 COG：分块、压缩与金字塔齐全，但字节布局（IFD / 金字塔在前）
+         未按 COG 规范排列，本地窗口读取不受影响；需要真正的 COG（对象存储 HTTP 范围读取、COG 校验）时
+         设 cog_layout = True，写完后再经 COG 驱动复制一次
 '''
 
 
@@ -23,126 +46,591 @@ output_root = rf"G:\US\{year}\clip"
 buffer_distance = 1000   # 扩充 1000m（EPSG:3857）
 
 TARGET_RES = 100   # 输出影像分辨率 = 100 米
+DST_CRS = "EPSG:3857"
+
+# "plan"：按区域构建/复用最近邻重采样计划后逐波段取值
+# "stream"：WarpedVRT 按输出分块流式裁切重投影（大区域 / 阿拉斯加推荐，内存占用最小）
+# "gdal"：每个 (tif, 区域) 都执行 mask + reproject（原方式）
+warp_mode = "plan"
+plan_cache_folder = r"./cache/warp_plans"
+warp_mem_limit_mb = 256      # stream 模式 GDAL 重投影工作内存上限
+
+# 并行调度：max_workers > 1 时 (波段, 区域) 任务分发到进程池，None 表示使用全部核心
+max_workers = 1
+gdal_cache_total_mb = 4096               # 所有进程合计的 GDAL 块缓存
+gdal_threads_total = os.cpu_count() or 1  # 所有进程合计的 GDAL 线程数
+ledger_name = "_split_done.jsonl"        # 完成记录（位于 output_root 下）
+
+# === 输出格式：分块 + 压缩 + 内部金字塔的 GeoTIFF，裁切时一次写出（cog_layout = True 时才是严格 COG） ===
+cog_compress = "ZSTD"             # ZSTD / DEFLATE / LZW / LERC / NONE
+cog_predictor = "auto"            # auto：浮点数据用 3（浮点预测），整型用 2；也可指定 1 / 2 / 3
+cog_creation_options = {}         # 其它 GTiff 创建选项，例如 {"ZSTD_LEVEL": 9} 或 {"MAX_Z_ERROR": 0}（COG 驱动下自动改名）
+cog_block_size = 512              # 分块边长（像元，需为 16 的倍数；stream 模式也按此分块处理）
+cog_overview_resampling = "nearest"
+cog_layout = False                # False：分块 GTiff（非严格 COG）；True：写完后经 COG 驱动重排为严格的 COG 字节布局
+
+
+def load_regions(folder):
+    """启动时读取一次所有区域 SHP，求外包框 + buffer，并投影到 4326 用于裁切"""
+    regions = []
+    for shp_file in sorted(os.listdir(folder)):
+        if not shp_file.endswith(".shp"):
+            continue
 
-# === 扫描目录中的所有 TIF 文件 ===
-tif_files = [f for f in os.listdir(tif_folder) if f.lower().endswith(".tif")]
-
-if not tif_files:
-    print("❌ 没有找到任何 TIF 文件")
-    exit()
-
-print(f"共检测到 {len(tif_files)} 个 TIF 文件，将逐个处理。\n")
-
-
-# === 遍历所有 TIF ===
-for tif_file in tif_files:
-
-    print(f"\n============================")
-    print(f"当前处理影像：{tif_file}")
-    print(f"============================")
+        # 1. 读取 SHP（3857，预投影边界缓存，只需外包框）
+        shp_path = os.path.join(folder, shp_file)
+        boundaries = load_boundaries(shp_path, DST_CRS)
 
-    tif_path = os.path.join(tif_folder, tif_file)
+        # 求整体 bounding box + buffer
+        minx, miny, maxx, maxy = boundaries.total_bounds
+        release_boundaries(shp_path, DST_CRS)
+        rect = box(minx, miny, maxx, maxy)
+        rect_buffered = rect.buffer(buffer_distance)
 
-    # === 解析命名 ===
+        # 投影到 4326 用于裁切
+        rect_4326 = gpd.GeoSeries([rect_buffered], crs=DST_CRS).to_crs("EPSG:4326").geometry[0]
+        regions.append({
+            "shp_file": shp_file,
+            "name": os.path.splitext(shp_file)[0],
+            "rect_3857": rect_buffered,
+            "rect_4326": rect_4326,
+        })
+    return regions
+
+
+def parse_tif_name(tif_file):
+    """usa_f_00_2023_... -> (地区, 性别, 年龄, 年份)；命名不符合时返回 None"""
     parts = tif_file.split("_")
     if len(parts) < 4:
-        print(f"⚠ 文件命名不符合预期格式（跳过）: {tif_file}")
-        continue
+        return None
+    return parts[0], parts[1], parts[2], parts[3]
+
+
+def dst_grid(src_crs, clip_transform, clip_height, clip_width):
+    """裁切结果重投影到 3857（分辨率 = 100m）的目标格网"""
+    return calculate_default_transform(
+        src_crs, DST_CRS,
+        clip_width, clip_height,
+        *rasterio.transform.array_bounds(clip_height, clip_width, clip_transform),
+        resolution=TARGET_RES
+    )
+
+
+# GTiff 创建选项 -> COG 驱动同义选项；GTIFF_LAYOUT_OPTIONS 由 COG 驱动自行决定，复制时丢弃
+COG_OPTION_NAMES = {"ZSTD_LEVEL": "LEVEL", "ZLEVEL": "LEVEL", "LZMA_PRESET": "LEVEL",
+                    "JPEG_QUALITY": "QUALITY", "WEBP_LEVEL": "QUALITY"}
+GTIFF_LAYOUT_OPTIONS = {"TILED", "BLOCKXSIZE", "BLOCKYSIZE", "INTERLEAVE", "COPY_SRC_OVERVIEWS", "PREDICTOR"}
+COG_PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+
+
+def gtiff_predictor(dtype):
+    """cog_predictor 为 auto 时：浮点数据用 3（浮点预测），整型用 2"""
+    if cog_predictor != "auto":
+        return int(cog_predictor)
+    return 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+
+def cog_options(dtype):
+    """COG 驱动的创建选项：cog_creation_options 按 COG_OPTION_NAMES 改名，GTiff 布局选项丢弃"""
+    options = {"BLOCKSIZE": cog_block_size, "OVERVIEWS": "FORCE_USE_EXISTING"}
+    if cog_compress and cog_compress.upper() != "NONE":
+        options.update({"COMPRESS": cog_compress, "PREDICTOR": COG_PREDICTORS[gtiff_predictor(dtype)]})
+    for name, value in cog_creation_options.items():
+        name = name.upper()
+        if name not in GTIFF_LAYOUT_OPTIONS:
+            options[COG_OPTION_NAMES.get(name, name)] = value
+    return options
+
+
+def output_meta(src, transform, width, height, nodata):
+    """输出文件的创建参数：3857 目标格网 + 分块压缩"""
+    meta = src.meta.copy()
+    meta.update({
+        "crs": DST_CRS,
+        "transform": transform,
+        "width": width,
+        "height": height,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": cog_block_size,
+        "blockysize": cog_block_size,
+    })
+    if cog_compress and cog_compress.upper() != "NONE":
+        meta.update({"compress": cog_compress, "predictor": gtiff_predictor(src.dtypes[0])})
+    meta.update(cog_creation_options)
+    return meta
+
+
+def build_overviews(dst):
+    """在同一次写出中生成内部金字塔（缩放到不足一个分块为止）"""
+    factors = []
+    factor = 2
+    while max(dst.width, dst.height) / factor >= cog_block_size:
+        factors.append(factor)
+        factor *= 2
+    if factors:
+        dst.build_overviews(factors, OverviewResampling[cog_overview_resampling])
+        dst.update_tags(ns="rio_overview", resampling=cog_overview_resampling)
+
+
+def to_cog_layout(path, output_path):
+    """可选：经 COG 驱动复制为严格 COG 布局（复用已生成的金字塔）"""
+    with rasterio.open(path) as src:
+        dtype = src.dtypes[0]
+    rasterio.shutil.copy(path, output_path, driver="COG", **cog_options(dtype))
+
+
+def plan_key(src, region):
+    h = hashlib.sha1()
+    h.update(src.crs.to_wkt().encode())
+    h.update(repr((tuple(src.transform)[:6], src.width, src.height)).encode())
+    h.update(region["rect_4326"].wkb)
+    h.update(repr((TARGET_RES, DST_CRS)).encode())
+    return h.hexdigest()[:20]
+
+
+def _separable_axes(to_src, transform, inverse, width, height, n_check=256, tol=1e-6):
+    """
+    若目标像元中心对应的源列只取决于目标列、源行只取决于目标行（无旋转且投影可分离，如 3857 -> 4326），
+    返回 (每个目标列的源列坐标, 每个目标行的源行坐标)，否则返回 None。
+    通过随机抽样像元的完整反投影验证，误差需小于 tol 个源像元。
+    """
+    if transform.b != 0 or transform.d != 0 or inverse.b != 0 or inverse.d != 0:
+        return None
+
+    cols = np.arange(width) + 0.5
+    rows = np.arange(height) + 0.5
+    xs = transform.c + cols * transform.a
+    ys = transform.f + rows * transform.e
+    lon, _ = to_src.transform(xs, np.full(width, ys[height // 2]))
+    _, lat = to_src.transform(np.full(height, xs[width // 2]), ys)
+    src_col = inverse.c + np.asarray(lon) * inverse.a
+    src_row = inverse.f + np.asarray(lat) * inverse.e
+
+    rng = np.random.default_rng(0)
+    ci = rng.integers(0, width, n_check)
+    ri = rng.integers(0, height, n_check)
+    check_lon, check_lat = to_src.transform(xs[ci], ys[ri])
+    check_col, check_row = inverse * (np.asarray(check_lon), np.asarray(check_lat))
+    if np.max(np.abs(check_col - src_col[ci])) > tol or np.max(np.abs(check_row - src_row[ri])) > tol:
+        return None
+    return src_col, src_row
+
+
+def build_warp_plan(src, region, rows_per_chunk=512):
+    """
+    最近邻重采样计划：
+        window    源影像中需要读取的裁切窗口（与 mask(crop=True) 相同）
+        index     (height, width) 目标像元对应的窗口内展平索引，-1 表示无数据（区域外或被多边形掩膜）
+        transform / width / height  目标格网
+    目标像元中心反投影到源坐标后取所在的源像元，与 GDAL nearest 规则一致。
+    区域不在影像覆盖范围内时返回 None。
+    """
+    try:
+        shape_mask, clip_transform, window = raster_geometry_mask(
+            src, [region["rect_4326"].__geo_interface__], crop=True
+        )
+    except ValueError:
+        return None
+
+    clip_height, clip_width = shape_mask.shape
+    transform, width, height = dst_grid(src.crs, clip_transform, clip_height, clip_width)
+
+    to_src = Transformer.from_crs(DST_CRS, src.crs, always_xy=True)
+    inverse = ~clip_transform
+    index_dtype = "int32" if clip_height * clip_width < 2 ** 31 else "int64"
+    index = np.empty((height, width), dtype=index_dtype)
+    cols = np.arange(width) + 0.5
+    flat_mask = shape_mask.ravel()
+
+    def to_index(src_col, src_row):
+        src_col = np.floor(src_col)
+        src_row = np.floor(src_row)
+        inside = (src_col >= 0) & (src_col < clip_width) & (src_row >= 0) & (src_row < clip_height)
+        flat = np.where(inside, src_row * clip_width + src_col, -1).astype(index_dtype)
+        flat[inside] = np.where(flat_mask[flat[inside]], -1, flat[inside])
+        return flat
+
+    separable = _separable_axes(to_src, transform, inverse, width, height)
+    if separable is not None:
+        # 3857 -> 4326 等经纬度可分离的投影：源列只取决于目标列，源行只取决于目标行
+        src_col, src_row = separable
+        for row0 in range(0, height, rows_per_chunk):
+            rr = src_row[row0:row0 + rows_per_chunk]
+            index[row0:row0 + len(rr)] = to_index(*np.broadcast_arrays(src_col[None, :], rr[:, None]))
+    else:
+        for row0 in range(0, height, rows_per_chunk):
+            rows = np.arange(row0, min(row0 + rows_per_chunk, height)) + 0.5
+            cc, rr = np.meshgrid(cols, rows)
+            xs, ys = transform * (cc, rr)
+            lon, lat = to_src.transform(xs, ys)
+            index[row0:row0 + len(rows)] = to_index(*(inverse * (lon, lat)))
+
+    return {
+        "window": window,
+        "index": index,
+        "transform": transform,
+        "width": width,
+        "height": height,
+    }
+
+
+def load_or_build_plan(src, region, cache_dir):
+    """读取磁盘缓存的计划，不存在时构建并写入缓存（index 以 .npy 存储，可内存映射读取）"""
+    os.makedirs(cache_dir, exist_ok=True)
+    key = plan_key(src, region)
+    meta_path = os.path.join(cache_dir, f"{region['name']}_{key}.json")
+    index_path = os.path.join(cache_dir, f"{region['name']}_{key}.npy")
+
+    if os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta is None:
+            return None
+        return {
+            "window": rasterio.windows.Window(*meta["window"]),
+            "index": np.load(index_path, mmap_mode="r"),
+            "transform": rasterio.Affine(*meta["transform"]),
+            "width": meta["width"],
+            "height": meta["height"],
+        }
+
+    plan = build_warp_plan(src, region)
+    meta = None
+    if plan is not None:
+        # 临时文件名带进程号：多个进程同时构建同一格网的计划时互不覆盖
+        tmp_index = f"{index_path}.tmp{os.getpid()}.npy"
+        np.save(tmp_index, plan["index"])
+        os.replace(tmp_index, index_path)
+        w = plan["window"]
+        meta = {
+            "window": [w.col_off, w.row_off, w.width, w.height],
+            "transform": list(plan["transform"])[:6],
+            "width": plan["width"],
+            "height": plan["height"],
+        }
+    # meta 最后写入，作为计划完整的标志
+    tmp_meta = f"{meta_path}.tmp{os.getpid()}"
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, meta_path)
+    return plan
+
+
+def clip_with_plan(src, plan, output_tif):
+    """按计划取值：只读取裁切窗口，对每个波段做一次索引 gather"""
+    src_nodata = src.nodata if src.nodata is not None else -9999
+    index = np.asarray(plan["index"])
+    valid = index >= 0
+    safe_index = np.where(valid, index, 0)
+
+    dst_meta = output_meta(src, plan["transform"], plan["width"], plan["height"], src_nodata)
+
+    with rasterio.open(output_tif, "w", **dst_meta) as dst:
+        for i in range(1, src.count + 1):
+            data = src.read(i, window=plan["window"]).ravel()
+            out = np.where(valid, data[safe_index], src_nodata).astype(data.dtype)
+            dst.write(out, i)
+        build_overviews(dst)
+
+
+def stream_grid(src, region):
+    """
+    不读取任何像元即可得到与 mask(crop=True) + calculate_default_transform 相同的目标格网。
+    区域不在影像覆盖范围内时返回 None。
+    """
+    try:
+        window = geometry_window(src, [region["rect_4326"].__geo_interface__])
+    except ValueError:
+        return None
+    clip_transform = src.window_transform(window)
+    return dst_grid(src.crs, clip_transform, int(window.height), int(window.width))
+
+
+def clip_streaming(src, region, output_tif):
+    """
+    流式裁切重投影：WarpedVRT 把源影像虚拟重投影到目标格网，按输出分块逐块读取与写出，
+    GDAL 只解码每块所需的源窗口。
+    与 mask 相同，源像元中心不在区域多边形内的目标像元置为 nodata。
+    区域不在影像范围内时返回 False。
+    """
+    grid = stream_grid(src, region)
+    if grid is None:
+        return False
+    transform, width, height = grid
+    src_nodata = src.nodata if src.nodata is not None else -9999
+
+    to_src = Transformer.from_crs(DST_CRS, src.crs, always_xy=True)
+    inverse = ~src.transform
+    rect_4326 = region["rect_4326"]
+    shapely.prepare(rect_4326)
+
+    def outside_mask(window):
+        """目标像元中心 -> 源像元 -> 源像元中心不在区域多边形内"""
+        cc, rr = np.meshgrid(np.arange(window.col_off, window.col_off + window.width) + 0.5,
+                             np.arange(window.row_off, window.row_off + window.height) + 0.5)
+        lon, lat = to_src.transform(*(transform * (cc, rr)))
+        src_col, src_row = inverse * (np.asarray(lon), np.asarray(lat))
+        cx, cy = src.transform * (np.floor(src_col) + 0.5, np.floor(src_row) + 0.5)
+        return ~shapely.contains_xy(rect_4326, cx, cy)
+
+    dst_meta = output_meta(src, transform, width, height, src_nodata)
+
+    with WarpedVRT(
+        src,
+        crs=DST_CRS,
+        transform=transform,
+        width=width,
+        height=height,
+        resampling=Resampling.nearest,
+        src_nodata=src_nodata,
+        nodata=src_nodata,
+        warp_mem_limit=warp_mem_limit_mb,
+    ) as vrt, rasterio.open(output_tif, "w", **dst_meta) as dst:
+        for row0 in range(0, height, cog_block_size):
+            for col0 in range(0, width, cog_block_size):
+                window = Window(col0, row0, min(cog_block_size, width - col0),
+                                min(cog_block_size, height - row0))
+
+                # 分块在源坐标中的范围（外扩一个源像元）：完全在多边形内无需掩膜，完全在外直接写 nodata
+                footprint = box(*transform_bounds(DST_CRS, src.crs, *dst.window_bounds(window), densify_pts=21))
+                footprint = footprint.buffer(max(abs(src.transform.a), abs(src.transform.e)))
+                if not rect_4326.intersects(footprint):
+                    empty = np.full((int(window.height), int(window.width)), src_nodata, dtype=dst.dtypes[0])
+                    for i in range(1, src.count + 1):
+                        dst.write(empty, i, window=window)
+                    continue
+                outside = None
+                if not rect_4326.contains(footprint):
+                    outside = outside_mask(window)
+
+                for i in range(1, src.count + 1):
+                    data = vrt.read(i, window=window)
+                    if outside is not None:
+                        data[outside] = src_nodata
+                    dst.write(data, i, window=window)
+        build_overviews(dst)
+    return True
+
+
+def clip_with_gdal(src, region, output_tif):
+    """原方式：mask(crop=True) 后用 GDAL 重投影，区域不在影像范围内时返回 False"""
+    src_nodata = src.nodata if src.nodata is not None else -9999
+
+    try:
+        out_image, out_transform = mask(
+            src, [region["rect_4326"].__geo_interface__], crop=True, nodata=src_nodata
+        )
+    except ValueError:
+        return False
+
+    transform, width, height = dst_grid(src.crs, out_transform, out_image.shape[1], out_image.shape[2])
+
+    dst_meta = output_meta(src, transform, width, height, src_nodata)
+
+    with rasterio.open(output_tif, "w", **dst_meta) as dst:
+        for i in range(1, src.count + 1):
+            reproject(
+                source=out_image[i - 1],
+                destination=rasterio.band(dst, i),
+                src_transform=out_transform,
+                src_crs=src.crs,
+                dst_transform=transform,
+                dst_crs=DST_CRS,
+                resampling=Resampling.nearest,  # ✅ 用 nearest 防止人口数据负值
+                src_nodata=src_nodata,
+                dst_nodata=src_nodata
+            )
+        build_overviews(dst)
+    return True
 
-    region_code = parts[0]     # usa
-    gender_code = parts[1]     # both
-    age_code = parts[2]        # 00
-    year_code = parts[3]       # 2023
 
-    # 生成输出目录
-    tif_output_folder = os.path.join(output_root, region_code, gender_code, age_code)
-    os.makedirs(tif_output_folder, exist_ok=True)
+def region_job_size(src, region):
+    """区域输出像元数，用于大区域优先调度；不在影像范围内时为 0"""
+    grid = stream_grid(src, region)
+    if grid is None:
+        return 0
+    _, width, height = grid
+    return width * height
 
-    print(f"→ 解析信息：地区={region_code}, 年龄={age_code}, 年份={year_code}")
-    print(f"→ 输出目录：{tif_output_folder}")
 
-    # === 遍历所有 SHP ===
-    for shp_file in os.listdir(shapefile_folder):
+def load_ledger(path):
+    """读取已完成的输出（文件仍存在才算完成）"""
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if os.path.exists(record["output"]):
+                    done.add(record["output"])
+    return done
 
-        if not shp_file.endswith(".shp"):
-            continue
 
-        shp_path = os.path.join(shapefile_folder, shp_file)
-        print(f"\n--- 裁切区域：{shp_file} ---")
+def append_ledger(path, record):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-        # 1. 读取 SHP（3857）
-        gdf = gpd.read_file(shp_path)
-        gdf_3857 = gdf.to_crs("EPSG:3857")
 
-        # 求整体 bounding box + buffer
-        minx, miny, maxx, maxy = gdf_3857.total_bounds
-        rect = box(minx, miny, maxx, maxy)
-        rect_buffered = rect.buffer(buffer_distance)
+# 每个进程只保留最近一个区域的计划（任务按区域连续排列）
+_plan_cache = {}
 
-        # 投影到 4326 用于裁切
-        rect_4326 = gpd.GeoSeries([rect_buffered], crs="EPSG:3857").to_crs("EPSG:4326").geometry[0]
-        geoms_4326 = [rect_4326.__geo_interface__]
 
-        # === 裁切影像（仍是 4326） ===
-        with rasterio.open(tif_path) as src:
-            src_nodata = src.nodata if src.nodata is not None else -9999
-
-            try:
-                out_image, out_transform = mask(
-                    src, geoms_4326, crop=True, nodata=src_nodata
-                )
-            except ValueError:
-                print("⚠ 这个区域不在影像覆盖范围内，跳过")
-                continue
-
-            clip_meta = src.meta.copy()
-            clip_meta.update({
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
-                "crs": src.crs,      # EPSG:4326
-                "nodata": src_nodata
-            })
-
-            # === 重投影到 3857（分辨率 = 100m） ===
-            dst_crs = "EPSG:3857"
-
-            transform, width, height = calculate_default_transform(
-                clip_meta["crs"], dst_crs,
-                clip_meta["width"], clip_meta["height"],
-                *rasterio.transform.array_bounds(
-                    clip_meta["height"], clip_meta["width"], clip_meta["transform"]
-                ),
-                resolution=TARGET_RES
-            )
+def cached_plan(src, region):
+    key = (plan_key(src, region), region["name"])
+    if key not in _plan_cache:
+        _plan_cache.clear()
+        _plan_cache[key] = load_or_build_plan(src, region, plan_cache_folder)
+    return _plan_cache[key]
 
-            dst_meta = clip_meta.copy()
-            dst_meta.update({
-                "crs": dst_crs,
-                "transform": transform,
-                "width": width,
-                "height": height,
-                "nodata": src_nodata
-            })
 
-            region_name = os.path.splitext(shp_file)[0]
-            output_tif = os.path.join(tif_output_folder, f"{region_name}_clip_3857.tif")
+def run_job(tif_file, output_tif, region):
+    """
+    处理一个 (波段, 区域) 任务：先写入临时文件，完成后原子改名，
+    中断时不会留下看似完整的半成品。返回 (output_tif, 是否有输出)。
+    """
+    with span("split_pop.job", band=tif_file, region=region["name"], mode=warp_mode):
+        tif_path = os.path.join(tif_folder, tif_file)
+        # 临时文件不以 .tif 结尾，下游按 *.tif 扫描目录时不会误当作切片（驱动由 meta 指定）
+        tmp_tif = output_tif + ".partial"
 
-            with rasterio.open(output_tif, "w", **dst_meta) as dst:
-                for i in range(1, src.count + 1):
-                    reproject(
-                        source=out_image[i - 1],
-                        destination=rasterio.band(dst, i),
-                        src_transform=out_transform,
-                        src_crs=clip_meta["crs"],
-                        dst_transform=transform,
-                        dst_crs=dst_crs,
-                        resampling=Resampling.nearest,  # ✅ 用 nearest 防止人口数据负值
-                        src_nodata=src_nodata,
-                        dst_nodata=src_nodata
-                    )
-
-        print(f"✓ 完成输出：{output_tif}")
-
-
-print("\n🎉 所有影像处理完成！")
+        with rasterio.open(tif_path) as src:
+            if warp_mode == "plan":
+                plan = cached_plan(src, region)
+                ok = plan is not None
+                if ok:
+                    clip_with_plan(src, plan, tmp_tif)
+            elif warp_mode == "stream":
+                ok = clip_streaming(src, region, tmp_tif)
+            else:
+                ok = clip_with_gdal(src, region, tmp_tif)
+
+        if ok:
+            if cog_layout:
+                cog_tif = output_tif + ".cog.partial"
+                to_cog_layout(tmp_tif, cog_tif)
+                os.remove(tmp_tif)
+                tmp_tif = cog_tif
+            os.replace(tmp_tif, output_tif)
+        return output_tif, ok
+
+
+_gdal_env = {}
+
+
+def _init_worker(gdal_cache_mb, gdal_threads):
+    # 父进程通常已初始化 GDAL，fork 出的子进程不再读取环境变量；
+    # 进程存续期间保持一个 rasterio.Env，预算对本进程之后的所有读取生效
+    if "env" in _gdal_env:
+        _gdal_env["env"].__exit__(None, None, None)
+    _gdal_env["env"] = rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb, GDAL_NUM_THREADS=gdal_threads)
+    _gdal_env["env"].__enter__()
+
+
+def _prepare_region(tif_file, region):
+    """plan 模式下预先构建区域计划（写入磁盘缓存），返回区域输出像元数"""
+    with span("split_pop.prepare_region", region=region["name"]):
+        with rasterio.open(os.path.join(tif_folder, tif_file)) as src:
+            if warp_mode == "plan":
+                load_or_build_plan(src, region, plan_cache_folder)
+            return region["name"], region_job_size(src, region)
+
+
+def main():
+    # === 扫描目录中的所有 TIF 文件 ===
+    tif_files = [f for f in os.listdir(tif_folder) if f.lower().endswith(".tif")]
+
+    if not tif_files:
+        print("❌ 没有找到任何 TIF 文件")
+        return
+
+    print(f"共检测到 {len(tif_files)} 个 TIF 文件，将逐个处理。\n")
+
+    bands = []
+    for tif_file in tif_files:
+        # === 解析命名 ===
+        parsed = parse_tif_name(tif_file)
+        if parsed is None:
+            print(f"⚠ 文件命名不符合预期格式（跳过）: {tif_file}")
+            continue
+        region_code, gender_code, age_code, year_code = parsed
+
+        # 生成输出目录
+        tif_output_folder = os.path.join(output_root, region_code, gender_code, age_code)
+        os.makedirs(tif_output_folder, exist_ok=True)
+        bands.append((tif_file, tif_output_folder))
+
+    if not bands:
+        return
+
+    regions = load_regions(shapefile_folder)
+    print(f"共 {len(regions)} 个裁切区域")
+
+    workers = max_workers or os.cpu_count() or 1
+    gdal_cache_mb = max(64, gdal_cache_total_mb // workers)
+    gdal_threads = max(1, gdal_threads_total // workers)
+    _init_worker(gdal_cache_mb, gdal_threads)
+
+    # === 区域大小（plan 模式同时构建计划），大区域优先，避免最后只剩一个大区域拖尾 ===
+    sizes = {}
+    first_band = bands[0][0]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(gdal_cache_mb, gdal_threads)) as executor:
+            futures = [executor.submit(_prepare_region, first_band, region) for region in regions]
+            for future in as_completed(futures):
+                name, size = future.result()
+                sizes[name] = size
+    else:
+        for region in regions:
+            name, size = _prepare_region(first_band, region)
+            sizes[name] = size
+
+    regions = sorted(regions, key=lambda r: (-sizes[r["name"]], r["name"]))
+
+    # === 断点续传：跳过 ledger 中已完成的输出 ===
+    os.makedirs(output_root, exist_ok=True)
+    ledger_path = os.path.join(output_root, ledger_name)
+    done = load_ledger(ledger_path)
+
+    jobs = []
+    for region in regions:
+        if sizes[region["name"]] == 0:
+            print(f"⚠ 这个区域不在影像覆盖范围内，跳过: {region['shp_file']}")
+            continue
+        for tif_file, tif_output_folder in bands:
+            output_tif = os.path.join(tif_output_folder, f"{region['name']}_clip_3857.tif")
+            if output_tif not in done:
+                jobs.append((tif_file, output_tif, region))
+
+    print(f"待处理任务 {len(jobs)} 个（已完成 {len(done)} 个），进程数 {workers}")
+
+    def record(tif_file, region, output_tif, ok):
+        if ok:
+            append_ledger(ledger_path, {"output": output_tif, "source": tif_file,
+                                        "region": region["name"], "mode": warp_mode})
+            print(f"✓ 完成输出：{output_tif}")
+        else:
+            print(f"⚠ 这个区域不在影像覆盖范围内，跳过: {output_tif}")
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(gdal_cache_mb, gdal_threads)) as executor:
+            futures = {executor.submit(run_job, *job): job for job in jobs}
+            for future in as_completed(futures):
+                tif_file, _, region = futures[future]
+                output_tif, ok = future.result()
+                record(tif_file, region, output_tif, ok)
+    else:
+        for tif_file, output_tif, region in jobs:
+            _, ok = run_job(tif_file, output_tif, region)
+            record(tif_file, region, output_tif, ok)
+
+    print("\n🎉 所有影像处理完成！")
+
+
+if __name__ == "__main__":
+    with span("split_pop", year=year, mode=warp_mode):
+        main()